@@ -0,0 +1,66 @@
+"""
+Inputs for the benchmarks, shaped like what users send to /play
+"""
+
+YOUTUBE = [
+    'https://www.youtube.com/watch?v=dQw4w9WgXcQ',
+    'https://youtube.com/watch?v=dQw4w9WgXcQ',
+    'https://m.youtube.com/watch?v=9bZkp7q19f0',
+    'https://music.youtube.com/watch?v=kJQP7kiw5Fk&feature=share',
+    'https://youtu.be/dQw4w9WgXcQ',
+    'https://youtu.be/dQw4w9WgXcQ?t=42',
+    'https://www.youtube.com/shorts/aqz-KE-bpKQ',
+    'https://www.youtube.com/embed/dQw4w9WgXcQ',
+    'https://www.youtube.com/watch?app=desktop&v=dQw4w9WgXcQ',
+    'https://www.youtube.com/watch?v=dQw4w9WgXcQ&list=PLFgquLnL59alCl_2TQvOiD5Vgm1hCaGSI&index=3',
+    'https://www.youtube.com/watch?v=kJQP7kiw5Fk&list=RDkJQP7kiw5Fk&start_radio=1',
+    'https://www.youtube.com/playlist?list=PLFgquLnL59alCl_2TQvOiD5Vgm1hCaGSI',
+    'https://youtube.com/playlist?list=PLx0sYbCqOb8TBPRdmBHs5Iftvv9TPboYG&si=abc',
+    'check this out https://www.youtube.com/watch?v=dQw4w9WgXcQ',
+    'https://www.youtube.com/watch?v=tooshort',
+    '//www.youtube.com/watch?v=dQw4w9WgXcQ',
+]
+
+SPOTIFY = [
+    'https://open.spotify.com/track/4cOdK2wGLETKBW3PvgPWqT',
+    'https://open.spotify.com/track/4cOdK2wGLETKBW3PvgPWqT?si=1a2b3c4d5e6f',
+    'https://open.spotify.com/album/1DFixLWuPkv3KT3TnV35m3',
+    'https://open.spotify.com/playlist/37i9dQZF1DXcBWIGoYBM5M',
+    'https://open.spotify.com/intl-de/track/4cOdK2wGLETKBW3PvgPWqT',
+    'https://open.spotify.com/artist/0OdUWJ0sBjDrqHygGUXeCF',
+    'listen https://open.spotify.com/playlist/37i9dQZF1DXcBWIGoYBM5M please',
+]
+
+SOUNDCLOUD = [
+    'https://soundcloud.com/forss/flickermood',
+    'https://soundcloud.com/forss/sets/soulhack',
+    'https://m.soundcloud.com/user-123456/some-track-name',
+]
+
+RADIO = [
+    'https://radio.garden/listen/radio-1/abcdEFGH',
+    'https://radio.garden/visit/prague/Xy1z2ABC',
+    '_tunein:s24939',
+    '_radia_cz:radio-1',
+    '_radia_cz:evropa2',
+    '_local:1',
+]
+
+TEXT = [
+    'never gonna give you up',
+    'rick astley',
+    'lofi hip hop radio beats to relax study to',
+    'Dvořák symfonie č. 9 Z Nového světa',
+    'a',
+    'https://example.com/audio/stream.mp3',
+    'http://ice.somafm.com/groovesalad-128-mp3',
+    'playlist?list= is not a link',
+    'index=5 something',
+    'x' * 300,
+]
+
+URLS = YOUTUBE + SPOTIFY + SOUNDCLOUD + RADIO + TEXT
+
+DURATIONS = [None, 0, '0', 1, 59, 60, 61, 3599, 3600, 3661, 86399, 359999, '215', '3:14', 12.7, 'abc']
+
+TIMESTAMPS = [0, 1, 1700000000, 2147483647, '1700000000', 1700000000.5, 'never', None]
@@ -0,0 +1,120 @@
+"""
+Memory of the guild cache with the 'full' and 'lean' gateway profiles (utils.discord.gateway_options)
+
+python -m benchmarks.gateway_memory
+python -m benchmarks.gateway_memory --guilds 20 --members 25000
+
+Synthetic GUILD_CREATE payloads (members, presences, roles, channels and voice states) are built into
+discord.Guild objects with the state of a client created with each profile, as if the guilds were chunked
+('full') or not ('lean'). The payloads are built before measuring, only the cache is counted (tracemalloc).
+"""
+from __future__ import annotations
+
+from time import perf_counter
+import tracemalloc
+import argparse
+import random
+import gc
+import sys
+
+import discord
+
+from utils.discord import gateway_options
+
+def member_payload(user_id: int, roles: list[str], rng: random.Random) -> dict:
+    return {
+        'user': {'id': str(user_id), 'username': f'user{user_id}', 'global_name': f'User {user_id}', 'discriminator': '0', 'avatar': f'{rng.getrandbits(128):032x}', 'bot': False},
+        'nick': f'nick{user_id}' if rng.random() < 0.3 else None,
+        'roles': rng.sample(roles, k=min(len(roles), rng.randint(0, 4))),
+        'joined_at': '2021-01-01T00:00:00.000000+00:00',
+        'deaf': False,
+        'mute': False,
+        'flags': 0,
+    }
+
+def presence_payload(user_id: int, rng: random.Random) -> dict:
+    activities = []
+    if rng.random() < 0.4:
+        activities.append({'name': 'Some Game', 'type': 0, 'created_at': 1700000000000})
+    return {'user': {'id': str(user_id)}, 'status': rng.choice(['online', 'idle', 'dnd']), 'client_status': {'desktop': 'online'}, 'activities': activities}
+
+def guild_payload(guild_id: int, members: int, rng: random.Random) -> dict:
+    roles = [{'id': str(guild_id * 1000 + index), 'name': f'role{index}', 'permissions': '0', 'position': index, 'color': 0, 'hoist': False, 'managed': False, 'mentionable': False}
+             for index in range(20)]
+    role_ids = [role['id'] for role in roles[1:]]
+    roles[0]['id'] = str(guild_id)  # @everyone
+
+    channels = [{'id': str(guild_id * 10000 + index), 'type': 2 if index % 5 == 0 else 0, 'name': f'channel{index}', 'position': index, 'permission_overwrites': [], 'guild_id': str(guild_id), 'bitrate': 64000, 'user_limit': 0}
+                for index in range(50)]
+    voice_channels = [channel['id'] for channel in channels if channel['type'] == 2]
+
+    user_ids = [guild_id * 1_000_000 + index for index in range(members)]
+    online = [user_id for user_id in user_ids if rng.random() < 0.2]
+    in_voice = rng.sample(user_ids, k=min(members, 30))
+
+    return {
+        'id': str(guild_id),
+        'name': f'guild{guild_id}',
+        'owner_id': str(user_ids[0]),
+        'member_count': members,
+        'roles': roles,
+        'channels': channels,
+        'emojis': [],
+        'stickers': [],
+        'features': [],
+        'members': [member_payload(user_id, role_ids, rng) for user_id in user_ids],
+        'presences': [presence_payload(user_id, rng) for user_id in online],
+        'voice_states': [{'user_id': str(user_id), 'channel_id': rng.choice(voice_channels), 'session_id': 'x', 'deaf': False, 'mute': False, 'self_deaf': False, 'self_mute': False, 'self_video': False, 'suppress': False, 'request_to_speak_timestamp': None}
+                         for user_id in in_voice],
+        'threads': [],
+        'stage_instances': [],
+        'guild_scheduled_events': [],
+        'large': members > 250,
+    }
+
+def measure(profile: str, payloads: list[dict]) -> dict:
+    """
+    Builds the guild cache of payloads with profile
+    :return: {'bytes', 'members', 'seconds'}
+    """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        start_size, _ = tracemalloc.get_traced_memory()
+        start = perf_counter()
+
+        client = discord.Client(**gateway_options(profile))
+        state = client._connection
+        guilds = [discord.Guild(data=payload, state=state) for payload in payloads]
+
+        seconds = perf_counter() - start
+        gc.collect()
+        size, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    members = sum(len(guild.members) for guild in guilds)
+    return {'bytes': size - start_size, 'members': members, 'seconds': seconds}
+
+def main(argv: list[str]=None) -> int:
+    parser = argparse.ArgumentParser(description='Memory of the guild cache with the full and lean gateway profiles')
+    parser.add_argument('--guilds', type=int, default=10)
+    parser.add_argument('--members', type=int, default=10000, help='members per guild')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    rng = random.Random(args.seed)
+    payloads = [guild_payload(guild_id, args.members, rng) for guild_id in range(1, args.guilds + 1)]
+
+    results = {profile: measure(profile, payloads) for profile in ('full', 'lean')}
+
+    print(f"{'profile':<10}{'cache MiB':>12}{'members':>12}{'build s':>10}")
+    for profile, result in results.items():
+        print(f"{profile:<10}{result['bytes'] / 1024 ** 2:>12.1f}{result['members']:>12}{result['seconds']:>10.2f}")
+    full, lean = results['full']['bytes'], results['lean']['bytes']
+    if full:
+        print(f'lean uses {1 - lean / full:.0%} less memory for {args.guilds} guilds x {args.members} members')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,189 @@
+"""
+Benchmarks of utils.url and utils.convert (the hot path of every /play)
+
+python -m benchmarks.url_convert            # run and compare with the baseline
+python -m benchmarks.url_convert --save     # run and store the baseline
+python -m benchmarks.url_convert --quick    # fewer rounds (for a quick check)
+
+Every case is run over the whole corpus, ops/sec is the number of calls per second (best round),
+allocations are measured with tracemalloc over one pass of the corpus.
+The baseline also stores a digest of the results, so a change of behaviour is reported too.
+"""
+from __future__ import annotations
+
+from typing import Callable
+from time import perf_counter
+import tracemalloc
+import platform
+import argparse
+import hashlib
+import json
+import sys
+import os
+
+from utils.url import get_url_type, extract_yt_id, get_first_url, get_url_of, classify_url_uncached
+from utils.convert import convert_duration, struct_to_time
+from benchmarks.corpus import URLS, DURATIONS, TIMESTAMPS
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), 'baselines', 'url_convert.json')
+ROUNDS = 7
+MIN_ROUND_TIME = 0.2  # seconds, the number of loops per round is scaled to at least this
+TOLERANCE = 0.25  # relative slowdown reported as a regression
+
+CASES: dict[str, tuple[Callable, list[tuple]]] = {
+    'get_url_type': (get_url_type, [(url,) for url in URLS]),
+    'classify_cold': (classify_url_uncached, [(url,) for url in URLS]),
+    'extract_yt_id': (extract_yt_id, [(url,) for url in URLS]),
+    'get_first_url': (get_first_url, [(url,) for url in URLS]),
+    'get_url_of': (get_url_of, [(url, section) for url in URLS for section in ('list=', 'spotify.com/', 'radio.garden/')]),
+    'convert_duration': (convert_duration, [(duration,) for duration in DURATIONS]),
+    'struct_to_time': (struct_to_time, [(timestamp, first) for timestamp in TIMESTAMPS for first in ('date', 'time', 'discord')]),
+}
+
+def _pass(func: Callable, inputs: list[tuple]) -> None:
+    for args in inputs:
+        func(*args)
+
+def _pass_keep(func: Callable, inputs: list[tuple]) -> list:
+    return [func(*args) for args in inputs]
+
+def measure_speed(func: Callable, inputs: list[tuple], rounds: int=ROUNDS) -> float:
+    """
+    Returns calls per second of the best round
+    :param func: function to measure
+    :param inputs: list of argument tuples
+    :param rounds: int
+    :return: float
+    """
+    loops = 1
+    while True:
+        start = perf_counter()
+        for _ in range(loops):
+            _pass(func, inputs)
+        elapsed = perf_counter() - start
+        if elapsed >= MIN_ROUND_TIME:
+            break
+        loops *= 2
+
+    best = elapsed
+    for _ in range(rounds - 1):
+        start = perf_counter()
+        for _ in range(loops):
+            _pass(func, inputs)
+        best = min(best, perf_counter() - start)
+
+    return loops * len(inputs) / best
+
+def measure_allocations(func: Callable, inputs: list[tuple]) -> dict:
+    """
+    Returns allocations of one pass over inputs (after a warm-up pass)
+    Results are kept alive until the snapshot, so blocks and bytes include the returned objects,
+    peak includes temporary allocations too
+    :param func: function to measure
+    :param inputs: list of argument tuples
+    :return: {'blocks_per_call', 'bytes_per_call', 'peak_bytes'}
+    """
+    _pass(func, inputs)
+
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+        start_size, _ = tracemalloc.get_traced_memory()
+        kept = _pass_keep(func, inputs)
+        after = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        del kept
+    finally:
+        tracemalloc.stop()
+
+    blocks = 0
+    size = 0
+    for stat in after.compare_to(before, 'filename'):
+        if stat.size_diff > 0:
+            blocks += stat.count_diff
+            size += stat.size_diff
+
+    return {'blocks_per_call': round(blocks / len(inputs), 3), 'bytes_per_call': round(size / len(inputs), 1), 'peak_bytes': peak - start_size}
+
+def results_digest(func: Callable, inputs: list[tuple]) -> str:
+    """
+    Returns digest of the results of func over inputs (detects changes of behaviour)
+    """
+    results = [repr(func(*args)) for args in inputs]
+    return hashlib.sha1('\n'.join(results).encode()).hexdigest()
+
+def run(rounds: int=ROUNDS, only: list[str]=None) -> dict:
+    """
+    Runs all cases
+    :param rounds: int - rounds of the speed measurement
+    :param only: list of case names to run (all if None)
+    :return: {case: {'calls', 'ops_per_sec', 'blocks_per_call', 'bytes_per_call', 'peak_bytes', 'digest'}}
+    """
+    results = {}
+    for name, (func, inputs) in CASES.items():
+        if only and name not in only:
+            continue
+        result = {'calls': len(inputs), 'ops_per_sec': round(measure_speed(func, inputs, rounds))}
+        result.update(measure_allocations(func, inputs))
+        result['digest'] = results_digest(func, inputs)
+        results[name] = result
+    return results
+
+def compare(results: dict, baseline: dict, tolerance: float=TOLERANCE) -> list[str]:
+    """
+    Returns list of regressions of results against baseline
+    """
+    problems = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if result['digest'] != base['digest']:
+            problems.append(f'{name}: results differ from the baseline')
+        if result['ops_per_sec'] < base['ops_per_sec'] * (1 - tolerance):
+            problems.append(f"{name}: {result['ops_per_sec']} ops/s is slower than the baseline {base['ops_per_sec']} ops/s")
+        if result['blocks_per_call'] > base['blocks_per_call'] + 1:
+            problems.append(f"{name}: {result['blocks_per_call']} blocks/call, baseline {base['blocks_per_call']}")
+    return problems
+
+def main(argv: list[str]=None) -> int:
+    parser = argparse.ArgumentParser(description='Benchmarks of utils.url and utils.convert')
+    parser.add_argument('--save', action='store_true', help='store the results as the baseline')
+    parser.add_argument('--quick', action='store_true', help='run only 2 rounds')
+    parser.add_argument('--baseline', default=BASELINE_PATH, help='path of the baseline file')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE, help='relative slowdown reported as a regression')
+    parser.add_argument('cases', nargs='*', help=f"cases to run ({', '.join(CASES)})")
+    args = parser.parse_args(argv)
+
+    results = run(2 if args.quick else ROUNDS, args.cases)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f).get('results', {})
+
+    print(f"{'case':<18}{'ops/s':>12}{'baseline':>12}{'change':>9}{'blocks/call':>13}{'bytes/call':>12}")
+    for name, result in results.items():
+        base = baseline.get(name)
+        base_ops = base['ops_per_sec'] if base else None
+        change = f'{result["ops_per_sec"] / base_ops - 1:+.0%}' if base_ops else '-'
+        print(f"{name:<18}{result['ops_per_sec']:>12}{base_ops or '-':>12}{change:>9}{result['blocks_per_call']:>13}{result['bytes_per_call']:>12}")
+
+    if args.save:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        stored = dict(baseline)
+        stored.update(results)
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump({'python': platform.python_version(), 'machine': platform.machine(), 'results': stored}, f, indent=2)
+            f.write('\n')
+        print(f'Baseline saved to {args.baseline}')
+        return 0
+
+    problems = compare(results, baseline, args.tolerance)
+    for problem in problems:
+        print(f'REGRESSION {problem}')
+    return 1 if problems else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,175 @@
+"""
+Differential check of utils.url.get_url_type against its previous implementation (kept below verbatim)
+
+python -m benchmarks.url_differential              # corpus + 200000 generated inputs
+python -m benchmarks.url_differential --count 1000000 --seed 7
+
+Generated inputs are made of fragments of real inputs (hosts, paths, parameters, prefixes and words)
+joined in random order, so every branch of the classifier and their combinations are hit.
+"""
+from __future__ import annotations
+
+from typing import Literal
+import argparse
+import random
+import sys
+import re
+
+from utils.url import get_url_type, classify_url, extract_yt_id
+from benchmarks.corpus import URLS
+
+# ---------------------------------------------- Reference -------------------------------------------------------------
+
+def reference_extract_yt_id(url_string: str) -> str or None:
+    magic_regex = r"^(?:https?://|//)?(?:www\.|m\.|.+\.)?(?:youtu\.be/|youtube\.com/(?:embed/|v/|shorts/|feeds/api/videos/|watch\?v=|watch\?.+&v=))([\w-]{11})(?![\w-])"
+    regex = re.compile(magic_regex)
+    results = regex.search(url_string)
+
+    if results is None:
+        return None
+    return results.group(1)
+
+def reference_get_url_of(string: str, section: str) -> str or None:
+    separated_string = string.split(' ')
+
+    for s_string in separated_string:
+        if section in s_string:
+            return reference_get_first_url(s_string)
+
+    return None
+
+def reference_get_first_url(string: str) -> str or None:
+    re_search = re.search(r"(http|ftp|https)://([\w_-]+(?:\.[\w_-]+)+)([\w.,@?^=%&:/~+#-]*[\w@?^=%&/~+#-])", string)
+    if re_search is None:
+        return None
+    return re_search[0]
+
+def reference_get_url_type(string: str) -> tuple[Literal['YouTube Playlist', 'YouTube Playlist Video', 'YouTube Video', 'Spotify Playlist', 'Spotify Album', 'Spotify Track', 'Spotify URL', 'SoundCloud URL', 'RadioGarden', 'RadioTuneIn', 'RadioCz', 'Local', 'String with URL', 'String'], str]:
+    first_url = reference_get_first_url(string)
+    yt_id = reference_extract_yt_id(string)
+
+    if '/playlist?list=' in string and reference_extract_yt_id(string) is None:
+        extracted_url = reference_get_url_of(string, '/playlist?list=')
+        if extracted_url is None:
+            return 'String', string
+        return 'YouTube Playlist', extracted_url
+
+    if any(param in string for param in {'index=', 'list='}) and reference_extract_yt_id(string) is not None:
+        extracted_url = reference_get_url_of(string, 'index=')
+        if extracted_url is None:
+            extracted_url = reference_get_url_of(string, 'list=')
+            if extracted_url is None:
+                return 'String', string
+        return 'YouTube Playlist Video', extracted_url
+
+    if yt_id is not None:
+        return 'YouTube Video', string
+
+    if 'spotify.com/playlist/' in string:
+        extracted_url = reference_get_url_of(string, 'spotify.com/playlist/')
+        if extracted_url is None:
+            return 'String', string
+        return 'Spotify Playlist', extracted_url
+
+    if 'spotify.com/album/' in string:
+        extracted_url = reference_get_url_of(string, 'spotify.com/album/')
+        if extracted_url is None:
+            return 'String', string
+        return 'Spotify Album', extracted_url
+
+    if 'spotify.com/track/' in string:
+        extracted_url = reference_get_url_of(string, 'spotify.com/track/')
+        if extracted_url is None:
+            return 'String', string
+        return 'Spotify Track', extracted_url
+
+    if 'spotify.com/' in string:
+        extracted_url = reference_get_url_of(string, 'spotify.com/')
+        if extracted_url is None:
+            return 'String', string
+        return 'Spotify URL', extracted_url
+
+    if 'soundcloud.com/' in string:
+        extracted_url = reference_get_url_of(string, 'soundcloud.com/')
+        if extracted_url is None:
+            return 'String', string
+        return 'SoundCloud URL', extracted_url
+
+    if 'radio.garden/' in string:
+        extracted_url = reference_get_url_of(string, 'radio.garden/')
+        if extracted_url is None:
+            return 'String', string
+        return 'RadioGarden', extracted_url
+
+    if string.startswith('_tunein:'):
+        return 'RadioTuneIn', string
+
+    if string.startswith('_radia_cz:'):
+        return 'RadioCz', string
+
+    if string.startswith('_local:'):
+        return 'Local', string
+
+    if first_url is not None:
+        return 'String with URL', first_url
+
+    return 'String', string
+
+# ---------------------------------------------- Generator -------------------------------------------------------------
+
+FRAGMENTS = [
+    'https://', 'http://', '//', 'ftp://', 'www.', 'm.', 'music.', 'open.', 'check.this.',
+    'youtube.com/', 'youtu.be/', 'spotify.com/', 'soundcloud.com/', 'radio.garden/', 'example.com/',
+    'watch?v=', 'watch?app=desktop&v=', 'embed/', 'shorts/', 'v/', 'feeds/api/videos/', 'playlist?list=', '/playlist?list=',
+    'playlist/', 'album/', 'track/', 'artist/', 'intl-de/', 'listen/', 'sets/',
+    'dQw4w9WgXcQ', 'kJQP7kiw5Fk', 'shortid', 'PLFgquLnL59alCl_2TQvOiD5Vgm1hCaGSI', '37i9dQZF1DXcBWIGoYBM5M',
+    '&list=', '&index=', 'index=', 'list=', '&t=42', '?si=abc', '&', '?', '=', '.', '/', '-', '_',
+    '_tunein:', '_radia_cz:', '_local:', 's24939', 'evropa2',
+    ' ', ' ', ' ', 'play', 'never gonna give you up', 'Dvořák', '\n',
+]
+
+def generate(rng: random.Random) -> str:
+    if rng.random() < 0.3:
+        # mutation of a real input
+        base = rng.choice(URLS)
+        position = rng.randint(0, len(base))
+        return base[:position] + ''.join(rng.choice(FRAGMENTS) for _ in range(rng.randint(0, 3))) + base[position:]
+    return ''.join(rng.choice(FRAGMENTS) for _ in range(rng.randint(1, 12)))
+
+def check(string: str) -> list[str]:
+    problems = []
+    expected = reference_get_url_type(string)
+    if get_url_type(string) != expected:
+        problems.append(f'get_url_type({string!r}) = {get_url_type(string)!r}, expected {expected!r}')
+    if extract_yt_id(string) != reference_extract_yt_id(string):
+        problems.append(f'extract_yt_id({string!r}) = {extract_yt_id(string)!r}, expected {reference_extract_yt_id(string)!r}')
+    info = classify_url(string)
+    if info.video_id != reference_extract_yt_id(info.url):
+        problems.append(f'classify_url({string!r}).video_id = {info.video_id!r}, expected {reference_extract_yt_id(info.url)!r}')
+    return problems
+
+def main(argv: list[str]=None) -> int:
+    parser = argparse.ArgumentParser(description='Differential check of utils.url.get_url_type')
+    parser.add_argument('--count', type=int, default=200000, help='number of generated inputs')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    rng = random.Random(args.seed)
+    inputs = list(URLS) + [generate(rng) for _ in range(args.count)]
+
+    problems = []
+    types = {}
+    for string in inputs:
+        problems.extend(check(string))
+        url_type = reference_get_url_type(string)[0]
+        types[url_type] = types.get(url_type, 0) + 1
+
+    for url_type, count in sorted(types.items(), key=lambda item: -item[1]):
+        print(f'{url_type:<24}{count:>8}')
+    for problem in problems[:20]:
+        print(f'MISMATCH {problem}')
+    print(f'{len(inputs)} inputs, {len(problems)} mismatches')
+    return 1 if problems else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
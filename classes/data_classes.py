@@ -1,3 +1,5 @@
+from typing import NamedTuple
+
 class ReturnData:
     """
     Data class for returning data from functions
@@ -15,3 +17,60 @@ class ReturnData:
         self.message = message
         self.video = video
         self.terminate = terminate
+
+class QueueEntry:
+    """
+    Data class for one track in a guild queue
+
+    :type url: str
+    :type author: discord.User or discord.Member or None
+
+    :param url: URL of the track (output of get_url)
+    :param author: Who added the track
+    """
+    def __init__(self, url: str, author=None):
+        self.url = url
+        self.author = author
+
+        self.title = None  # filled when the track is resolved
+        self.duration = None
+        self.data = None  # resolved info dict (see GetSource.resolve)
+
+class QueuePlaylist:
+    """
+    Data class for the not yet loaded rest of a YouTube playlist in a guild queue
+    Stands in the queue as one entry and is replaced by its next page of tracks when it reaches the front
+
+    :type url: str
+    :type author: discord.User or discord.Member or None
+
+    :param url: Canonical URL of the playlist
+    :param author: Who added the playlist
+    :param next_index: Index of the next entry to load (starting with 1)
+    :param skip_id: YouTube id of a video to leave out (the video the playlist was added with)
+    """
+    def __init__(self, url: str, author=None, next_index: int=1, skip_id: str=None):
+        self.url = url
+        self.author = author
+        self.next_index = next_index
+        self.skip_id = skip_id
+
+        self.title = None  # filled by the first page
+        self.task = None  # asyncio.Task loading the next page
+        self.failures = 0  # consecutive pages that could not be loaded because the extractor was overloaded
+
+class UrlInfo(NamedTuple):
+    """
+    Result of utils.url.classify_url (immutable, instances are shared by the memo cache)
+
+    :param type: URL type ('YouTube Video', 'Spotify Track', 'String', ...)
+    :param url: Canonical URL (or the input string for 'String' and radio types)
+    :param video_id: YouTube video id of url or None
+    :param playlist_id: YouTube playlist id of url (list= parameter) or None
+    :param spotify_id: Spotify track / album / playlist id of url or None
+    """
+    type: str
+    url: str
+    video_id: str or None = None
+    playlist_id: str or None = None
+    spotify_id: str or None = None
@@ -1,35 +1,63 @@
-from classes.data_classes import ReturnData
+from classes.data_classes import ReturnData, QueueEntry, QueuePlaylist, UrlInfo
 
-from utils.source import GetSource
+from utils.queue import get_queue
+from utils.sessions import voice_sessions
+from utils.tracing import start_trace, span
 from utils.log import log
 from utils.url import get_first_url
-from utils.url import get_url_type, extract_yt_id
+from utils.url import classify_url, get_playlist_index
+from utils.radio import get_station, RadioError, RADIO_TYPES
 
 import commands.voice
+import commands.queue
 
+from time import time
 import discord
-import subprocess
+import asyncio
+import aiohttp
 import json
 
-async def get_url_probe_data(url: str) -> (tuple or None, str or None):
+PROBE_CONCURRENCY = 4  # max number of ffprobe processes running at once
+PROBE_TIMEOUT = 20  # seconds
+PROBE_CACHE_TTL = 3600  # seconds to keep a successful probe result
+PROBE_CACHE_NEGATIVE_TTL = 300  # seconds to keep a failed probe result
+PROBE_CACHE_SIZE = 512
+
+probe_semaphore: asyncio.Semaphore or None = None
+probe_cache: dict[str, tuple[float, tuple or None]] = {}
+
+async def probe_url(url: str) -> tuple or None:
     """
-    Returns probe data of url
-    or None if not found
+    Runs ffprobe on url without blocking the event loop
     :param url: str: url to probe
-    :return: tuple(codec, bitrate), url or None, None
+    :return: tuple(codec, bitrate) or None
     """
-    extracted_url = get_first_url(url)
-    if extracted_url is None:
-        return None, extracted_url
-
+    global probe_semaphore
+    if probe_semaphore is None:
+        probe_semaphore = asyncio.Semaphore(PROBE_CONCURRENCY)
+
+    executable = 'ffmpeg'
+    exe = executable[:2] + 'probe' if executable in ('ffmpeg', 'avconv') else executable
+    args = ['-v', 'quiet', '-print_format', 'json', '-show_streams', '-select_streams', 'a:0', url]
+
+    async with probe_semaphore:
+        # noinspection PyBroadException
+        try:
+            process = await asyncio.create_subprocess_exec(exe, *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+        except Exception:
+            return None
+
+        try:
+            output, _ = await asyncio.wait_for(process.communicate(), timeout=PROBE_TIMEOUT)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+            raise
+
+    codec = bitrate = None
     # noinspection PyBroadException
     try:
-        executable = 'ffmpeg'
-        exe = executable[:2] + 'probe' if executable in ('ffmpeg', 'avconv') else executable
-        args = [exe, '-v', 'quiet', '-print_format', 'json', '-show_streams', '-select_streams', 'a:0', extracted_url]
-        output = subprocess.check_output(args, timeout=20)
-        codec = bitrate = None
-
         if output:
             data = json.loads(output)
             streamdata = data['streams'][0]
@@ -41,9 +69,60 @@ async def get_url_probe_data(url: str) -> (tuple or None, str or None):
         codec, bitrate = None, None
 
     if codec and bitrate:
-        return (codec, bitrate), extracted_url
+        return codec, bitrate
+    return None
+
+async def get_url_probe_data(url: str) -> (tuple or None, str or None):
+    """
+    Returns probe data of url
+    or None if not found
+    Results (also negative ones) are cached per url
+    :param url: str: url to probe
+    :return: tuple(codec, bitrate), url or None, None
+    """
+    extracted_url = get_first_url(url)
+    if extracted_url is None:
+        return None, extracted_url
+
+    cached = probe_cache.get(extracted_url)
+    if cached is not None and cached[0] > time():
+        return cached[1], extracted_url
+
+    try:
+        probe = await probe_url(extracted_url)
+    except asyncio.TimeoutError:
+        probe = None
+
+    ttl = PROBE_CACHE_TTL if probe else PROBE_CACHE_NEGATIVE_TTL
+    probe_cache.pop(extracted_url, None)
+    probe_cache[extracted_url] = (time() + ttl, probe)
+    while len(probe_cache) > PROBE_CACHE_SIZE:
+        del probe_cache[next(iter(probe_cache))]
+
+    return probe, extracted_url
 
-    return None, extracted_url
+def playlist_url(playlist_id: str) -> str:
+    return f'https://www.youtube.com/playlist?list={playlist_id}'
+
+def get_playlist(url_info: UrlInfo, author=None) -> QueuePlaylist or None:
+    """
+    Returns queue placeholder of the playlist in url_info
+    For a playlist video, the playlist continues after the video (index= parameter) or leaves the video out
+
+    :param url_info: UrlInfo - classified input of the user
+    :param author: Who added the playlist
+    :return: QueuePlaylist or None if url_info has no playlist
+    """
+    if url_info.type not in ('YouTube Playlist', 'YouTube Playlist Video') or not url_info.playlist_id:
+        return None
+
+    if url_info.type == 'YouTube Playlist':
+        return QueuePlaylist(playlist_url(url_info.playlist_id), author)
+
+    index = get_playlist_index(url_info.url)
+    if index is not None:
+        return QueuePlaylist(playlist_url(url_info.playlist_id), author, next_index=index + 1)
+    return QueuePlaylist(playlist_url(url_info.playlist_id), author, skip_id=url_info.video_id)
 
 async def get_url(ctx, url) -> ReturnData:
     """
@@ -58,8 +137,8 @@ async def get_url(ctx, url) -> ReturnData:
         return ReturnData(False, message)
 
     # Get url type
-    url_type, url = get_url_type(url)
-    yt_id = extract_yt_id(url)
+    url_info = classify_url(url)
+    url_type, url, yt_id = url_info.type, url_info.url, url_info.video_id
 
     if url_type in ['Spotify Playlist', 'Spotify Album', 'Spotify Track', 'Spotify URL']:
         message = 'Spotify URLs are not supported in this bot'
@@ -67,17 +146,29 @@ async def get_url(ctx, url) -> ReturnData:
 
     # YOUTUBE ----------------------------------------------------------------------------------------------------------
 
-    if url_type == 'YouTube Playlist Video':
-        url = url[:url.index('&list=')]
-        url_type = 'YouTube Video'
-
-    if url_type == 'YouTube Video' or yt_id is not None:
+    # the playlist of a playlist video is added by play_def (get_playlist)
+    if url_type in ['YouTube Video', 'YouTube Playlist Video'] or yt_id is not None:
         url = f"https://www.youtube.com/watch?v={yt_id}"
         return ReturnData(True, 'Video url returned', url)
 
     if url_type == 'YouTube Playlist':
-        message = 'YouTube playlists are not supported in this bot'
-        return ReturnData(False, message)
+        if url_info.playlist_id is None:
+            message = f'`{url}` is not a valid YouTube playlist'
+            return ReturnData(False, message)
+        return ReturnData(True, 'Playlist url returned', playlist_url(url_info.playlist_id))
+
+    # RADIO ------------------------------------------------------------------------------------------------------------
+
+    if url_type in RADIO_TYPES:
+        try:
+            station = await get_station(url_type, url)
+        except RadioError as e:
+            return ReturnData(False, str(e))
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            log(ctx, 'Failed to get radio station', options={'url': url, 'error': e}, log_type='error')
+            message = 'Radio station is **not available** right now'
+            return ReturnData(False, message)
+        return ReturnData(True, 'Radio station returned', station)
 
     # URL --------------------------------------------------------------------------------------------------------------
 
@@ -92,49 +183,103 @@ async def get_url(ctx, url) -> ReturnData:
 async def play_def(ctx, bot_class, url, mute_response: bool=False) -> ReturnData:
     log(ctx, 'play_def', options=locals(), log_type='function', author=ctx.author)
 
-    response = ReturnData(False, 'Unknown error')
-
-    voice: discord.VoiceClient = ctx.guild.voice_client
-
-    if not voice:
-        if ctx.author.voice is None:
-            message = "You are **not connected** to a voice channel"
+    trace = start_trace('play', ctx.guild.id, ctx.interaction.id if ctx.interaction else ctx.message.id)
+    try:
+        voice = voice_sessions.voice(ctx.guild.id)
+
+        if not voice:
+            if ctx.author.voice is None:
+                message = "You are **not connected** to a voice channel"
+                if not mute_response:
+                    await ctx.reply(message)
+                return ReturnData(False, message)
+
+        if not ctx.interaction.response.is_done():
+            with span('defer'):
+                await ctx.defer()
+
+        with span('get_url'):
+            url_response = await get_url(ctx, url)
+        if not url_response.response:
+            if not mute_response:
+                await ctx.reply(url_response.message)
+            return url_response
+
+        stream_url = url_response.video
+        url_info = classify_url(url)
+
+        station = None
+        if url_info.type in RADIO_TYPES:
+            station = url_response.video
+            stream_url = station['stream']
+
+        if not voice_sessions.get(ctx.guild.id):
+            with span('join'):
+                join_response = await commands.voice.join_def(ctx, bot_class, None, True)
+            voice = voice_sessions.voice(ctx.guild.id)
+            if not join_response.response or voice is None:
+                if not mute_response:
+                    await ctx.reply(join_response.message)
+                return join_response
+
+        queue = get_queue(ctx.guild.id)
+
+        # idle or queued is decided under the queue lock, so two concurrent requests do not both start playback
+        async with queue.lock:
+            idle = queue.current is None and queue.starting is None and not queue.entries and not voice.is_playing() and not voice.is_paused()
+
+            # a playlist is loaded page by page when it reaches the front of the queue
+            entries = [] if url_info.type == 'YouTube Playlist' else [QueueEntry(stream_url, ctx.author)]
+            playlist = get_playlist(url_info, ctx.author)
+            if playlist is not None:
+                entries.append(playlist)
+
+            if station is not None:
+                # the stream comes from the radio catalogue, it is not extracted
+                entries[0].title = station['station_name']
+                entries[0].data = {'url': station['stream'], 'title': station['station_name'], 'duration': None}
+
+            position = None
+            overflow = None
+            for entry in entries:
+                try:
+                    added = queue.add(entry)
+                except OverflowError as e:
+                    if position is None:
+                        overflow = str(e)
+                    # else the video is queued, only the rest of its playlist did not fit
+                    break
+                position = position or added
+
+        if overflow is not None:
+            if not mute_response:
+                await ctx.reply(overflow)
+            return ReturnData(False, overflow)
+
+        if url_info.type == 'YouTube Playlist':
+            queued_message = f'Added playlist to queue: `{stream_url}` (position {position})'
+        else:
+            queued_message = f'Added to queue: `{entries[0].title or stream_url}` (position {position})'
+
+        if not idle:
+            message = queued_message
+            if voice.is_paused():
+                # a new track resumes a paused player, as it did before the queue
+                resume_response = await commands.voice.resume_def(ctx, bot_class, True)
+                if resume_response.response:
+                    message += ', player **resumed!**'
             if not mute_response:
                 await ctx.reply(message)
-            return ReturnData(False, message)
-
-    if not ctx.interaction.response.is_done():
-        await ctx.defer()
-
+            return ReturnData(True, message)
 
-    url_response = await get_url(ctx, url)
-    if not url_response.response:
+        response = await commands.queue.play_next(bot_class, ctx.guild.id)
+        if not response.response and (voice.is_playing() or queue.starting is not None):
+            # playback was started by another request meanwhile, the track waits in the queue
+            response = ReturnData(True, queued_message)
         if not mute_response:
-            await ctx.reply(url_response.message)
-        return url_response
-
-    stream_url = url_response.video
-
-    if not ctx.guild.voice_client:
-        join_response = await commands.voice.join_def(ctx, bot_class, None, True)
-        voice: discord.VoiceClient = ctx.guild.voice_client
-        if not join_response.response:
-            if not mute_response:
-                await ctx.reply(join_response.message)
-            return join_response
-
-    if voice.is_playing():
-        voice.stop()
-
-    if voice.is_paused():
-        return await commands.voice.resume_def(ctx, bot_class)
-
-    source = await GetSource.create_source(ctx.guild.id, stream_url)
-    voice.play(source)
-
-    message = f'Now Playing: `{stream_url}`'
-    if not mute_response:
-        await ctx.reply(message)
-    return ReturnData(True, message)
-
-
+            await ctx.reply(response.message)
+        return response
+    finally:
+        # when audio is playing, the trace is finished by the first read of the source
+        if not trace.waiting_audio:
+            trace.finish('not_played')
@@ -0,0 +1,263 @@
+from classes.data_classes import ReturnData, QueuePlaylist
+
+from utils.source import SourceUnavailable
+from utils.extractor import ExtractionError, ExtractionCancelled
+from utils.queue import get_queue, PLAYLIST_RETRY_DELAY, RECONNECT_RETRY_DELAY
+from utils.reaper import idle_reaper
+from utils.sessions import voice_sessions
+from utils.tracing import current_trace, start_trace, TracedSource
+from utils.convert import convert_duration
+from utils.log import log
+
+import contextvars
+import discord
+import asyncio
+
+def _log_failure(guild_id: int, future) -> None:
+    """
+    Logs an exception of play_next started from the 'after' callback (nobody awaits that future)
+    """
+    if future.cancelled():
+        return
+    error = future.exception()
+    if error is not None:
+        log(guild_id, 'play_next failed', options={'error': error}, log_type='error')
+
+def _retry_later(bot_class, guild_id: int, delay: float) -> None:
+    """
+    Calls play_next again after delay seconds (outside of the current trace)
+    """
+    def retry():
+        future = asyncio.ensure_future(play_next(bot_class, guild_id))
+        future.add_done_callback(lambda _future: _log_failure(guild_id, _future))
+
+    bot_class.loop.call_later(delay, retry, context=contextvars.Context())
+
+async def play_next(bot_class, guild_id: int) -> ReturnData:
+    """
+    Plays the next track of the guild queue
+    Called when a track ends (voice.play(after=...)) or when a track is added to an idle queue
+    :param bot_class: Bot class
+    :param guild_id: int
+    :return: ReturnData
+    """
+    queue = get_queue(guild_id)
+
+    trace = current_trace.get()
+    if trace is None or trace.finished or trace.waiting_audio:
+        # transition to the next track (called from the 'after' callback)
+        trace = start_trace('next', guild_id)
+
+    def finish(status: str) -> None:
+        if trace.kind == 'next':
+            trace.finish(status)
+
+    # the lock is held only for the bookkeeping, the track is loaded without it (extraction can take long),
+    # the starting token keeps other calls out meanwhile and is dropped when the queue is cleared
+    starting = object()
+    async with queue.lock:
+        session = voice_sessions.get(guild_id)
+
+        if session is None:
+            queue.clear()
+            finish('not_connected')
+            return ReturnData(False, 'Bot is not connected to a voice channel')
+
+        voice = session.voice_client
+        if voice.is_playing() or voice.is_paused() or queue.starting is not None:
+            finish('already_playing')
+            return ReturnData(False, 'Already playing')
+
+        if not session.connected:
+            # the voice client reconnects, the queue is kept
+            _retry_later(bot_class, guild_id, RECONNECT_RETRY_DELAY)
+            finish('reconnecting')
+            return ReturnData(False, 'Voice connection is reconnecting, playback starts in a moment')
+
+        queue.starting = starting
+
+    try:
+        message = 'Queue is empty'
+        while True:
+            async with queue.lock:
+                if queue.starting is not starting:
+                    finish('stopped')
+                    return ReturnData(False, 'Player was stopped')
+
+                entry = queue.pop_next()
+                if entry is None:
+                    queue.current = None
+                    session.stopped()
+                    idle_reaper.touch(guild_id)
+                    finish('queue_empty')
+                    return ReturnData(False, message)
+
+            if isinstance(entry, QueuePlaylist):
+                # loads the next page of the playlist into the queue
+                if await queue.expand(entry):
+                    continue
+
+                async with queue.lock:
+                    if queue.starting is not starting:
+                        finish('stopped')
+                        return ReturnData(False, 'Player was stopped')
+
+                    # the page can not be loaded now, the tracks behind the playlist are played meanwhile
+                    playlist, entry = entry, queue.pop_after(entry)
+                    if entry is None:
+                        queue.current = None
+                        session.stopped()
+                        idle_reaper.touch(guild_id)
+                        if playlist.failures:
+                            # the extractor is overloaded, the playlist is dropped after PLAYLIST_MAX_RETRIES tries
+                            _retry_later(bot_class, guild_id, PLAYLIST_RETRY_DELAY)
+                        finish('playlist_deferred')
+                        return ReturnData(False, 'Playlist is loading, playback starts in a moment')
+
+            try:
+                # the extraction is cancelled when the player is stopped or the bot leaves the channel
+                source = await queue.take_source(entry, session.volume, alive=lambda: queue.starting is starting and queue.connected())
+            except ExtractionCancelled:
+                finish('stopped')
+                return ReturnData(False, 'Player was stopped')
+            except (SourceUnavailable, ExtractionError) as e:
+                log(guild_id, 'Skipping track that failed to load', options={'url': entry.url, 'error': e}, log_type='error')
+                message = str(e)
+                continue
+
+            async with queue.lock:
+                if queue.starting is not starting:
+                    source.cleanup()
+                    finish('stopped')
+                    return ReturnData(False, 'Player was stopped')
+
+                session = voice_sessions.get(guild_id)
+                if session is None:
+                    # disconnected while the track loaded
+                    source.cleanup()
+                    queue.clear()
+                    finish('not_connected')
+                    return ReturnData(False, 'Bot is not connected to a voice channel')
+                if not session.connected:
+                    # the voice client reconnects, the track is played when it is back
+                    source.cleanup()
+                    queue.entries.appendleft(entry)
+                    _retry_later(bot_class, guild_id, RECONNECT_RETRY_DELAY)
+                    finish('reconnecting')
+                    return ReturnData(False, 'Voice connection is reconnecting, playback starts in a moment')
+                voice = session.voice_client
+
+                def after(error, _loop=bot_class.loop):
+                    if error is not None:
+                        log(guild_id, 'Player error', options={'error': error}, log_type='error')
+                    future = asyncio.run_coroutine_threadsafe(play_next(bot_class, guild_id), _loop)
+                    future.add_done_callback(lambda _future: _log_failure(guild_id, _future))
+
+                source = TracedSource(source, trace, bot_class.loop)
+                try:
+                    voice.play(source, after=after)
+                except Exception as e:
+                    # e.g. the bot was disconnected right now
+                    log(guild_id, 'Failed to start playback', options={'url': entry.url, 'error': e}, log_type='error')
+                    source.cleanup()
+                    queue.current = None
+                    session.stopped()
+                    idle_reaper.touch(guild_id)
+                    trace.finish('play_failed')
+                    return ReturnData(False, f'Could not play `{entry.title or entry.url}`')
+
+                queue.current = entry
+                session.playing(source)
+                queue.prefetch()
+                idle_reaper.touch(guild_id)
+
+                log(guild_id, 'play_next', options={'url': entry.url, 'left': len(queue)}, log_type='function')
+                return ReturnData(True, f'Now Playing: `{entry.title or entry.url}`', entry)
+    finally:
+        if queue.starting is starting:
+            queue.starting = None
+
+async def skip_def(ctx, bot_class, mute_response: bool = False) -> ReturnData:
+    """
+    Skips the current track
+    :param ctx: Context
+    :param bot_class: Bot class
+    :param mute_response: Should bot response be muted
+    :return: ReturnData
+    """
+    log(ctx, 'skip_def', options=locals(), log_type='function', author=ctx.author)
+
+    voice = voice_sessions.voice(ctx.guild.id)
+
+    if not voice or not (voice.is_playing() or voice.is_paused()):
+        message = 'No audio playing'
+        if not mute_response:
+            await ctx.reply(message, ephemeral=True)
+        return ReturnData(False, message)
+
+    # stopping the player triggers play_next via the 'after' callback
+    voice.stop()
+
+    message = 'Track **skipped!**'
+    if not mute_response:
+        await ctx.reply(message, ephemeral=True)
+    return ReturnData(True, message)
+
+async def remove_def(ctx, bot_class, position: int, mute_response: bool = False) -> ReturnData:
+    """
+    Removes track from queue
+    :param ctx: Context
+    :param bot_class: Bot class
+    :param position: int - position of the track in queue (starting with 1)
+    :param mute_response: Should bot response be muted
+    :return: ReturnData
+    """
+    log(ctx, 'remove_def', options=locals(), log_type='function', author=ctx.author)
+
+    try:
+        entry = get_queue(ctx.guild.id).remove(position)
+    except IndexError as e:
+        message = 'Queue is empty' if not len(get_queue(ctx.guild.id)) else str(e)
+        if not mute_response:
+            await ctx.reply(message, ephemeral=True)
+        return ReturnData(False, message)
+
+    message = f'Removed `{entry.title or entry.url}` from queue'
+    if not mute_response:
+        await ctx.reply(message, ephemeral=True)
+    return ReturnData(True, message)
+
+async def queue_def(ctx, bot_class, mute_response: bool = False) -> ReturnData:
+    """
+    Shows the guild queue
+    :param ctx: Context
+    :param bot_class: Bot class
+    :param mute_response: Should bot response be muted
+    :return: ReturnData
+    """
+    log(ctx, 'queue_def', options=locals(), log_type='function', author=ctx.author)
+
+    queue = get_queue(ctx.guild.id)
+
+    embed = discord.Embed(title="Queue", description=f"{len(queue)} tracks in queue")
+
+    if queue.current is not None:
+        current = queue.current
+        embed.add_field(name="**Now Playing**", value=f'`{current.title or current.url}` ({convert_duration(current.duration)})', inline=False)
+
+    message = ''
+    for position, entry in enumerate(queue.entries, start=1):
+        if isinstance(entry, QueuePlaylist):
+            add = f'`{position}.` {entry.title or entry.url} *(playlist, more tracks loading)*\n'
+        else:
+            add = f'`{position}.` {entry.title or entry.url}\n'
+        if len(message + add) > 1024:
+            break
+        message = message + add
+
+    if message:
+        embed.add_field(name="**Up Next**", value=message, inline=False)
+
+    if not mute_response:
+        await ctx.reply(embed=embed, ephemeral=True)
+    return ReturnData(True, f'{len(queue)} tracks in queue')
@@ -1,7 +1,10 @@
 from classes.data_classes import ReturnData
 
 from utils.log import log
-from utils.discord import get_voice_client
+from utils.discord import voice_member_count
+from utils.sessions import voice_sessions
+from utils.queue import get_queue
+from utils.reaper import idle_reaper
 
 from discord.ext import commands as dc_commands
 import discord
@@ -18,15 +21,19 @@ async def stop_def(ctx, bot_class, mute_response: bool = False) -> ReturnData:
     """
     log(ctx, 'stop_def', options=locals(), log_type='function', author=ctx.author)
 
-    voice: discord.voice_client.VoiceClient = get_voice_client(bot_class.voice_clients, guild=ctx.guild)
+    session = voice_sessions.get(ctx.guild.id)
 
-    if not voice:
+    if not session:
         message = "Bot is not connected to a voice channel"
         if not mute_response:
             await ctx.reply(message, ephemeral=True)
         return ReturnData(False, message)
 
-    voice.stop()
+    # clear the queue first, so the 'after' callback does not start the next track
+    get_queue(ctx.guild.id).clear()
+    session.voice_client.stop()
+    session.stopped()
+    idle_reaper.touch(ctx.guild.id)
 
     message = "Player **stopped!**"
     if not mute_response:
@@ -43,16 +50,19 @@ async def pause_def(ctx, bot_class, mute_response: bool = False) -> ReturnData:
     """
     log(ctx, 'pause_def', options=locals(), log_type='function', author=ctx.author)
 
-    voice: discord.voice_client.VoiceClient = get_voice_client(bot_class.voice_clients, guild=ctx.guild)
+    session = voice_sessions.get(ctx.guild.id)
 
-    if not voice:
+    if not session:
         message = "Bot is not connected to a voice channel"
         if not mute_response:
             await ctx.reply(message, ephemeral=True)
         return ReturnData(False, message)
 
+    voice = session.voice_client
     if voice.is_playing():
         voice.pause()
+        session.paused()
+        idle_reaper.touch(ctx.guild.id)
         message = "Player **paused!**"
         if not mute_response:
             await ctx.reply(message, ephemeral=True)
@@ -79,16 +89,19 @@ async def resume_def(ctx, bot_class, mute_response: bool = False) -> ReturnData:
     """
     log(ctx, 'resume_def', options=locals(), log_type='function', author=ctx.author)
 
-    voice: discord.voice_client.VoiceClient = get_voice_client(bot_class.voice_clients, guild=ctx.guild)
+    session = voice_sessions.get(ctx.guild.id)
 
-    if not voice:
+    if not session:
         message = "Bot is not connected to a voice channel"
         if not mute_response:
             await ctx.reply(message, ephemeral=True)
         return ReturnData(False, message)
 
+    voice = session.voice_client
     if voice.is_paused():
         voice.resume()
+        session.resumed()
+        idle_reaper.touch(ctx.guild.id)
         message = "Player **resumed!**"
         if not mute_response:
             await ctx.reply(message, ephemeral=True)
@@ -124,9 +137,10 @@ async def join_def(ctx, bot_class, channel_id=None, mute_response: bool = False)
             # get author voice channel
             author_channel = ctx.author.voice.channel
 
-            if ctx.voice_client:
+            voice = voice_sessions.voice(ctx.guild.id)
+            if voice:
                 # if bot is already connected to author channel return True
-                if ctx.voice_client.channel == author_channel:
+                if voice.channel == author_channel:
                     message = "I'm already in this channel"
                     if not mute_response:
                         await ctx.reply(message, ephemeral=True)
@@ -157,16 +171,17 @@ async def join_def(ctx, bot_class, channel_id=None, mute_response: bool = False)
             return ReturnData(False, message)
 
         # check if the channel is empty
-        if not len(voice_channel.members) > 0:
+        if not voice_member_count(voice_channel) > 0:
             message = "The channel is empty"
             await ctx.reply(message, ephemeral=True)
             return ReturnData(False, message)
 
         # disconnect from voice channel if connected
-        if ctx.guild.voice_client:
-            await ctx.guild.voice_client.disconnect(force=True)
+        previous = voice_sessions.unregister(ctx.guild.id)
+        if previous:
+            await previous.voice_client.disconnect(force=True)
         # connect to voice channel
-        await voice_channel.connect()
+        voice_sessions.register(ctx.guild.id, await voice_channel.connect())
         # deafen bot
         await ctx.guild.change_voice_state(channel=voice_channel, self_deaf=True)
 
@@ -196,11 +211,13 @@ async def disconnect_def(ctx, bot_class, mute_response: bool = False) -> ReturnD
     """
     log(ctx, 'disconnect_def', options=locals(), log_type='function', author=ctx.author)
 
-    if ctx.guild.voice_client:
+    session = voice_sessions.get(ctx.guild.id)
+    if session:
         await stop_def(ctx, bot_class, mute_response=True)
 
-        channel = ctx.guild.voice_client.channel
-        await ctx.guild.voice_client.disconnect(force=True)
+        channel = session.voice_client.channel
+        await session.voice_client.disconnect(force=True)
+        voice_sessions.unregister(ctx.guild.id)
 
         message = f"Left voice channel: `{channel}`"
         if not mute_response:
@@ -0,0 +1,133 @@
+"""
+Runs the bot as several processes (clusters), each owning a contiguous range of shards
+
+python launcher.py --clusters 4                 # shard count recommended by Discord
+python launcher.py --clusters 4 --shards 16
+
+Cluster 0 is the primary one: it syncs the command tree and sends admin notifications,
+the other clusters forward their notifications to it. A cluster that exits is restarted with a backoff.
+"""
+from __future__ import annotations
+
+from time import monotonic, sleep
+import multiprocessing
+import urllib.request
+import argparse
+import signal
+import json
+import sys
+import os
+
+import config
+
+STARTUP_STAGGER = 5  # seconds between starts of the clusters (identify is rate limited)
+RESTART_DELAY = 5  # seconds before the first restart of a crashed cluster
+RESTART_MAX_DELAY = 300  # seconds
+RESTART_RESET_AFTER = 600  # seconds of uptime after which the backoff is reset
+
+def recommended_shards(token: str) -> int:
+    """
+    Returns shard count recommended by Discord (GET /gateway/bot)
+    :param token: str - bot token
+    :return: int
+    """
+    request = urllib.request.Request('https://discord.com/api/v10/gateway/bot', headers={
+        'Authorization': f'Bot {token}',
+        'User-Agent': 'DiscordBot (https://github.com/Tomer27cz/stanislav_the_1st, 1.0)',
+    })
+    with urllib.request.urlopen(request, timeout=10) as response:
+        return int(json.load(response)['shards'])
+
+def run_cluster(cluster_id: int, cluster_count: int, shard_ids: list[int], shard_count: int, admin_queue) -> None:
+    """
+    Entry point of a cluster process
+    """
+    # read by utils.cluster on import, so they are set before the bot is imported
+    os.environ['CLUSTER_ID'] = str(cluster_id)
+    os.environ['CLUSTER_COUNT'] = str(cluster_count)
+    os.environ['SHARD_COUNT'] = str(shard_count)
+    os.environ['SHARD_IDS'] = ','.join(map(str, shard_ids))
+
+    import utils.cluster
+    utils.cluster.admin_queue = admin_queue
+
+    import main
+    main.bot.run(config.BOT_TOKEN)
+
+class Cluster:
+    def __init__(self, cluster_id: int, shard_ids: list[int]):
+        self.cluster_id = cluster_id
+        self.shard_ids = shard_ids
+        self.process: multiprocessing.Process or None = None
+        self.started = 0.0
+        self.delay = RESTART_DELAY
+        self.restart_at: float or None = None
+
+def main(argv: list[str]=None) -> int:
+    parser = argparse.ArgumentParser(description='Runs the bot as several sharded processes')
+    parser.add_argument('--clusters', type=int, default=getattr(config, 'CLUSTER_COUNT', 2), help='number of processes')
+    parser.add_argument('--shards', type=int, default=getattr(config, 'SHARD_COUNT', None), help='total number of shards (default: recommended by Discord)')
+    args = parser.parse_args(argv)
+
+    shard_count = args.shards or recommended_shards(config.BOT_TOKEN)
+    # every cluster needs at least one shard
+    shard_count = max(shard_count, args.clusters)
+
+    # imported here, the module is imported again (without running main) in every spawned process
+    from utils.cluster import shard_ranges
+    context = multiprocessing.get_context('spawn')
+    admin_queue = context.Queue()
+
+    clusters = [Cluster(cluster_id, shard_ids) for cluster_id, shard_ids in enumerate(shard_ranges(shard_count, args.clusters))]
+
+    def start(cluster: Cluster) -> None:
+        cluster.process = context.Process(target=run_cluster, name=f'cluster-{cluster.cluster_id}',
+                                          args=(cluster.cluster_id, args.clusters, cluster.shard_ids, shard_count, admin_queue))
+        cluster.process.start()
+        cluster.started = monotonic()
+        cluster.restart_at = None
+        print(f'Cluster {cluster.cluster_id} started (pid {cluster.process.pid}, shards {cluster.shard_ids[0]}-{cluster.shard_ids[-1]} of {shard_count})', flush=True)
+
+    stopping = False
+
+    def stop(signum, frame) -> None:
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    for cluster in clusters:
+        start(cluster)
+        sleep(STARTUP_STAGGER)
+
+    while not stopping:
+        for cluster in clusters:
+            if cluster.process.is_alive():
+                continue
+
+            if cluster.restart_at is None:
+                if monotonic() - cluster.started > RESTART_RESET_AFTER:
+                    cluster.delay = RESTART_DELAY
+                cluster.restart_at = monotonic() + cluster.delay
+                print(f'Cluster {cluster.cluster_id} exited with code {cluster.process.exitcode}, restarting in {cluster.delay}s', flush=True)
+                cluster.delay = min(cluster.delay * 2, RESTART_MAX_DELAY)
+
+            elif monotonic() >= cluster.restart_at:
+                start(cluster)
+        sleep(1)
+
+    for cluster in clusters:
+        if cluster.process is not None and cluster.process.is_alive():
+            cluster.process.terminate()
+    # the clusters close the bot on SIGTERM (see Bot.setup_hook), a cluster that does not exit in time is killed
+    for cluster in clusters:
+        if cluster.process is not None:
+            cluster.process.join(timeout=30)
+            if cluster.process.is_alive():
+                print(f'Cluster {cluster.cluster_id} did not stop in time, killing it', flush=True)
+                cluster.process.kill()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,44 +1,145 @@
-from utils.log import send_to_admin
+from time import monotonic
+import_started = monotonic()
+
+from utils.log import send_to_admin, stop_logging, data_sink, relay_admin_messages
+from utils.cluster import SHARDED, SHARD_COUNT, SHARD_IDS, PRIMARY_CLUSTER, CLUSTER_ID, CLUSTER_COUNT, cluster_paths
+from utils.http import close_session
+from utils.extractor import extraction_engine
+from utils.audio_cache import audio_cache
+from utils.reaper import idle_reaper
+from utils.radio import radio_catalogue
+from utils.bot import command_catalogue, sync_tree
+from utils.discord import gateway_options, voice_member_count
+from utils.sessions import voice_sessions
 
 from commands.general import *
 from commands.player import *
 from commands.voice import *
+from commands.queue import *
 
 from discord.ext import commands as dc_commands
 from discord import app_commands
 
+from utils.log_archive import search_logs, parse_line, parse_time
+from utils.tracing import trace_percentiles, StartupTimer
+from utils.metrics import metrics_server, register_bot_metrics, command_total, command_duration, METRICS_ENABLED
+
+from io import BytesIO
+from time import time
 import discord.ext.commands
 import asyncio
+import signal
 
 import config
 
+startup_timer = StartupTimer(import_started)
+startup_timer.mark('imports')
+
 my_id = config.OWNER_ID
 bot_id = config.CLIENT_ID
 prefix = config.PREFIX
 d_id = 349164237605568513
 
+def is_owner(ctx: dc_commands.Context) -> bool:
+    return ctx.author.id == my_id
+
 # ---------------- Bot class ------------
 
-class Bot(dc_commands.Bot):
+class Bot(dc_commands.AutoShardedBot if SHARDED else dc_commands.Bot):
     """
     Bot class
 
     This class is used to create the bot instance.
+    With SHARDED (or when started by launcher.py) it is an AutoShardedBot running SHARD_IDS of SHARD_COUNT shards.
     """
 
     def __init__(self):
-        intents = discord.Intents.all()
-        super().__init__(command_prefix=prefix, intents=intents)
+        shard_options = {'shard_count': SHARD_COUNT, 'shard_ids': SHARD_IDS} if SHARDED else {}
+        super().__init__(command_prefix=prefix, **gateway_options(), **shard_options)
         self.synced = False
+        self._relay_task: asyncio.Task or None = None
+        self._warm_up_task: asyncio.Task or None = None
+        self._shutdown_task: asyncio.Task or None = None
 
     async def on_ready(self):
         await self.wait_until_ready()
-        if not self.synced:
-            log(None, "Trying to sync commands")
-            await self.tree.sync()
-            log(None, f"Synced slash commands for {self.user}")
+        if not startup_timer.reported:
+            startup_timer.mark('gateway')
+        if not self.synced and PRIMARY_CLUSTER:
+            # the tree is global, one process syncs it for all clusters
+            await sync_tree(self)
+            self.synced = True
+        command_catalogue.ensure(self)
+        if not startup_timer.reported:
+            startup_timer.mark('sync')
         await bot.change_presence(activity=discord.Game(name=f"/help"))
         log(None, f'Logged in as:\n{bot.user.name}\n{bot.user.id}')
+        if self._warm_up_task is None:
+            self._warm_up_task = asyncio.create_task(self.warm_up())
+        if SHARDED:
+            log(None, f'Cluster {CLUSTER_ID + 1}/{CLUSTER_COUNT} running shards {sorted(self.shards)} of {self.shard_count}')
+
+    async def warm_up(self):
+        # runs after on_ready, so it does not delay the gateway connection
+        try:
+            await extraction_engine.warm_up()
+        except Exception as e:
+            log(None, 'Extractor warm-up failed', options={'error': e}, log_type='error')
+        startup_timer.mark('warm-up')
+        startup_timer.report()
+
+    def add_command(self, command, /) -> None:
+        super().add_command(command)
+        command_catalogue.invalidate()
+
+    def remove_command(self, name: str, /):
+        command = super().remove_command(name)
+        command_catalogue.invalidate()
+        return command
+
+    async def setup_hook(self):
+        startup_timer.mark('login')
+        try:
+            # launcher.py stops the clusters with SIGTERM, close the bot so the logs and collected data are written
+            self.loop.add_signal_handler(signal.SIGTERM, lambda: asyncio.ensure_future(self.close()))
+        except (NotImplementedError, RuntimeError):
+            # not supported on Windows
+            pass
+        idle_reaper.start(self)
+        radio_catalogue.start()
+        data_sink.start()
+
+        if PRIMARY_CLUSTER and CLUSTER_COUNT > 1:
+            self._relay_task = asyncio.create_task(relay_admin_messages(self))
+
+        if METRICS_ENABLED:
+            register_bot_metrics(self)
+            await metrics_server.start()
+            log(None, f"Metrics served on http://{metrics_server.host}:{metrics_server.port}/metrics")
+
+        startup_timer.mark('setup')
+
+    async def close(self):
+        # called again when bot.run exits after a SIGTERM, every call waits for the one shutdown
+        if self._shutdown_task is None:
+            self._shutdown_task = asyncio.ensure_future(self._shutdown())
+        await self._shutdown_task
+
+    async def _shutdown(self):
+        if self._relay_task is not None:
+            self._relay_task.cancel()
+        if self._warm_up_task is not None:
+            self._warm_up_task.cancel()
+        idle_reaper.stop()
+        radio_catalogue.stop()
+        await metrics_server.stop()
+        await close_session()
+        extraction_engine.shutdown()
+        audio_cache.close()
+        log(None, "Closed HTTP session and extraction pool")
+        await super().close()
+        await data_sink.stop()
+        stop_logging()
 
     async def on_guild_join(self, guild_object):
         # log
@@ -69,45 +170,27 @@ class Bot(dc_commands.Bot):
         await send_to_admin(self, log_msg)
 
     async def on_voice_state_update(self, member, before, after):
-        voice_state = member.guild.voice_client
         guild_id = member.guild.id
 
-        if voice_state is not None and len(voice_state.channel.members) == 1:
-            voice_state.stop()
-            await voice_state.disconnect()
-            log(guild_id, "-->> Disconnecting when last person left <<--")
-
-        if not member.id == self.user.id:
-            return
-
-        elif before.channel is None:
-            # get voice client
-            voice = after.channel.guild.voice_client
-
-            # initialize loop
-            time_var = 0
-            while True:
-                # check every second
-                await asyncio.sleep(5)
-
-                # increase time_var
-                time_var += 5
-
-                # check if bot is playing and not paused
-                if voice.is_playing() and not voice.is_paused():
-                    time_var = 0  # reset time_var
-
-                # check if time_var is greater than buffer
-                if time_var >= 30:
-                    # stop playing and disconnect
-                    voice.stop()
-                    await voice.disconnect()
-
-                    log(guild_id, "-->> Disconnecting after 30 seconds of inactivity <<--")
+        if member.id == self.user.id:
+            if after.channel is None:
+                voice_sessions.unregister(guild_id)
+                idle_reaper.forget(guild_id)
+                return
 
-                # check if bot is disconnected
-                if not voice.is_connected():
-                    break  # break loop
+            if member.guild.voice_client is not None:
+                voice_sessions.register(guild_id, member.guild.voice_client)
+            if before.channel is None:
+                # bot joined, start counting inactivity
+                idle_reaper.touch(guild_id)
+
+        session = voice_sessions.get(guild_id)
+        if session is not None and voice_member_count(session.voice_client.channel) == 1:
+            get_queue(guild_id).clear()
+            session.voice_client.stop()
+            await session.voice_client.disconnect()
+            voice_sessions.unregister(guild_id)
+            log(guild_id, "-->> Disconnecting when last person left <<--")
 
     async def on_command_error(self, ctx, error):
         # get error traceback
@@ -153,7 +236,7 @@ class Bot(dc_commands.Bot):
         log(ctx, err_msg, log_type='error', author=ctx.author)
 
         await send_to_admin(self, err_msg, file=True)
-        await ctx.reply(f"{error}   {bot.get_user(config.DEVELOPER_ID).mention}", ephemeral=True)
+        await ctx.reply(f"{error}   <@{config.DEVELOPER_ID}>", ephemeral=True)
 
     async def on_message(self, message):
         # on every message
@@ -189,6 +272,18 @@ bot = Bot()
 
 log(None, 'Discord API initialized')
 
+@bot.before_invoke
+async def before_command(ctx: dc_commands.Context):
+    ctx.started_at = monotonic()
+
+@bot.after_invoke
+async def after_command(ctx: dc_commands.Context):
+    name = ctx.command.qualified_name if ctx.command else 'unknown'
+    command_total.inc(command=name, status='error' if ctx.command_failed else 'ok')
+    started_at = getattr(ctx, 'started_at', None)
+    if started_at is not None:
+        command_duration.observe(monotonic() - started_at, command=name)
+
 # --------------------------------------- COMMANDS --------------------------------------------------
 
 @bot.hybrid_command(name='play', with_app_command=True, description="Play a YouTube Song", help="Play a YouTube Song", extras={'category': 'player'})
@@ -197,6 +292,22 @@ async def play(ctx: dc_commands.Context, url: str):
     log(ctx, 'play', options=locals(), log_type='command', author=ctx.author)
     await play_def(ctx, bot, url)
 
+@bot.hybrid_command(name='skip', with_app_command=True, description="Skip the current song", help="Skip the current song", extras={'category': 'player'})
+async def skip(ctx: dc_commands.Context):
+    log(ctx, 'skip', options=locals(), log_type='command', author=ctx.author)
+    await skip_def(ctx, bot)
+
+@bot.hybrid_command(name='queue', with_app_command=True, description="Show the queue", help="Show the queue", extras={'category': 'player'})
+async def queue_command(ctx: dc_commands.Context):
+    log(ctx, 'queue', options=locals(), log_type='command', author=ctx.author)
+    await queue_def(ctx, bot)
+
+@bot.hybrid_command(name='remove', with_app_command=True, description="Remove a song from the queue", help="Remove a song from the queue", extras={'category': 'player'})
+@app_commands.describe(position="Position of the song in the queue")
+async def remove(ctx: dc_commands.Context, position: int):
+    log(ctx, 'remove', options=locals(), log_type='command', author=ctx.author)
+    await remove_def(ctx, bot, position)
+
 @bot.hybrid_command(name='stop', with_app_command=True, description="Stop the current song", help="Stop the current song", extras={'category': 'voice'})
 async def stop(ctx: dc_commands.Context):
     log(ctx, 'stop', options=locals(), log_type='command', author=ctx.author)
@@ -229,61 +340,81 @@ async def ping_command(ctx: dc_commands.Context):
     await ping_def(ctx, bot)
 
 
-# --------------------------------------------- HELP COMMAND -----------------------------------------------------------
+# --------------------------------------------- OWNER COMMANDS ---------------------------------------------------------
 
-bot.remove_command('help')
+@bot.hybrid_command(name='logs', with_app_command=True, description="Search the logs", help="Search the logs", extras={'category': 'owner'}, hidden=True)
+@app_commands.describe(guild_id="Guild ID to search for", hours="How many hours back to search (before end)", log_type="Type of log (CMD, FUNC, ERR, WRN, TXT)", limit="Max number of lines",
+                       start="Start of the window (DD/MM/YYYY HH:MM:SS), overrides hours", end="End of the window (DD/MM/YYYY HH:MM:SS), default now")
+@dc_commands.check(is_owner)
+async def logs_command(ctx: dc_commands.Context, guild_id: str = None, hours: int = 24, log_type: str = None, limit: int = 200, start: str = None, end: str = None):
+    log(ctx, 'logs', options=locals(), log_type='command', author=ctx.author)
+    await ctx.defer(ephemeral=True)
 
-@bot.hybrid_command(name='help', with_app_command=True, description="Get help on a command", help="Get help on a command", extras={'category': 'general'})
-async def help_command(ctx: dc_commands.Context, command_name: str = None):
-    log(ctx, 'help', options=locals(), log_type='command', author=ctx.author)
-    gi = ctx.guild.id
+    try:
+        until = parse_time(end) if end else None
+        since = parse_time(start) if start else (until or time()) - hours * 3600
+    except ValueError as e:
+        await ctx.reply(str(e), ephemeral=True)
+        return
 
-    embed = discord.Embed(title="Commands", description=f"Use `/help <command>` to get help on a command | Prefix: `{prefix}`")
+    lines, searched = [], 0
+    for path in cluster_paths('log.log'):
+        # every cluster process writes its own log, all of them are searched
+        cluster_lines, cluster_searched = await asyncio.to_thread(search_logs, path, guild_id, since, until, log_type, limit)
+        lines.extend(cluster_lines)
+        searched += cluster_searched
+    if CLUSTER_COUNT > 1:
+        lines.sort(key=lambda line: parse_line(line)[0] or 0)
+        lines = lines[-limit:]
+
+    if not lines:
+        await ctx.reply(f'No matching lines ({searched} files searched)', ephemeral=True)
+        return
 
-    command_dict = {}
-    command_name_dict = {}
-    for command in bot.commands:
-        if command.hidden:
-            continue
+    file = discord.File(BytesIO('\n'.join(lines).encode()), filename='logs.txt')
+    await ctx.reply(f'{len(lines)} matching lines ({searched} files searched)', file=file, ephemeral=True)
 
-        command_name_dict[command.name] = command
+@bot.hybrid_command(name='traces', with_app_command=True, description="Time to first audio by phase", help="Time to first audio by phase (p50 / p90 / p99)", extras={'category': 'owner'}, hidden=True)
+@dc_commands.check(is_owner)
+async def traces_command(ctx: dc_commands.Context):
+    log(ctx, 'traces', options=locals(), log_type='command', author=ctx.author)
 
-        category = command.extras.get('category', 'No category')
-        if category not in command_dict:
-            command_dict[category] = []
+    percentiles = trace_percentiles()
+    if not percentiles:
+        await ctx.reply('No finished traces yet', ephemeral=True)
+        return
 
-        command_dict[category].append(command)
+    embed = discord.Embed(title="Time to first audio", description="p50 / p90 / p99 in ms (count)")
+    for kind, phases in percentiles.items():
+        message = ''
+        for phase, stats in phases.items():
+            message += f"`{phase}` {stats['p50'] * 1000:.0f} / {stats['p90'] * 1000:.0f} / {stats['p99'] * 1000:.0f} ({stats['count']})\n"
+        embed.add_field(name=f'**{kind}**', value=message[:1024], inline=False)
 
-    if not command_name:
-        for category in command_dict.keys():
-            message = ''
+    await ctx.reply(embed=embed, ephemeral=True)
 
-            for command in command_dict[category]:
-                add = f'`{command.name}` - {command.description} \n'
+@bot.hybrid_command(name='sync', with_app_command=True, description="Sync the command tree", help="Sync the command tree even if it did not change", extras={'category': 'owner'}, hidden=True)
+@dc_commands.check(is_owner)
+async def sync_command(ctx: dc_commands.Context):
+    log(ctx, 'sync', options=locals(), log_type='command', author=ctx.author)
+    await ctx.defer(ephemeral=True)
 
-                if len(message + add) > 1024:
-                    embed.add_field(name=f"**{category.capitalize()}**", value=message, inline=False)
-                    message = ''
-                    continue
+    await sync_tree(bot, force=True)
+    await ctx.reply(f'Synced {len(bot.tree.get_commands())} commands', ephemeral=True)
 
-                message = message + add
+# --------------------------------------------- HELP COMMAND -----------------------------------------------------------
 
-            embed.add_field(name=f"**{category.capitalize()}**", value=message, inline=False)
+bot.remove_command('help')
 
-        await ctx.send(embed=embed)
-        return
+@bot.hybrid_command(name='help', with_app_command=True, description="Get help on a command", help="Get help on a command", extras={'category': 'general'})
+async def help_command(ctx: dc_commands.Context, command_name: str = None):
+    log(ctx, 'help', options=locals(), log_type='command', author=ctx.author)
 
-    if command_name not in command_name_dict:
+    embed = command_catalogue.help_embed(bot, command_name)
+    if embed is None:
         await ctx.send('Command not found')
         return
 
-    command = command_name_dict[command_name]
-
-    embed = discord.Embed(title=command.name, description=command.description)
-    # noinspection PyProtectedMember
-    for key, value in command.app_command._params.items():
-        embed.add_field(name=f"`{key}` - {value.description}", value=f'Required": `{value.required}` | Default: `{value.default}` | Type: `{value.type}`', inline=False)
-
     await ctx.send(embed=embed)
 
 # --------------------------------------------------- APP --------------------------------------------------------------
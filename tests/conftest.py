@@ -0,0 +1,27 @@
+import tempfile
+import types
+import sys
+import os
+
+import pytest
+
+# config.py holds the secrets of a deployment and is not in the repository,
+# the modules under test only need OWNER_ID, every other setting has a default
+try:
+    import config
+except ImportError:
+    config = types.ModuleType('config')
+    config.OWNER_ID = 0
+    sys.modules['config'] = config
+
+def pytest_sessionstart(session):
+    # the bot writes log.log and db/ relative to the working directory (before the test modules are imported)
+    os.chdir(tempfile.mkdtemp(prefix='bot_tests_'))
+
+@pytest.fixture(autouse=True, scope='session')
+def flush_data_log():
+    yield
+    # written into the test directory, not by the atexit hook after pytest went back to the repository
+    log = sys.modules.get('utils.log')
+    if log is not None:
+        log.data_sink.flush()
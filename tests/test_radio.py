@@ -0,0 +1,252 @@
+"""
+utils.radio and the radio branch of /play against a local stand-in of the radio.garden, TuneIn and radia.cz APIs
+
+The stand-in serves the shapes of classes/typed_dictionaries.py. The radia.cz station list is converted
+from XML, so it is wrapped in {'radios': {'radio': [...]}} and a single stream is not wrapped in a list.
+"""
+from collections import Counter
+from types import SimpleNamespace
+import asyncio
+
+import pytest
+from aiohttp import web
+
+import utils.radio as radio
+from utils.http import close_session
+
+GARDEN = {
+    'vbFsCngB': {'id': 'vbFsCngB', 'title': 'KUTX FM 98.9', 'url': '/listen/kutx-98-9/vbFsCngB', 'website': 'http://www.kutx.org', 'secure': True,
+                 'place': {'id': 'Aq7xeIiB', 'title': 'Austin TX'}, 'country': {'id': 'GhDXw4EW', 'title': 'United States'}},
+}
+
+TUNEIN = {
+    's15666': {
+        'describe': {'element': 'station', 'guide_id': 's15666', 'preset_id': 's15666', 'name': 'Evropa 2', 'call_sign': 'Evropa 2', 'url': 'http://www.evropa2.cz/',
+                     'logo': 'https://cdn-radiotime-logos.tunein.com/s15666q.png', 'current_song': 'Legends Never Die', 'current_artist': 'Bad Wolves',
+                     'tunein_url': 'http://tunein.com/station/?stationId=15666', 'is_available': True},
+        'tune': [{'element': 'audio', 'url': 'http://example.com/evropa2.pls', 'bitrate': 128, 'media_type': 'mp3', 'is_direct': False},
+                 {'element': 'audio', 'url': 'http://example.com/evropa2-64.aac', 'bitrate': 64, 'media_type': 'aac', 'is_direct': True},
+                 {'element': 'audio', 'url': 'http://example.com/evropa2-128.mp3', 'bitrate': 128, 'media_type': 'mp3', 'is_direct': True}],
+    },
+}
+
+RADIA_CZ = {'radios': {'radio': [
+    {'@u': '2024-02-29 19:46:53', 'id': '94', 'name': 'Hitrádio Faktor', 'logoSvg': 'https://radia.cz/data/station_logo_svg/0001/02/faktor.svg',
+     'logo': 'https://radia.cz/data/station_logo/0001/02/faktor.png', 'link': 'https://radia.cz/radio-hitradio-faktor',
+     'nowplay': 'https://cdb.radia.cz/content/nowplay/v2/hitradio-faktor.xml', 'playlist': 'https://cdb.radia.cz/content/playlist/v2/hitradio-faktor.xml', 'program': None,
+     'streams': {'stream': [
+         {'id': '2630', 'name': 'Hitrádio Faktor aac 64kb', 'type': 'aac', 'bitrate': '64', 'forAndroid': '1', 'forApple': '1', 'forBrowser': '1',
+          'url': 'https://ice.radia.cz/faktor64.aac', 'defWifi': '0', 'def3g': '1'},
+         {'id': '2628', 'name': 'Hitrádio Faktor mp3 128kb', 'type': 'mp3', 'bitrate': '128', 'forAndroid': '1', 'forApple': '1', 'forBrowser': '1',
+          'url': 'https://ice.radia.cz/faktor128.mp3', 'defWifi': '1', 'def3g': '0'},
+         {'id': '2619', 'name': 'Hitrádio Faktor mp3 64kb', 'type': 'mp3', 'bitrate': '64', 'forAndroid': '1', 'forApple': '1', 'forBrowser': '1',
+          'url': 'https://ice.radia.cz/faktor64.mp3', 'defWifi': '0', 'def3g': '1'}]}},
+    {'@u': '2024-02-29 19:46:53', 'id': '12', 'name': 'Radio Beat', 'link': 'https://radia.cz/radio-beat', 'nowplay': None, 'program': None,
+     'streams': {'stream': {'id': '100', 'name': 'Radio Beat mp3 128kb', 'type': 'mp3', 'bitrate': '128', 'url': 'https://ice.radia.cz/beat128.mp3', 'defWifi': '1', 'def3g': '1'}}},
+]}}
+
+INPUTS = {
+    ('RadioGarden', 'https://radio.garden/listen/kutx-98-9/vbFsCngB'): '/garden/ara/content/listen/vbFsCngB/channel.mp3',
+    ('RadioTuneIn', '_tunein:s15666'): 'http://example.com/evropa2-128.mp3',
+    ('RadioCz', '_radia_cz:94'): 'https://ice.radia.cz/faktor128.mp3',
+    ('RadioCz', '_radia_cz:12'): 'https://ice.radia.cz/beat128.mp3',
+}
+
+def stand_in(requests: Counter) -> web.Application:
+    async def garden_channel(request: web.Request) -> web.Response:
+        requests['garden'] += 1
+        channel = GARDEN.get(request.match_info['channel_id'])
+        if channel is None:
+            return web.json_response({'error': 'Not found'}, status=404)
+        return web.json_response({'apiVersion': 1, 'version': '9bd5454', 'data': channel})
+
+    def tunein(part: str):
+        async def handler(request: web.Request) -> web.Response:
+            requests[f'tunein_{part}'] += 1
+            station = TUNEIN.get(request.query.get('id'))
+            if station is None:
+                return web.json_response({'head': {'status': '400', 'fault': 'Invalid root category'}})
+            body = [station['describe']] if part == 'describe' else station['tune']
+            return web.json_response({'head': {'status': '200'}, 'body': body})
+        return handler
+
+    async def radia_cz(request: web.Request) -> web.Response:
+        requests['radia_cz'] += 1
+        return web.json_response(RADIA_CZ)
+
+    app = web.Application()
+    app.router.add_get('/garden/ara/content/channel/{channel_id}', garden_channel)
+    app.router.add_get('/tunein/Describe.ashx', tunein('describe'))
+    app.router.add_get('/tunein/Tune.ashx', tunein('tune'))
+    app.router.add_get('/radia_cz/radios.json', radia_cz)
+    return app
+
+@pytest.fixture
+def api(monkeypatch, tmp_path):
+    """
+    Runs a test coroutine with the stand-in and an empty catalogue in tmp_path
+    Yields (run, requests), run(coroutine function) returns its result
+    """
+    requests = Counter()
+
+    async def run_with_stand_in(test):
+        runner = web.AppRunner(stand_in(requests))
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        base = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+        monkeypatch.setattr(radio, 'RADIO_GARDEN_API', f'{base}/garden')
+        monkeypatch.setattr(radio, 'TUNEIN_API', f'{base}/tunein')
+        monkeypatch.setattr(radio, 'RADIA_CZ_RADIOS_URL', f'{base}/radia_cz/radios.json')
+        try:
+            return await test()
+        finally:
+            await close_session()
+            await runner.cleanup()
+
+    monkeypatch.setattr(radio, 'RADIO_CATALOGUE_REFRESH_DELAY', 0)
+    monkeypatch.setattr(radio, 'radio_catalogue', radio.RadioCatalogue(str(tmp_path / 'radio_catalogue.json')))
+    yield (lambda test: asyncio.run(run_with_stand_in(test))), requests
+
+def test_inputs_resolve_to_streams_with_one_request_each(api):
+    run, requests = api
+
+    async def test():
+        return await asyncio.gather(*(radio.get_station(url_type, url) for url_type, url in INPUTS))
+
+    stations = run(test)
+    for station, stream in zip(stations, INPUTS.values()):
+        assert station['stream'].endswith(stream)
+    assert [station['station_name'] for station in stations] == ['KUTX FM 98.9', 'Evropa 2', 'Hitrádio Faktor', 'Radio Beat']
+    # both radia.cz stations come from one station list
+    assert requests == Counter(garden=1, tunein_describe=1, tunein_tune=1, radia_cz=1)
+
+def test_repeat_lookups_and_restart_make_no_request(api):
+    run, requests = api
+
+    async def test():
+        for _ in range(3):
+            for url_type, url in INPUTS:
+                await radio.get_station(url_type, url)
+        before = sum(requests.values())
+
+        # restart, the stations are loaded from the file
+        radio.radio_catalogue = radio.RadioCatalogue(radio.radio_catalogue.path)
+        for url_type, url in INPUTS:
+            await radio.get_station(url_type, url)
+        return before
+
+    before = run(test)
+    assert before == 4
+    assert sum(requests.values()) == before
+    assert radio.radio_catalogue.misses == 0
+
+def test_clusters_share_the_catalogue_file(api):
+    run, requests = api
+
+    async def test():
+        path = radio.radio_catalogue.path
+        first, second = radio.RadioCatalogue(path), radio.RadioCatalogue(path)
+        await asyncio.gather(first.get('garden', 'vbFsCngB'), second.get('tunein', 's15666'))
+        # fetched by the other cluster, taken from the file
+        await first.get('tunein', 's15666')
+        await second.get('garden', 'vbFsCngB')
+        return sorted(radio.RadioCatalogue(path).stations)
+
+    assert run(test) == ['garden:vbFsCngB', 'tunein:s15666']
+    assert requests == Counter(garden=1, tunein_describe=1, tunein_tune=1)
+
+def test_refresh_fetches_stale_stations(api):
+    run, requests = api
+
+    async def test():
+        for url_type, url in INPUTS:
+            await radio.get_station(url_type, url)
+        assert await radio.radio_catalogue.refresh() == 0
+
+        radio.radio_catalogue.ttl = 0
+        return await radio.radio_catalogue.refresh()
+
+    # garden, tunein and one station list for both radia.cz stations
+    assert run(test) == 3
+    assert requests == Counter(garden=2, tunein_describe=2, tunein_tune=2, radia_cz=2)
+
+def test_unknown_stations(api):
+    run, requests = api
+
+    async def test():
+        errors = []
+        for url_type, url in [('RadioGarden', 'https://radio.garden/listen/nothing/XXXXXXXX'), ('RadioTuneIn', '_tunein:s0'),
+                              ('RadioCz', '_radia_cz:999999'), ('RadioCz', '_radia_cz:999998'), ('RadioGarden', 'https://radio.garden/visit/austin-tx/Aq7xeIiB')]:
+            with pytest.raises(radio.RadioError) as error:
+                await radio.get_station(url_type, url)
+            errors.append(str(error.value))
+        return errors
+
+    errors = run(test)
+    assert 'does not exist' in errors[0]
+    assert 'Invalid root category' in errors[1]
+    assert 'is not a radio.garden station' in errors[4]
+    # the second unknown radia.cz id is answered from the fresh station list
+    assert requests['radia_cz'] == 1
+
+class FakeVoice:
+    def is_connected(self):
+        return True
+
+    def is_playing(self):
+        return False
+
+    def is_paused(self):
+        return False
+
+def fake_ctx(guild_id: int):
+    replies = []
+
+    async def reply(message=None, **kwargs):
+        replies.append(message)
+
+    async def defer(**kwargs):
+        pass
+
+    interaction = SimpleNamespace(id=1, response=SimpleNamespace(is_done=lambda: True))
+    ctx = SimpleNamespace(guild=SimpleNamespace(id=guild_id), author=SimpleNamespace(voice=object()), interaction=interaction,
+                          message=None, reply=reply, defer=defer)
+    return ctx, replies
+
+def test_play_queues_the_catalogue_stream(api, monkeypatch):
+    import commands.player
+    import commands.queue
+    from classes.data_classes import ReturnData
+    from utils.sessions import voice_sessions
+    from utils.queue import get_queue
+
+    run, requests = api
+    guild_id = 4242
+
+    async def play_next(bot_class, guild):
+        return ReturnData(True, 'played')
+
+    monkeypatch.setattr(commands.queue, 'play_next', play_next)
+
+    async def test():
+        voice_sessions.register(guild_id, FakeVoice())
+        try:
+            ctx, replies = fake_ctx(guild_id)
+            response = await commands.player.play_def(ctx, None, '_radia_cz:94')
+            assert response.response
+            entry = get_queue(guild_id).entries[0]
+
+            missing = await commands.player.get_url(ctx, '_radia_cz:999999')
+            return entry, replies, missing
+        finally:
+            voice_sessions.unregister(guild_id)
+            get_queue(guild_id).clear()
+
+    entry, replies, missing = run(test)
+    # the stream is not extracted again
+    assert entry.data == {'url': 'https://ice.radia.cz/faktor128.mp3', 'title': 'Hitrádio Faktor', 'duration': None}
+    assert entry.title == 'Hitrádio Faktor'
+    assert replies == ['played']
+    assert not missing.response
+    assert requests == Counter(radia_cz=1)
@@ -0,0 +1,36 @@
+"""
+utils.url against its previous implementation (benchmarks/url_differential.py) on the benchmark corpus
+and on generated inputs, so a change of the classifier fails the tests and not only the benchmark
+"""
+import random
+
+import pytest
+
+from utils.url import classify_url, classify_url_uncached, URL_CACHE_MAX_LENGTH
+from benchmarks.url_differential import check, generate, reference_get_url_type
+from benchmarks.corpus import URLS
+
+GENERATED = 20000
+
+@pytest.mark.parametrize('string', URLS)
+def test_corpus_matches_reference(string):
+    assert check(string) == []
+
+def test_generated_inputs_match_reference():
+    rng = random.Random(0)
+    problems = []
+    for _ in range(GENERATED):
+        problems.extend(check(generate(rng)))
+    assert problems[:5] == []
+
+def test_classify_url_matches_reference_type():
+    for string in URLS:
+        info = classify_url(string)
+        assert (info.type, info.url) == reference_get_url_type(string)
+
+def test_memo_cache_does_not_change_results():
+    long_input = 'never gonna give you up ' * (URL_CACHE_MAX_LENGTH // 10) + 'https://www.youtube.com/watch?v=dQw4w9WgXcQ'
+    for string in [*URLS, long_input]:
+        # the second call is answered from the cache (inputs up to URL_CACHE_MAX_LENGTH characters)
+        assert classify_url(string) == classify_url_uncached(string)
+        assert classify_url(string) == classify_url_uncached(string)
@@ -0,0 +1,245 @@
+from __future__ import annotations
+from utils.log import log
+
+from collections import OrderedDict
+import asyncio
+import json
+import os
+
+import config
+
+AUDIO_CACHE_ENABLED = getattr(config, 'AUDIO_CACHE_ENABLED', False)
+AUDIO_CACHE_DIR = getattr(config, 'AUDIO_CACHE_DIR', 'db/cache/audio')
+AUDIO_CACHE_MAX_BYTES = getattr(config, 'AUDIO_CACHE_MAX_BYTES', 1024 ** 3)  # 1 GiB
+AUDIO_CACHE_MIN_PLAYS = getattr(config, 'AUDIO_CACHE_MIN_PLAYS', 2)  # plays before a track is cached
+AUDIO_CACHE_MAX_DURATION = 900  # seconds, longer tracks (and streams) are not cached
+AUDIO_CACHE_FILL_CONCURRENCY = 2  # max number of FFmpeg processes filling the cache
+AUDIO_CACHE_FILL_TIMEOUT = 600  # seconds
+AUDIO_CACHE_TRACKED_PLAYS = 4096  # max number of video ids whose plays are counted
+
+class AudioCache:
+    """
+    On-disk cache of popular tracks stored as Ogg/Opus files keyed by video id
+
+    Tracks are written in the background after they were played AUDIO_CACHE_MIN_PLAYS times.
+    Files are written to a temporary name and renamed, so a partial file is never served.
+    When the size budget is exceeded, the least recently played files are removed.
+    """
+    def __init__(self, directory: str=AUDIO_CACHE_DIR, max_bytes: int=AUDIO_CACHE_MAX_BYTES, min_plays: int=AUDIO_CACHE_MIN_PLAYS, enabled: bool=AUDIO_CACHE_ENABLED):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.min_plays = min_plays
+        self.enabled = enabled
+
+        self._index: OrderedDict[str, int] = OrderedDict()  # video id -> size in bytes (LRU order)
+        self._plays: OrderedDict[str, int] = OrderedDict()
+        self._filling: dict[str, asyncio.Task] = {}
+        self._semaphore: asyncio.Semaphore or None = None
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.fills = 0
+        self.evictions = 0
+
+        if self.enabled:
+            self._load()
+
+    def _path(self, video_id: str, ext: str='ogg') -> str:
+        return os.path.join(self.directory, f'{video_id}.{ext}')
+
+    def _load(self) -> None:
+        """
+        Builds the index from files on disk (oldest modification time first)
+        :return: None
+        """
+        os.makedirs(self.directory, exist_ok=True)
+
+        files = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith('.tmp'):
+                # leftover of an interrupted fill
+                os.remove(path)
+                continue
+            if not name.endswith('.ogg'):
+                continue
+            stat = os.stat(path)
+            files.append((stat.st_mtime, name[:-4], stat.st_size))
+
+        for _, video_id, size in sorted(files):
+            self._index[video_id] = size
+            self.size += size
+
+        self._remove_files(self._evict())
+
+    async def get(self, video_id: str) -> dict or None:
+        """
+        Returns info dict of the cached file or None
+        :param video_id: str
+        :return: dict or None
+        """
+        if not self.enabled:
+            return None
+
+        if video_id not in self._index:
+            self.misses += 1
+            return None
+
+        data = await asyncio.to_thread(self._open, video_id)
+        if data is None:
+            if video_id in self._index:
+                self.size -= self._index.pop(video_id)
+            self.misses += 1
+            return None
+
+        self._index.move_to_end(video_id)
+        self.hits += 1
+        return data
+
+    def _open(self, video_id: str) -> dict or None:
+        """
+        Marks the cached file as played and reads its metadata (runs on a worker thread)
+        :param video_id: str
+        :return: dict or None - None when the file is gone
+        """
+        path = self._path(video_id)
+        try:
+            os.utime(path)  # keeps the LRU order across restarts
+        except FileNotFoundError:
+            return None
+
+        data = {}
+        try:
+            with open(self._path(video_id, 'json'), encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+        data.update({'id': video_id, 'url': path, 'acodec': 'opus', 'local': True})
+        return data
+
+    def record_play(self, video_id: str, data: dict) -> None:
+        """
+        Counts a play of video_id (called when playback starts) and starts filling the cache when it is popular enough
+        :param video_id: str
+        :param data: dict - resolved info dict (with a remote 'url')
+        :return: None
+        """
+        if not self.enabled or video_id in self._index or video_id in self._filling:
+            return
+
+        duration = data.get('duration')
+        if not duration or duration > AUDIO_CACHE_MAX_DURATION:
+            return
+
+        plays = self._plays.pop(video_id, 0) + 1
+        self._plays[video_id] = plays
+        while len(self._plays) > AUDIO_CACHE_TRACKED_PLAYS:
+            self._plays.popitem(last=False)
+
+        if plays < self.min_plays:
+            return
+
+        task = asyncio.ensure_future(self._fill(video_id, data))
+        self._filling[video_id] = task
+        task.add_done_callback(lambda _task: self._done_fill(video_id, _task))
+
+    def _done_fill(self, video_id: str, task: asyncio.Task) -> None:
+        self._filling.pop(video_id, None)
+        if task.cancelled():
+            return
+        error = task.exception()
+        if error is not None:
+            log(None, 'Audio cache fill failed', options={'video_id': video_id, 'error': error}, log_type='warning')
+
+    async def _fill(self, video_id: str, data: dict) -> None:
+        """
+        Downloads and transcodes data['url'] to an Ogg/Opus file
+        :param video_id: str
+        :param data: dict - resolved info dict
+        :return: None
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(AUDIO_CACHE_FILL_CONCURRENCY)
+
+        path = self._path(video_id)
+        tmp_path = path + '.tmp'
+        codec = ['-c:a', 'copy'] if data.get('acodec') == 'opus' else ['-c:a', 'libopus', '-b:a', '128k']
+        args = ['-v', 'error', '-y', '-reconnect', '1', '-reconnect_streamed', '1', '-reconnect_delay_max', '5',
+                '-i', data['url'], '-vn', *codec, '-f', 'ogg', tmp_path]
+
+        async with self._semaphore:
+            process = await asyncio.create_subprocess_exec('ffmpeg', *args, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+            try:
+                _, stderr = await asyncio.wait_for(process.communicate(), timeout=AUDIO_CACHE_FILL_TIMEOUT)
+            except (asyncio.TimeoutError, asyncio.CancelledError):
+                if process.returncode is None:
+                    process.kill()
+                    await process.wait()
+                self._remove(tmp_path)
+                raise
+
+        if process.returncode != 0:
+            await asyncio.to_thread(self._remove, tmp_path)
+            log(None, 'Audio cache fill failed', options={'video_id': video_id, 'stderr': stderr.decode(errors='replace')[-500:]}, log_type='warning')
+            return
+
+        metadata = {key: data[key] for key in ('title', 'duration') if key in data}
+        size = await asyncio.to_thread(self._store, video_id, tmp_path, metadata)
+        self._index[video_id] = size
+        self.size += size
+        self._plays.pop(video_id, None)
+        self.fills += 1
+
+        await asyncio.to_thread(self._remove_files, self._evict())
+
+    def _store(self, video_id: str, tmp_path: str, metadata: dict) -> int:
+        """
+        Writes metadata of a filled file and moves the file into place (runs on a worker thread)
+        :param video_id: str
+        :param tmp_path: str - transcoded file
+        :param metadata: dict - title and duration
+        :return: int - size of the file in bytes
+        """
+        path = self._path(video_id)
+        with open(self._path(video_id, 'json.tmp'), 'w', encoding='utf-8') as f:
+            json.dump(metadata, f)
+        os.replace(self._path(video_id, 'json.tmp'), self._path(video_id, 'json'))
+        os.replace(tmp_path, path)
+        return os.path.getsize(path)
+
+    @staticmethod
+    def _remove(path: str) -> None:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def _evict(self) -> list[str]:
+        """
+        Drops least recently played files from the index until the cache fits the budget
+        :return: list - video ids whose files should be removed (see _remove_files)
+        """
+        evicted = []
+        while self.size > self.max_bytes and self._index:
+            video_id, size = self._index.popitem(last=False)
+            self.size -= size
+            evicted.append(video_id)
+            self.evictions += 1
+        return evicted
+
+    def _remove_files(self, video_ids: list[str]) -> None:
+        for video_id in video_ids:
+            self._remove(self._path(video_id))
+            self._remove(self._path(video_id, 'json'))
+
+    def close(self) -> None:
+        for task in list(self._filling.values()):
+            task.cancel()
+
+    def stats(self) -> dict:
+        return {'enabled': self.enabled, 'files': len(self._index), 'bytes': self.size, 'max_bytes': self.max_bytes,
+                'hits': self.hits, 'misses': self.misses, 'fills': self.fills, 'filling': len(self._filling), 'evictions': self.evictions}
+
+audio_cache = AudioCache()
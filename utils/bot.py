@@ -1,5 +1,122 @@
 from classes.typed_dictionaries import DiscordCommandDict, DiscordCommandDictAttribute
+from utils.log import log
+
 from typing import List
+import hashlib
+import discord
+import json
+import os
+
+import config
+
+TREE_FINGERPRINT_PATH = getattr(config, 'TREE_FINGERPRINT_PATH', 'db/command_tree.json')
+
+def _command_dict(command) -> DiscordCommandDict:
+    attrs: List[DiscordCommandDictAttribute] = []
+    app_command = getattr(command, 'app_command', None)
+    # noinspection PyProtectedMember
+    params = app_command._params if app_command is not None else {}
+    for key, value in params.items():
+        attrs.append({
+            'name': key,
+            'description': str(value.description),
+            'required': value.required,
+            'default': str(value.default),
+            'type': str(value.type)
+        })
+
+    return {
+        'name': command.name,
+        'description': str(command.description),
+        'category': command.extras.get('category', 'No category'),
+        'attributes': attrs
+    }
+
+class CommandCatalogue:
+    """
+    List of visible commands and the rendered help embeds
+
+    Built on first use after the command set changed (Bot.add_command / Bot.remove_command call invalidate()),
+    so /help is a dictionary lookup. The embeds are shared, do not modify them.
+    """
+    def __init__(self):
+        self.version = 0
+        self._built = -1
+
+        self.prefix = ''
+        self.commands: List[DiscordCommandDict] = []
+        self.overview: discord.Embed or None = None
+        self.embeds: dict[str, discord.Embed] = {}
+
+    def invalidate(self) -> None:
+        self.version += 1
+
+    def ensure(self, bot_class) -> None:
+        """
+        Rebuilds the catalogue if the command set changed since the last build
+        :param bot_class: Bot class
+        :return: None
+        """
+        if self._built != self.version:
+            self.build(bot_class)
+
+    def build(self, bot_class) -> None:
+        """
+        Builds the command list and the help embeds
+        :param bot_class: Bot class
+        :return: None
+        """
+        prefix = bot_class.command_prefix if isinstance(bot_class.command_prefix, str) else ''
+
+        commands: List[DiscordCommandDict] = []
+        categories: dict[str, List[DiscordCommandDict]] = {}
+        embeds: dict[str, discord.Embed] = {}
+        for command in bot_class.commands:
+            if command.hidden:
+                continue
+
+            command_dict = _command_dict(command)
+            commands.append(command_dict)
+            categories.setdefault(command_dict['category'], []).append(command_dict)
+
+            embed = discord.Embed(title=command_dict['name'], description=command_dict['description'])
+            for attr in command_dict['attributes']:
+                embed.add_field(name=f"`{attr['name']}` - {attr['description']}", value=f"Required: `{attr['required']}` | Default: `{attr['default']}` | Type: `{attr['type']}`", inline=False)
+            embeds[command_dict['name']] = embed
+
+        overview = discord.Embed(title="Commands", description=f"Use `/help <command>` to get help on a command | Prefix: `{prefix}`")
+        for category, category_commands in categories.items():
+            message = ''
+            for command_dict in category_commands:
+                add = f"`{command_dict['name']}` - {command_dict['description']} \n"
+
+                if len(message + add) > 1024:
+                    overview.add_field(name=f"**{category.capitalize()}**", value=message, inline=False)
+                    message = ''
+
+                message = message + add
+
+            overview.add_field(name=f"**{category.capitalize()}**", value=message, inline=False)
+
+        self.prefix = prefix
+        self.commands = commands
+        self.embeds = embeds
+        self.overview = overview
+        self._built = self.version
+
+    def help_embed(self, bot_class, command_name: str=None) -> discord.Embed or None:
+        """
+        Returns help embed of command_name (overview if None)
+        :param bot_class: Bot class
+        :param command_name: str - name of the command
+        :return: discord.Embed or None if the command does not exist
+        """
+        self.ensure(bot_class)
+        if not command_name:
+            return self.overview
+        return self.embeds.get(command_name)
+
+command_catalogue = CommandCatalogue()
 
 def get_commands(bot_class) -> List[DiscordCommandDict]:
     """
@@ -8,29 +125,74 @@ def get_commands(bot_class) -> List[DiscordCommandDict]:
     :param bot_class: Bot class
     :return: dict
     """
-    command_list: List[DiscordCommandDict] = []
-    for command in bot_class.commands:
-        if command.hidden:
-            continue
-
-        attrs: List[DiscordCommandDictAttribute] = []
-        # noinspection PyProtectedMember
-        for key, value in command.app_command._params.items():
-            attrs.append({
-                'name': key,
-                'description': str(value.description),
-                'required': value.required,
-                'default': str(value.default),
-                'type': str(value.type)
-            })
-
-        command_dict = {
-            'name': command.name,
-            'description': str(command.description),
-            'category': command.extras.get('category', 'No category'),
-            'attributes': attrs
-        }
-
-        command_list.append(command_dict)
-
-    return command_list
+    command_catalogue.ensure(bot_class)
+    return command_catalogue.commands
+
+# ---------------------------------------------- Tree sync -------------------------------------------------------------
+
+def tree_fingerprint(tree) -> str:
+    """
+    Returns deterministic hash of the global app commands of tree (names, descriptions, parameters, types, ...)
+    :param tree: discord.app_commands.CommandTree
+    :return: str - hex digest
+    """
+    payload = []
+    for command in tree.get_commands():
+        try:
+            payload.append(command.to_dict(tree))
+        except TypeError:
+            # discord.py < 2.4 does not take the tree
+            payload.append(command.to_dict())
+
+    payload.sort(key=lambda item: (item.get('type', 1), item['name']))
+    data = json.dumps(payload, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+def read_tree_fingerprint(application_id: int, path: str=TREE_FINGERPRINT_PATH) -> str or None:
+    """
+    Returns fingerprint stored by the last sync of application_id or None
+    """
+    try:
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return data.get(str(application_id))
+
+def write_tree_fingerprint(application_id: int, fingerprint: str, path: str=TREE_FINGERPRINT_PATH) -> None:
+    """
+    Stores fingerprint of application_id (written atomically)
+    """
+    try:
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        data = {}
+    data[str(application_id)] = fingerprint
+
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+async def sync_tree(bot_class, force: bool=False) -> bool:
+    """
+    Syncs the command tree if it changed since the last sync (or if force)
+    :param bot_class: Bot class
+    :param force: bool - sync even if the fingerprint did not change
+    :return: bool - True if the tree was synced
+    """
+    fingerprint = tree_fingerprint(bot_class.tree)
+    application_id = bot_class.application_id
+
+    if not force and read_tree_fingerprint(application_id) == fingerprint:
+        log(None, f"Command tree unchanged ({fingerprint[:12]}), skipping sync")
+        return False
+
+    log(None, "Trying to sync commands")
+    await bot_class.tree.sync()
+    write_tree_fingerprint(application_id, fingerprint)
+    log(None, f"Synced slash commands for {bot_class.user} ({fingerprint[:12]})")
+    return True
@@ -0,0 +1,57 @@
+from __future__ import annotations
+
+import os
+
+import config
+
+# set by launcher.py for every process, a single process is cluster 0 of 1
+CLUSTER_ID = int(os.environ.get('CLUSTER_ID', 0))
+CLUSTER_COUNT = int(os.environ.get('CLUSTER_COUNT', 1))
+PRIMARY_CLUSTER = CLUSTER_ID == 0  # sends admin notifications and syncs the command tree
+
+SHARDED = bool(getattr(config, 'SHARDED', False)) or CLUSTER_COUNT > 1
+SHARD_COUNT: int or None = int(os.environ['SHARD_COUNT']) if os.environ.get('SHARD_COUNT') else getattr(config, 'SHARD_COUNT', None)
+SHARD_IDS: list[int] or None = [int(shard_id) for shard_id in os.environ['SHARD_IDS'].split(',')] if os.environ.get('SHARD_IDS') else None
+
+# multiprocessing queue of admin notifications from the other clusters (set by launcher.py)
+admin_queue = None
+
+def shard_ranges(shard_count: int, cluster_count: int) -> list[list[int]]:
+    """
+    Splits shards into contiguous ranges, one per cluster
+    :param shard_count: int - total number of shards
+    :param cluster_count: int - number of processes
+    :return: list of shard id lists
+    """
+    if cluster_count < 1 or shard_count < cluster_count:
+        raise ValueError(f'Can not split {shard_count} shards into {cluster_count} clusters')
+
+    base, extra = divmod(shard_count, cluster_count)
+    ranges = []
+    start = 0
+    for cluster_id in range(cluster_count):
+        size = base + (1 if cluster_id < extra else 0)
+        ranges.append(list(range(start, start + size)))
+        start += size
+    return ranges
+
+def cluster_path(path: str, cluster_id: int=CLUSTER_ID) -> str:
+    """
+    Returns per-cluster variant of a file path, 'log.log' -> 'log-c1.log' (unchanged without clusters)
+    :param path: str
+    :param cluster_id: int
+    :return: str
+    """
+    if CLUSTER_COUNT <= 1:
+        return path
+    root, ext = os.path.splitext(path)
+    return f'{root}-c{cluster_id}{ext}'
+
+def cluster_paths(path: str) -> list[str]:
+    """
+    Returns paths of all clusters
+    """
+    return [cluster_path(path, cluster_id) for cluster_id in range(CLUSTER_COUNT)]
+
+def cluster_info() -> dict:
+    return {'cluster_id': CLUSTER_ID, 'cluster_count': CLUSTER_COUNT, 'primary': PRIMARY_CLUSTER, 'sharded': SHARDED, 'shard_count': SHARD_COUNT, 'shard_ids': SHARD_IDS}
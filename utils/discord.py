@@ -1,56 +1,60 @@
+from typing import Literal
 import discord
 
-def get_voice_client(iterable, **attrs) -> discord.VoiceClient:
+import config
+
+GATEWAY_PROFILE: Literal['full', 'lean'] = getattr(config, 'GATEWAY_PROFILE', 'full')
+
+def gateway_options(profile: Literal['full', 'lean']=GATEWAY_PROFILE) -> dict:
     """
-    Gets voice_client from voice_clients list
-    :param iterable: list
-    :return: discord.VoiceClient
+    Returns intents and caching options of the bot for profile
+
+    'full' - all intents, every member of every guild is chunked and cached
+    'lean' - guilds, voice states and messages only, members are cached only while in voice,
+             guilds are not chunked at startup (anything else is fetched on demand)
+
+    :param profile: 'full' or 'lean'
+    :return: dict - keyword arguments of discord.Client
     """
-    from operator import attrgetter
-
-    # noinspection PyShadowingNames
-    def _get(iterable, /, **attrs):
-        # global -> local
-        _all = all
-        attrget = attrgetter
-
-        # Special case the single element call
-        if len(attrs) == 1:
-            k, v = attrs.popitem()
-            pred = attrget(k.replace('__', '.'))
-            return next((elem for elem in iterable if pred(elem) == v), None)
-
-        converted = [(attrget(attr.replace('__', '.')), value) for attr, value in attrs.items()]
-        for elem in iterable:
-            if _all(pred(elem) == value for pred, value in converted):
-                return elem
-        return None
+    if profile == 'full':
+        return {'intents': discord.Intents.all()}
 
-    # noinspection PyShadowingNames
-    async def _aget(iterable, /, **attrs):
-        # global -> local
-        _all = all
-        attrget = attrgetter
-
-        # Special case the single element call
-        if len(attrs) == 1:
-            k, v = attrs.popitem()
-            pred = attrget(k.replace('__', '.'))
-            async for elem in iterable:
-                if pred(elem) == v:
-                    return elem
-            return None
-
-        converted = [(attrget(attr.replace('__', '.')), value) for attr, value in attrs.items()]
-
-        async for elem in iterable:
-            if _all(pred(elem) == value for pred, value in converted):
-                return elem
-        return None
+    if profile != 'lean':
+        raise ValueError('Wrong gateway profile')
+
+    intents = discord.Intents.none()
+    intents.guilds = True
+    intents.voice_states = True
+    intents.guild_messages = True
+    intents.dm_messages = True
+    intents.message_content = True  # prefix commands
+
+    member_cache_flags = discord.MemberCacheFlags.none()
+    member_cache_flags.voice = True
 
+    return {'intents': intents, 'member_cache_flags': member_cache_flags, 'chunk_guilds_at_startup': False}
 
-    return (
-        _aget(iterable, **attrs)  # type: ignore
-        if hasattr(iterable, '__aiter__')  # isinstance(iterable, collections.abc.AsyncIterable) is too slow
-        else _get(iterable, **attrs)  # type: ignore
-    )
+def voice_member_count(channel) -> int:
+    """
+    Returns number of users connected to a voice channel (including the bot)
+    Uses the voice states, so it does not depend on the member cache
+    :param channel: discord.VoiceChannel or discord.StageChannel
+    :return: int
+    """
+    return len(channel.voice_states)
+
+async def get_or_fetch_user(bot_class, user_id: int) -> discord.User or None:
+    """
+    Returns user from the cache or fetches it (the lean profile does not cache users)
+    :param bot_class: Bot class
+    :param user_id: int
+    :return: discord.User or None if the user does not exist
+    """
+    user = bot_class.get_user(user_id)
+    if user is not None:
+        return user
+
+    try:
+        return await bot_class.fetch_user(user_id)
+    except discord.NotFound:
+        return None
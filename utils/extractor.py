@@ -0,0 +1,304 @@
+from __future__ import annotations
+
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Executor
+from typing import Callable, Literal
+from time import monotonic
+import threading
+import asyncio
+
+from utils.metrics import extract_duration
+
+import config
+
+YTDL_OPTIONS = {
+    'format': 'bestaudio/best',
+    'extractaudio': True,
+    'audioformat': 'mp3',
+    'outtmpl': '%(extractor)s-%(id)s-%(title)s.%(ext)s',
+    'restrictfilenames': True,
+    'noplaylist': True,
+    'nocheckcertificate': True,
+    'ignoreerrors': False,
+    'logtostderr': False,
+    'quiet': True,
+    'no_warnings': True,
+    'default_search': 'auto',
+    'source_address': '0.0.0.0',
+}
+
+EXTRACTOR_MODE: Literal['thread', 'process'] = getattr(config, 'EXTRACTOR_MODE', 'thread')
+EXTRACTOR_WORKERS = getattr(config, 'EXTRACTOR_WORKERS', 4)  # number of threads / processes
+EXTRACTOR_MAX_QUEUE = getattr(config, 'EXTRACTOR_MAX_QUEUE', 32)  # max number of jobs waiting or running
+EXTRACTOR_TIMEOUT = getattr(config, 'EXTRACTOR_TIMEOUT', 30)  # seconds per job
+EXTRACTOR_POLL = 0.5  # seconds between checks of the 'alive' callback
+
+YTDL_FLAT_OPTIONS = {
+    **YTDL_OPTIONS,
+    'noplaylist': False,
+    'extract_flat': 'in_playlist',  # ids and titles only
+    'lazy_playlist': True,  # download only the pages of the requested entries
+}
+
+# processed by the workers at warm-up (no network), so the first /play does not pay for the
+# yt_dlp import, the YouTube extractor and the format selection
+WARMUP_URL = 'https://www.youtube.com/watch?v=dQw4w9WgXcQ'
+WARMUP_INFO = {
+    'id': 'dQw4w9WgXcQ',
+    'title': 'warm-up',
+    'extractor': 'youtube',
+    'extractor_key': 'Youtube',
+    'webpage_url': WARMUP_URL,
+    'duration': 1,
+    'formats': [
+        {'format_id': '251', 'url': 'https://localhost/251', 'ext': 'webm', 'acodec': 'opus', 'vcodec': 'none', 'abr': 160, 'asr': 48000, 'protocol': 'https'},
+        {'format_id': '140', 'url': 'https://localhost/140', 'ext': 'm4a', 'acodec': 'mp4a.40.2', 'vcodec': 'none', 'abr': 128, 'asr': 44100, 'protocol': 'https'},
+        {'format_id': '18', 'url': 'https://localhost/18', 'ext': 'mp4', 'acodec': 'mp4a.40.2', 'vcodec': 'avc1.42001E', 'width': 640, 'height': 360, 'protocol': 'https'},
+    ],
+}
+
+class ExtractionError(Exception):
+    """Extraction failed (the message of the original error is preserved)"""
+
+class ExtractorBusy(ExtractionError):
+    """Too many extraction jobs are waiting"""
+
+class ExtractionTimeout(ExtractionError):
+    """Extraction job took longer than its timeout"""
+
+class ExtractionCancelled(ExtractionError):
+    """Extraction job was cancelled because its result is no longer needed (player stopped, bot left the channel)"""
+
+def slim_info(data: dict) -> dict:
+    """
+    Returns only the parts of extracted info needed for playback
+    :param data: dict - yt_dlp info dict
+    :return: dict
+    """
+    keys = ('id', 'url', 'title', 'duration', 'ext', 'acodec', 'abr', 'asr', 'format_id', 'http_headers', 'extractor_key')
+    return {key: data.get(key) for key in keys if key in data}
+
+# ---------------------------------------------- Worker side -----------------------------------------------------------
+
+# every worker (thread or process) owns its own YoutubeDL instance
+_worker_state = threading.local()
+
+def _init_worker() -> None:
+    """
+    Creates and warms up the YoutubeDL instance of the current worker
+    :return: None
+    """
+    # imported on first use, so the import does not slow down the start of the bot
+    import yt_dlp
+
+    ytdl = yt_dlp.YoutubeDL(YTDL_OPTIONS)
+    # instantiate the extractor now, so the first job does not have to
+    ytdl.get_info_extractor('Youtube')
+    _worker_state.ytdl = ytdl
+
+def _warm_up() -> None:
+    """
+    Runs the YouTube extractor and the format selection of the current worker on WARMUP_INFO
+    :return: None
+    """
+    ytdl = getattr(_worker_state, 'ytdl', None)
+    if ytdl is None:
+        _init_worker()
+        ytdl = _worker_state.ytdl
+
+    extractor = ytdl.get_info_extractor('Youtube')
+    if not extractor.suitable(WARMUP_URL):
+        raise ExtractionError('YouTube extractor does not match the warm-up url')
+
+    # copy, yt_dlp modifies the info dict in place
+    info = {**WARMUP_INFO, 'formats': [dict(f) for f in WARMUP_INFO['formats']]}
+    ytdl.process_ie_result(info, download=False)
+
+def _extract_playlist_page(url: str, start: int, count: int) -> dict:
+    """
+    Extracts entries start..start+count-1 of a playlist in the current worker
+    Only ids and titles are extracted (flat), pages after the requested entries are not downloaded (lazy)
+    :param url: str - playlist url
+    :param start: int - index of the first entry (starting with 1)
+    :param count: int - number of entries
+    :return: dict - {'title', 'entries': [{'id', 'url', 'title', 'duration'}], 'done'}
+    """
+    ytdl = getattr(_worker_state, 'ytdl_flat', None)
+    if ytdl is None:
+        import yt_dlp
+        ytdl = yt_dlp.YoutubeDL(YTDL_FLAT_OPTIONS)
+        _worker_state.ytdl_flat = ytdl
+
+    # the instance belongs to this worker, so the range can be set per job
+    ytdl.params['playlist_items'] = f'{start}:{start + count - 1}'
+    try:
+        data = ytdl.extract_info(url, download=False)
+    except Exception as e:
+        raise ExtractionError(str(e)) from None
+
+    if data is None:
+        raise ExtractionError(f'No data extracted from {url}')
+
+    page = data.get('entries') or []
+    entries = []
+    for entry in page:
+        if not entry or not entry.get('id'):
+            continue
+        entries.append({'id': entry['id'], 'url': f"https://www.youtube.com/watch?v={entry['id']}", 'title': entry.get('title'), 'duration': entry.get('duration')})
+
+    # a short page is the last one (entries without an id are counted, they are still in the playlist)
+    return {'title': data.get('title'), 'entries': entries, 'done': len(page) < count}
+
+def _extract(url: str) -> dict:
+    """
+    Extracts info of url in the current worker
+    :param url: str - url to extract
+    :return: dict - slim info dict
+    """
+    ytdl = getattr(_worker_state, 'ytdl', None)
+    if ytdl is None:
+        _init_worker()
+        ytdl = _worker_state.ytdl
+
+    try:
+        data = ytdl.extract_info(url, download=False)
+    except Exception as e:
+        # yt_dlp errors are not always picklable, send only the message back
+        raise ExtractionError(str(e)) from None
+
+    if data is None:
+        raise ExtractionError(f'No data extracted from {url}')
+
+    if 'entries' in data:
+        entries = list(data['entries'])
+        if not entries:
+            raise ExtractionError(f'No entries extracted from {url}')
+        data = entries[0]
+
+    return slim_info(data)
+
+# ---------------------------------------------- Engine ----------------------------------------------------------------
+
+class ExtractionEngine:
+    """
+    Runs yt_dlp extractions in a dedicated pool
+
+    mode 'thread' uses a thread pool, mode 'process' uses a process pool,
+    in both cases each worker owns its own warmed YoutubeDL instance.
+    """
+    def __init__(self, mode: Literal['thread', 'process']=EXTRACTOR_MODE, workers: int=EXTRACTOR_WORKERS, max_queue: int=EXTRACTOR_MAX_QUEUE, timeout: float=EXTRACTOR_TIMEOUT):
+        if mode not in ('thread', 'process'):
+            raise ValueError('Wrong mode')
+
+        self.mode = mode
+        self.workers = workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+
+        self._executor: Executor or None = None
+        self._pending_lock = threading.Lock()
+        self.pending = 0  # jobs queued or running in the pool, also those whose caller gave up (see _run)
+        self.warmed = False
+
+    @property
+    def executor(self) -> Executor:
+        if self._executor is None:
+            if self.mode == 'process':
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='extractor', initializer=_init_worker)
+        return self._executor
+
+    async def _run(self, func: Callable, args: tuple, what: str, timeout: float=None, alive: Callable[[], bool]=None):
+        """
+        Runs func(*args) in the pool, see extract for the errors
+        """
+        if self.pending >= self.max_queue:
+            raise ExtractorBusy(f'Extractor is busy ({self.pending} jobs queued or running)')
+
+        timeout = self.timeout if timeout is None else timeout
+        deadline = monotonic() + timeout
+
+        with self._pending_lock:
+            self.pending += 1
+        start = monotonic()
+        result = 'error'
+        job = self.executor.submit(func, *args)
+        # a job that already runs can not be cancelled, it counts until the worker finishes it
+        job.add_done_callback(self._job_done)
+        future = asyncio.wrap_future(job)
+        try:
+            while True:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    result = 'timeout'
+                    raise ExtractionTimeout(f'Extraction of {what} timed out after {timeout}s')
+
+                done, _ = await asyncio.wait({future}, timeout=min(remaining, EXTRACTOR_POLL))
+                if done:
+                    data = future.result()
+                    result = 'ok'
+                    return data
+
+                if alive is not None and not alive():
+                    result = 'cancelled'
+                    raise ExtractionCancelled(f'Extraction of {what} was cancelled')
+        finally:
+            extract_duration.observe(monotonic() - start, result=result)
+            if not future.done():
+                # drops the job if it did not start yet, a running job finishes in the background
+                future.cancel()
+
+    def _job_done(self, job) -> None:
+        # runs on the thread that completed (or cancelled) the job
+        with self._pending_lock:
+            self.pending -= 1
+
+    async def extract(self, url: str, timeout: float=None, alive: Callable[[], bool]=None) -> dict:
+        """
+        Extracts info of url in the pool
+
+        :param url: str - url to extract
+        :param timeout: float - seconds before the job is abandoned (default: engine timeout)
+        :param alive: callable - returns False when the result is no longer needed
+        :return: dict - slim info dict
+        :raises ExtractorBusy: when the queue is full
+        :raises ExtractionTimeout: when the job takes longer than timeout
+        :raises ExtractionCancelled: when alive() returns False
+        :raises ExtractionError: when yt_dlp fails
+        """
+        return await self._run(_extract, (url,), url, timeout, alive)
+
+    async def extract_playlist_page(self, url: str, start: int, count: int, timeout: float=None) -> dict:
+        """
+        Extracts one page of a playlist without resolving its entries (see _extract_playlist_page)
+
+        :param url: str - playlist url
+        :param start: int - index of the first entry (starting with 1)
+        :param count: int - number of entries
+        :param timeout: float - seconds before the job is abandoned (default: engine timeout)
+        :return: dict - {'title', 'entries': [{'id', 'url', 'title', 'duration'}], 'done'}
+        :raises ExtractionError: see extract
+        """
+        return await self._run(_extract_playlist_page, (url, start, count), f'{url} [{start}:{start + count - 1}]', timeout)
+
+    async def warm_up(self) -> float:
+        """
+        Starts the workers and runs a warm-up job on them (see _warm_up)
+        :return: float - seconds it took
+        """
+        start = monotonic()
+        loop = asyncio.get_running_loop()
+        # the pool may reuse one thread for several jobs, the import and extractor classes are shared anyway
+        await asyncio.gather(*(loop.run_in_executor(self.executor, _warm_up) for _ in range(self.workers)))
+        self.warmed = True
+        return monotonic() - start
+
+    def stats(self) -> dict:
+        return {'mode': self.mode, 'workers': self.workers, 'pending': self.pending, 'max_queue': self.max_queue, 'warmed': self.warmed}
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+extraction_engine = ExtractionEngine()
@@ -0,0 +1,35 @@
+from __future__ import annotations
+import aiohttp
+
+HTTP_LIMIT = 100  # total simultaneous connections
+HTTP_LIMIT_PER_HOST = 10  # simultaneous connections per host
+HTTP_DNS_CACHE_TTL = 300  # seconds
+HTTP_KEEPALIVE_TIMEOUT = 30  # seconds
+HTTP_TIMEOUT = aiohttp.ClientTimeout(total=20, connect=10)
+
+_session: aiohttp.ClientSession or None = None
+
+def get_session() -> aiohttp.ClientSession:
+    """
+    Returns the process-wide aiohttp session
+    The session is created on first use (it has to be created inside a running event loop)
+    :return: aiohttp.ClientSession
+    """
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(limit=HTTP_LIMIT,
+                                         limit_per_host=HTTP_LIMIT_PER_HOST,
+                                         ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+                                         keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT)
+        _session = aiohttp.ClientSession(connector=connector, timeout=HTTP_TIMEOUT)
+    return _session
+
+async def close_session() -> None:
+    """
+    Closes the process-wide aiohttp session
+    :return: None
+    """
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
@@ -1,15 +1,37 @@
 from utils.convert import struct_to_time
+from utils.log_archive import ArchivingFileHandler, archive_file, existing_segment, LOG_MAX_BYTES
+from utils.discord import get_or_fetch_user
+from utils.cluster import cluster_path, PRIMARY_CLUSTER, CLUSTER_ID
+import utils.cluster
 
 from time import time
 from io import BytesIO
 from typing import Literal
 from discord.ext import commands as dc_commands
+import logging.handlers
 import discord
 import logging
+import threading
+import asyncio
+import atexit
+import queue
+import json
 import sys
+import os
 
+import config
 from config import OWNER_ID
 
+LOG_QUEUE_SIZE = getattr(config, 'LOG_QUEUE_SIZE', 10000)  # max number of records waiting to be written
+LOG_OVERFLOW: Literal['drop', 'block'] = getattr(config, 'LOG_OVERFLOW', 'drop')  # what to do when the queue is full
+LOG_BLOCK_TIMEOUT = 1  # seconds to wait for space in the queue when LOG_OVERFLOW is 'block'
+
+DATA_LOG_FORMAT: Literal['text', 'jsonl'] = getattr(config, 'DATA_LOG_FORMAT', 'text')
+DATA_LOG_PATH = cluster_path('db/log/data.jsonl' if DATA_LOG_FORMAT == 'jsonl' else 'db/log/data.log')
+LOG_PATH = cluster_path('log.log')  # every cluster process writes its own log
+DATA_FLUSH_SIZE = getattr(config, 'DATA_FLUSH_SIZE', 100)  # records in memory before a write
+DATA_FLUSH_INTERVAL = getattr(config, 'DATA_FLUSH_INTERVAL', 5)  # seconds between writes
+
 # ---------------- Create Loggers ------------
 
 # Formatters
@@ -21,21 +43,117 @@ print_handler.setLevel(logging.INFO)
 print_handler.setFormatter(formatter)
 
 # File handlers
-file_handler = logging.FileHandler('log.log', encoding='utf-8')
+file_handler = ArchivingFileHandler(LOG_PATH, encoding='utf-8')
 file_handler.setLevel(logging.INFO)
 file_handler.setFormatter(formatter)
 
+class LazyMessage:
+    """
+    Log message that is built only when a handler formats it (on the listener thread)
+    """
+    __slots__ = ('_build', '_text')
+
+    def __init__(self, build):
+        self._build = build
+        self._text = None
+
+    def __str__(self):
+        if self._text is None:
+            self._text = self._build()
+        return self._text
+
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that does not format records on the calling thread and has an explicit overflow policy
+
+    'drop' - records that do not fit into the queue are dropped and counted
+    'block' - the caller waits up to LOG_BLOCK_TIMEOUT seconds, then the record is dropped
+    """
+    def __init__(self, log_queue: queue.Queue, overflow: Literal['drop', 'block']=LOG_OVERFLOW):
+        super().__init__(log_queue)
+        self.overflow = overflow
+        self.dropped = 0
+        self._reported = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # formatting is left to the listener handlers
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            if self.overflow == 'block':
+                self.queue.put(record, timeout=LOG_BLOCK_TIMEOUT)
+            else:
+                self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            return
+
+        if self.dropped > self._reported:
+            dropped = self.dropped - self._reported
+            self._reported = self.dropped
+            warning = logging.LogRecord('main', logging.WARNING, __file__, 0, f"WRN  None | Dropped {dropped} log records (queue full)", None, None)
+            try:
+                self.queue.put_nowait(warning)
+            except queue.Full:
+                self._reported -= dropped
+
+log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+queue_handler = BoundedQueueHandler(log_queue)
+queue_handler.setLevel(logging.INFO)
+
+# Writes records from the queue on a background thread
+log_listener = logging.handlers.QueueListener(log_queue, print_handler, file_handler, respect_handler_level=True)
+log_listener.start()
+
 # Main logger
 main_logger = logging.getLogger('main')
 main_logger.setLevel(logging.INFO)
-main_logger.addHandler(print_handler)
-main_logger.addHandler(file_handler)
+main_logger.addHandler(queue_handler)
+
+def stop_logging() -> None:
+    """
+    Writes all queued records and stops the listener thread
+    :return: None
+    """
+    global log_listener
+    if log_listener is None:
+        return
+
+    listener, log_listener = log_listener, None
+    # records logged from now on are handled on the calling thread
+    main_logger.removeHandler(queue_handler)
+    main_logger.addHandler(print_handler)
+    main_logger.addHandler(file_handler)
+
+    listener.stop()
+
+atexit.register(stop_logging)
 
 # logging.basicConfig(filename='db/log/log.log', level=logging.INFO, format='%(asctime)s | %(levelname)s | %(message)s')
 
+def readable_dict(_dict: dict) -> str:
+    if not _dict:
+        return ''
+    ignored_keys = ['ctx', 'glob', 'web_data', 'bot_class', 'bot']
+
+    out_str = ''
+    for _key, _value in _dict.items():
+        if _key in ignored_keys:
+            continue
+
+        if isinstance(_value, str):
+            out_str += f"{_key}='{_value}', "
+            continue
+
+        out_str += f"{_key}={_value}, "
+
+    return out_str[:-2]
+
 def log(ctx, text_data, options: dict=None, log_type: Literal['command', 'function', 'web', 'text', 'ip', 'error', 'warning']='text', author=None) -> None:
     """
     Logs data to the console and to the log file
+    Values are read on the calling thread, the message is assembled and written on the listener thread
     :param ctx: dc_commands.Context or WebData or guild_id
     :param text_data: The data to be logged
     :param options: dict - options to be logged from command
@@ -43,24 +161,6 @@ def log(ctx, text_data, options: dict=None, log_type: Literal['command', 'functi
     :param author: Author of the command
     :return: None
     """
-    def readable_dict(_dict: dict) -> str:
-        if not _dict:
-            return ''
-        ignored_keys = ['ctx', 'glob', 'web_data', 'bot_class', 'bot']
-
-        out_str = ''
-        for _key, _value in _dict.items():
-            if _key in ignored_keys:
-                continue
-
-            if isinstance(_value, str):
-                out_str += f"{_key}='{_value}', "
-                continue
-
-            out_str += f"{_key}={_value}, "
-
-        return out_str[:-2]
-
     if isinstance(ctx, dc_commands.Context):
         if ctx.guild is None:
             guild_id = 'Other'
@@ -71,49 +171,157 @@ def log(ctx, text_data, options: dict=None, log_type: Literal['command', 'functi
     else:
         guild_id = ctx
 
+    # the message is assembled later on the listener thread, values that can change (or discord objects) are read now
+    if not isinstance(text_data, str):
+        text_data = str(text_data)
+    author = None if author is None else str(author)
+    if log_type in ('command', 'function', 'web'):
+        options = readable_dict(options)
+    elif options is not None:
+        options = str(options)
+
     match log_type:
         case 'command':
-            message = f"CMD  {guild_id} | {text_data} by ({author}) -> {readable_dict(options)}"
+            message = LazyMessage(lambda: f"CMD  {guild_id} | {text_data} by ({author}) -> {options}")
             logging.getLogger('main').info(message)
             return
         case 'function':
-            message = f"FUNC {guild_id} | {text_data} -> {readable_dict(options)}"
+            message = LazyMessage(lambda: f"FUNC {guild_id} | {text_data} -> {options}")
             logging.getLogger('main').info(message)
             return
         case 'web':
-            message = f"WEB  {guild_id} | Command ({text_data}) was requested by ({author}) -> {readable_dict(options)}"
+            message = LazyMessage(lambda: f"WEB  {guild_id} | Command ({text_data}) was requested by ({author}) -> {options}")
             logging.getLogger('web').info(message)
             return
         case 'text':
-            message = f"TXT  {guild_id} | {text_data}"
+            message = LazyMessage(lambda: f"TXT  {guild_id} | {text_data}")
             logging.getLogger('main').info(message)
             return
         case 'ip':
-            message = f"IP   {guild_id} | Requested: {text_data}"
+            message = LazyMessage(lambda: f"IP   {guild_id} | Requested: {text_data}")
             logging.getLogger('web').info(message)
             return
         case 'error':
-            message = f"ERR  {guild_id} | {text_data} -> {options}"
+            message = LazyMessage(lambda: f"ERR  {guild_id} | {text_data} -> {options}")
             logging.getLogger('main').error(message)
             return
         case 'warning':
-            message = f"WRN  {guild_id} | {text_data} -> {options}"
+            message = LazyMessage(lambda: f"WRN  {guild_id} | {text_data} -> {options}")
             logging.getLogger('main').warning(message)
             return
         case _:
             raise ValueError('Wrong log_type')
 
+class DataSink:
+    """
+    Buffered writer for collected data
+
+    Records are kept in memory and written in batches, when the buffer reaches flush_size
+    or every flush_interval seconds (from a background task). Writing happens on a worker thread.
+    'text' writes '01/01/2024 00:00:00 | data' lines (dicts and lists as JSON), 'jsonl' writes one JSON object per line.
+    """
+    def __init__(self, path: str=DATA_LOG_PATH, fmt: Literal['text', 'jsonl']=DATA_LOG_FORMAT, flush_size: int=DATA_FLUSH_SIZE, flush_interval: float=DATA_FLUSH_INTERVAL):
+        self.path = path
+        self.fmt = fmt
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+
+        self._buffer: list[tuple[float, object]] = []
+        self._lock = threading.Lock()
+        self._task: asyncio.Task or None = None
+        self._pending: set[asyncio.Task] = set()
+        self._write_lock = asyncio.Lock()
+
+        self.written = 0
+
+    def add(self, data) -> None:
+        self._buffer.append((time(), data))
+        if len(self._buffer) >= self.flush_size:
+            self._flush_soon()
+
+    def _take(self) -> list[tuple[float, object]]:
+        batch, self._buffer = self._buffer, []
+        return batch
+
+    def _format(self, created: float, data) -> str:
+        if self.fmt == 'jsonl':
+            return json.dumps({'time': created, 'data': data}, default=str, ensure_ascii=False) + '\n'
+        if isinstance(data, (dict, list)):
+            # structured records (traces) stay machine readable in the text format too
+            data = json.dumps(data, default=str, ensure_ascii=False)
+        return f"{struct_to_time(created)} | {data}\n"
+
+    def _write(self, batch: list[tuple[float, object]]) -> None:
+        if not batch:
+            return
+        text = ''.join(self._format(created, data) for created, data in batch)
+
+        with self._lock:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            if os.path.exists(self.path) and os.path.getsize(self.path) > LOG_MAX_BYTES:
+                archive_file(self.path, existing_segment(self.path))
+
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(text)
+            self.written += len(batch)
+
+    async def _write_in_order(self, batch: list[tuple[float, object]]) -> None:
+        # batches are written one after another in the order they were taken (asyncio.Lock wakes waiters in order)
+        async with self._write_lock:
+            await asyncio.to_thread(self._write, batch)
+
+    def _flush_soon(self) -> asyncio.Task or None:
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.flush()
+            return None
+
+        task = loop.create_task(self._write_in_order(self._take()))
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+        return task
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            if self._buffer:
+                # a write that already started is finished even when the sink is stopped (see stop)
+                await asyncio.shield(self._flush_soon())
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+
+    def flush(self) -> None:
+        """
+        Writes the buffer on the calling thread
+        :return: None
+        """
+        self._write(self._take())
+
+    async def stop(self) -> None:
+        """
+        Stops the background task, waits for the writes in progress and writes the rest of the buffer
+        :return: None
+        """
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        while self._pending:
+            await asyncio.wait(set(self._pending))
+        self.flush()
+
+data_sink = DataSink()
+atexit.register(data_sink.flush)
+
 def collect_data(data) -> None:
     """
-    Collects data to the data.log file
+    Collects data to the data.log file (buffered, see DataSink)
     :param data: data to be collected
     :return: None
     """
-    now_time_str = struct_to_time(time())
-    message = f"{now_time_str} | {data}\n"
-
-    with open(f'db/log/data.log', "a", encoding="utf-8") as f:
-        f.write(message)
+    data_sink.add(data)
 
 async def send_to_admin(bot_class, data, file=False) -> None:
     """
@@ -123,8 +331,14 @@ async def send_to_admin(bot_class, data, file=False) -> None:
     :param file: bool - if data should be sent as a file
     :return: None
     """
-    admin = bot_class.get_user(OWNER_ID)
-    developer = bot_class.get_user(349164237605568513)
+    if not PRIMARY_CLUSTER:
+        # only the primary cluster sends notifications, the others forward them (see relay_admin_messages)
+        if utils.cluster.admin_queue is not None:
+            utils.cluster.admin_queue.put((f'[cluster {CLUSTER_ID}] {data}', file))
+        return
+
+    admin = await get_or_fetch_user(bot_class, OWNER_ID)
+    developer = await get_or_fetch_user(bot_class, 349164237605568513)
 
     # if length of data is more than 2000 symbols send a file
     if len(data) > 2000 or file:
@@ -142,3 +356,24 @@ async def send_to_admin(bot_class, data, file=False) -> None:
         await developer.send(data)
 
     await admin.send(data)
+
+async def relay_admin_messages(bot_class) -> None:
+    """
+    Sends admin notifications forwarded by the other cluster processes (runs in the primary cluster)
+    :param bot_class: Bot class
+    :return: None
+    """
+    admin_queue = utils.cluster.admin_queue
+    if admin_queue is None:
+        return
+
+    while True:
+        try:
+            data, file = await asyncio.to_thread(admin_queue.get, True, 1)
+        except queue.Empty:
+            continue
+
+        try:
+            await send_to_admin(bot_class, data, file=file)
+        except Exception as e:
+            log(None, 'Failed to relay admin message', options={'error': e}, log_type='error')
@@ -0,0 +1,262 @@
+from __future__ import annotations
+
+from collections import deque
+from datetime import datetime
+from time import time
+import logging.handlers
+import logging
+import shutil
+import json
+import gzip
+import os
+
+import config
+
+LOG_MAX_BYTES = getattr(config, 'LOG_MAX_BYTES', 50 * 1024 ** 2)  # rotate when the file is bigger (50 MiB)
+LOG_MAX_AGE = getattr(config, 'LOG_MAX_AGE', 86400)  # rotate when the file is older (seconds)
+LOG_ARCHIVE_DIR = getattr(config, 'LOG_ARCHIVE_DIR', 'db/log/archive')
+LOG_ARCHIVE_KEEP = getattr(config, 'LOG_ARCHIVE_KEEP', 200)  # max number of archives kept per log
+LOG_TIME_FORMAT = '%d/%m/%Y %H:%M:%S'
+
+def parse_time(text: str) -> float:
+    """
+    Parses a time in the format of the log lines, seconds (and the time) can be left out
+    :param text: str - '01/01/2024 12:30:00', '01/01/2024 12:30' or '01/01/2024'
+    :return: float - timestamp
+    :raises ValueError: when text is not in one of the formats
+    """
+    for time_format in (LOG_TIME_FORMAT, '%d/%m/%Y %H:%M', '%d/%m/%Y'):
+        try:
+            return datetime.strptime(text.strip(), time_format).timestamp()
+        except ValueError:
+            pass
+    raise ValueError(f'Time `{text}` is not in the format DD/MM/YYYY HH:MM:SS')
+
+def parse_line(line: str) -> (float or None, str or None, str or None):
+    """
+    Parses a log line '01/01/2024 00:00:00 | main | CMD  123 | ...'
+    :param line: str - line of log file
+    :return: (timestamp, log type, guild id) - None when the part is missing
+    """
+    parts = line.split(' | ', 3)
+    try:
+        timestamp = datetime.strptime(parts[0], LOG_TIME_FORMAT).timestamp()
+    except ValueError:
+        return None, None, None
+
+    if len(parts) < 3:
+        return timestamp, None, None
+
+    log_type, guild_id = parse_message(parts[2] if len(parts) == 3 else f'{parts[2]} | {parts[3]}')
+    return timestamp, log_type, guild_id
+
+def parse_message(message: str) -> (str or None, str or None):
+    """
+    Parses a message made by utils.log.log 'CMD  123 | ...'
+    :param message: str
+    :return: (log type, guild id)
+    """
+    if len(message) < 5 or message[4] != ' ':
+        return None, None
+    head = message[5:].split(' | ', 1)[0]
+    return message[:4].strip(), head.strip()
+
+class Segment:
+    """
+    Index of the log file that is currently written (time range, guild ids and log types)
+    'complete' is False when the file existed before the segment was started (its content was not indexed)
+    """
+    def __init__(self, start: float or None=None, complete: bool=True):
+        self.start = start
+        self.end = start
+        self.guilds: set[str] = set()
+        self.types: set[str] = set()
+        self.complete = complete
+
+    def add(self, created: float, log_type: str or None, guild_id: str or None) -> None:
+        if self.start is None:
+            self.start = created
+        self.end = created
+        if log_type:
+            self.types.add(log_type)
+        if guild_id:
+            self.guilds.add(guild_id)
+
+    def to_dict(self) -> dict:
+        return {'start': self.start, 'end': self.end, 'guilds': sorted(self.guilds), 'types': sorted(self.types), 'complete': self.complete}
+
+def existing_segment(path: str) -> Segment:
+    """
+    Returns segment of a file that already exists (start is taken from its first line)
+    :param path: str
+    :return: Segment
+    """
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return Segment()
+
+    start = None
+    with open(path, encoding='utf-8', errors='replace') as f:
+        for line in f:
+            start = parse_line(line)[0]
+            if start is not None:
+                break
+
+    segment = Segment(start or os.path.getmtime(path), complete=False)
+    segment.end = os.path.getmtime(path)
+    return segment
+
+def archive_file(path: str, segment: Segment, archive_dir: str=LOG_ARCHIVE_DIR, keep: int=LOG_ARCHIVE_KEEP) -> str or None:
+    """
+    Compresses path into archive_dir, writes the sidecar index and truncates path
+    :param path: str - file to archive
+    :param segment: Segment - index of the file
+    :param archive_dir: str
+    :param keep: int - max number of archives kept for this file
+    :return: str - path of the archive or None if there was nothing to archive
+    """
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return None
+
+    os.makedirs(archive_dir, exist_ok=True)
+
+    name = os.path.splitext(os.path.basename(path))[0]
+    stamp = datetime.fromtimestamp(segment.start or time()).strftime('%Y%m%d-%H%M%S')
+    archive = os.path.join(archive_dir, f'{name}-{stamp}.log.gz')
+    counter = 1
+    while os.path.exists(archive):
+        archive = os.path.join(archive_dir, f'{name}-{stamp}-{counter}.log.gz')
+        counter += 1
+
+    with open(path, 'rb') as source, gzip.open(archive + '.tmp', 'wb') as target:
+        shutil.copyfileobj(source, target)
+    os.replace(archive + '.tmp', archive)
+
+    with open(archive + '.idx.tmp', 'w', encoding='utf-8') as f:
+        json.dump(segment.to_dict(), f)
+    os.replace(archive + '.idx.tmp', archive + '.idx')
+
+    open(path, 'w').close()
+
+    archives = _archives(name, archive_dir)
+    for old, _ in archives[:-keep] if keep else []:
+        for file in (old, old + '.idx'):
+            try:
+                os.remove(file)
+            except FileNotFoundError:
+                pass
+
+    return archive
+
+class ArchivingFileHandler(logging.handlers.RotatingFileHandler):
+    """
+    File handler that rotates by size or age into gzip archives with a sidecar index
+    """
+    def __init__(self, filename: str, max_bytes: int=LOG_MAX_BYTES, max_age: float=LOG_MAX_AGE, archive_dir: str=LOG_ARCHIVE_DIR, encoding: str='utf-8'):
+        self.segment = existing_segment(filename)
+        super().__init__(filename, maxBytes=max_bytes, encoding=encoding)
+        self.max_age = max_age
+        self.archive_dir = archive_dir
+
+    def shouldRollover(self, record: logging.LogRecord) -> bool:
+        if self.segment.start is not None and record.created - self.segment.start >= self.max_age:
+            return True
+        return bool(super().shouldRollover(record))
+
+    def doRollover(self) -> None:
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+
+        archive_file(self.baseFilename, self.segment, self.archive_dir)
+        self.segment = Segment()
+
+        self.stream = self._open()
+
+    def emit(self, record: logging.LogRecord) -> None:
+        super().emit(record)
+        log_type, guild_id = parse_message(record.getMessage())
+        self.segment.add(record.created, log_type, guild_id)
+
+# ---------------------------------------------- Search ----------------------------------------------------------------
+
+def _archives(name: str, archive_dir: str) -> list[tuple[str, dict or None]]:
+    """
+    Returns archives of log name with their index (None if missing), oldest first
+    """
+    if not os.path.isdir(archive_dir):
+        return []
+
+    archives = []
+    for file in os.listdir(archive_dir):
+        if not (file.startswith(f'{name}-') and file.endswith('.log.gz')):
+            continue
+        path = os.path.join(archive_dir, file)
+        try:
+            with open(path + '.idx', encoding='utf-8') as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            index = None
+        archives.append((path, index))
+
+    archives.sort(key=lambda item: (item[1] or {}).get('end') or os.path.getmtime(item[0]))
+    return archives
+
+def _relevant(index: dict or None, guild_id: str or None, since: float or None, until: float or None, log_type: str or None) -> bool:
+    if index is None:
+        return True
+    if since is not None and index.get('end') is not None and index['end'] < since:
+        return False
+    if until is not None and index.get('start') is not None and index['start'] > until:
+        return False
+    if not index.get('complete', True):
+        return True
+    if guild_id is not None and guild_id not in index.get('guilds', []):
+        return False
+    if log_type is not None and log_type not in index.get('types', []):
+        return False
+    return True
+
+def search_logs(path: str='log.log', guild_id: str=None, since: float=None, until: float=None, log_type: str=None, limit: int=100, archive_dir: str=LOG_ARCHIVE_DIR) -> (list[str], int):
+    """
+    Searches the log file and its archives, only archives whose index matches are decompressed
+    :param path: str - live log file
+    :param guild_id: str - guild id to search for
+    :param since: float - timestamp, lines before are skipped
+    :param until: float - timestamp, lines after are skipped
+    :param log_type: str - 'CMD', 'FUNC', 'ERR', ...
+    :param limit: int - max number of lines returned (the newest)
+    :param archive_dir: str
+    :return: (matching lines, number of searched files)
+    """
+    guild_id = str(guild_id) if guild_id is not None else None
+    log_type = log_type.upper() if log_type else None
+
+    files = []
+    name = os.path.splitext(os.path.basename(path))[0]
+    for archive, index in _archives(name, archive_dir):
+        if _relevant(index, guild_id, since, until, log_type):
+            files.append((archive, True))
+    if os.path.exists(path):
+        files.append((path, False))
+
+    found = deque(maxlen=limit)
+    for file, compressed in files:
+        opener = gzip.open if compressed else open
+        with opener(file, 'rt', encoding='utf-8', errors='replace') as f:
+            matched = False
+            for line in f:
+                timestamp, line_type, line_guild = parse_line(line)
+                if timestamp is None:
+                    # continuation of a multi-line record (traceback)
+                    if matched:
+                        found[-1] += '\n' + line.rstrip('\n')
+                    continue
+
+                matched = not (since is not None and timestamp < since
+                               or until is not None and timestamp > until
+                               or log_type is not None and line_type != log_type
+                               or guild_id is not None and line_guild != guild_id)
+                if matched:
+                    found.append(line.rstrip('\n'))
+
+    return list(found), len(files)
@@ -0,0 +1,248 @@
+from __future__ import annotations
+
+from abc import ABC, abstractmethod
+from typing import Callable, Literal
+from time import monotonic
+from bisect import bisect_left
+import asyncio
+
+from utils.cluster import CLUSTER_ID
+
+import config
+
+METRICS_ENABLED = getattr(config, 'METRICS_ENABLED', False)
+METRICS_HOST = getattr(config, 'METRICS_HOST', '127.0.0.1')
+METRICS_PORT = getattr(config, 'METRICS_PORT', 9100) + CLUSTER_ID  # every cluster process serves its own port
+LOOP_LAG_INTERVAL = 1.0  # seconds between event loop lag measurements
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _labels(names: tuple, values: tuple, extra: str='') -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+class Metric(ABC):
+    """Base of all metrics, values are kept per tuple of label values"""
+    type: Literal['counter', 'gauge', 'histogram'] = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple=(), registry: Registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        (registry or REGISTRY).register(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    @abstractmethod
+    def samples(self) -> list[str]:
+        """Returns the exposition lines of all label values"""
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        lines.extend(self.samples())
+        return '\n'.join(lines)
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, value: float=1, **labels) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + value
+
+    def samples(self) -> list[str]:
+        return [f'{self.name}{_labels(self.labelnames, key)} {value}' for key, value in self._values.items()]
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: dict[tuple, float] = {}
+
+    def set(self, value: float, **labels) -> None:
+        self._values[self._key(labels)] = value
+
+    def samples(self) -> list[str]:
+        return [f'{self.name}{_labels(self.labelnames, key)} {value}' for key, value in self._values.items()]
+
+class GaugeFunc(Metric):
+    """
+    Gauge (or counter) whose value is read from a function when scraped
+    The function returns a number, or a dict of {label values tuple: number}
+    """
+    def __init__(self, name: str, documentation: str, func: Callable[[], float or dict], labelnames: tuple=(), metric_type: Literal['counter', 'gauge']='gauge', registry: Registry=None):
+        self.func = func
+        self.type = metric_type
+        super().__init__(name, documentation, labelnames, registry)
+
+    def samples(self) -> list[str]:
+        try:
+            value = self.func()
+        except Exception:
+            return []
+        if value is None:
+            return []
+        if isinstance(value, dict):
+            return [f'{self.name}{_labels(self.labelnames, key if isinstance(key, tuple) else (key,))} {float(v)}' for key, v in value.items()]
+        return [f'{self.name} {float(value)}']
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple=(), buckets: tuple=DEFAULT_BUCKETS, registry: Registry=None):
+        self.buckets = tuple(sorted(buckets))
+        self._values: dict[tuple, list] = {}  # key -> [bucket counts..., sum, count]
+        super().__init__(name, documentation, labelnames, registry)
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        data = self._values.get(key)
+        if data is None:
+            data = [0] * (len(self.buckets) + 2)
+            self._values[key] = data
+
+        index = bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            data[index] += 1
+        data[-2] += value
+        data[-1] += 1
+
+    def samples(self) -> list[str]:
+        lines = []
+        for key, data in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, data):
+                cumulative += count
+                labels = _labels(self.labelnames, key, 'le="%s"' % bound)
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _labels(self.labelnames, key, 'le="+Inf"')
+            lines.append(f'{self.name}_bucket{labels} {data[-1]}')
+            lines.append(f'{self.name}_sum{_labels(self.labelnames, key)} {data[-2]}')
+            lines.append(f'{self.name}_count{_labels(self.labelnames, key)} {data[-1]}')
+        return lines
+
+class Registry:
+    def __init__(self):
+        self._metrics: dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> None:
+        if metric.name in self._metrics:
+            raise ValueError(f'Metric {metric.name} is already registered')
+        self._metrics[metric.name] = metric
+
+    def unregister(self, name: str) -> None:
+        self._metrics.pop(name, None)
+
+    def render(self) -> str:
+        return '\n'.join(metric.render() for metric in self._metrics.values()) + '\n'
+
+REGISTRY = Registry()
+
+# ---------------------------------------------- Metrics ---------------------------------------------------------------
+
+command_total = Counter('bot_commands_total', 'Command invocations', ('command', 'status'))
+command_duration = Histogram('bot_command_duration_seconds', 'Command latency', ('command',))
+extract_duration = Histogram('bot_extract_duration_seconds', 'yt-dlp extract_info duration', ('result',))
+url_check_total = Counter('bot_url_check_total', 'url_checker results', ('status',))
+loop_lag = Histogram('bot_event_loop_lag_seconds', 'Event loop lag', buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0))
+loop_lag_last = Gauge('bot_event_loop_lag_last_seconds', 'Last measured event loop lag')
+
+def count_ffmpeg(bot_class) -> dict:
+    """
+    Returns number of live FFmpeg processes by kind
+    :param bot_class: Bot class
+    :return: dict
+    """
+    from utils.audio_cache import audio_cache
+
+    playback = 0
+    for voice_client in bot_class.voice_clients:
+        source = getattr(voice_client, 'source', None)
+        source = getattr(source, 'original', source)
+        process = getattr(source, '_process', None)
+        if process is not None and process.poll() is None:
+            playback += 1
+
+    return {('playback',): playback, ('cache_fill',): audio_cache.stats()['filling']}
+
+def register_bot_metrics(bot_class) -> None:
+    """
+    Registers metrics that are read from the bot and other modules when scraped
+    :param bot_class: Bot class
+    :return: None
+    """
+    from utils.source import retry_policy, circuit_breakers, stream_cache, stream_flights
+    from utils.extractor import extraction_engine
+    from utils.audio_cache import audio_cache
+
+    states = {'closed': 0, 'half_open': 1, 'open': 2}
+
+    GaugeFunc('bot_voice_clients', 'Active voice clients', lambda: len(bot_class.voice_clients))
+    GaugeFunc('bot_gateway_latency_seconds', 'Gateway latency (bot.latency)', lambda: bot_class.latency if bot_class.latency == bot_class.latency else None)
+    GaugeFunc('bot_ffmpeg_processes', 'Live FFmpeg processes', lambda: count_ffmpeg(bot_class), ('kind',))
+    GaugeFunc('bot_guilds', 'Guilds the bot is in', lambda: len(bot_class.guilds))
+    GaugeFunc('bot_source_retries_total', 'Retried stream resolutions', lambda: retry_policy.retries, metric_type='counter')
+    GaugeFunc('bot_source_exhausted_total', 'Stream resolutions that failed after all retries', lambda: retry_policy.exhausted, metric_type='counter')
+    GaugeFunc('bot_circuit_breaker_state', 'Circuit breaker state (0 closed, 1 half open, 2 open)', lambda: {(name,): states[stats['state']] for name, stats in circuit_breakers.stats().items()}, ('extractor',))
+    GaugeFunc('bot_circuit_breaker_rejected_total', 'Calls rejected by an open circuit breaker', lambda: {(name,): stats['rejected'] for name, stats in circuit_breakers.stats().items()}, ('extractor',), metric_type='counter')
+    GaugeFunc('bot_stream_cache_hits_total', 'Resolved stream cache hits', lambda: stream_cache.hits, metric_type='counter')
+    GaugeFunc('bot_stream_cache_misses_total', 'Resolved stream cache misses', lambda: stream_cache.misses, metric_type='counter')
+    GaugeFunc('bot_stream_flights_coalesced_total', 'Resolutions that joined an in-flight one', lambda: stream_flights.coalesced, metric_type='counter')
+    GaugeFunc('bot_extractor_pending', 'Extraction jobs waiting or running', lambda: extraction_engine.pending)
+    GaugeFunc('bot_audio_cache_bytes', 'Size of the audio cache', lambda: audio_cache.size)
+
+# ---------------------------------------------- Server ----------------------------------------------------------------
+
+class MetricsServer:
+    """
+    Serves REGISTRY on http://METRICS_HOST:METRICS_PORT/metrics from the bot's event loop
+    and measures the event loop lag
+    """
+    def __init__(self, host: str=METRICS_HOST, port: int=METRICS_PORT):
+        self.host = host
+        self.port = port
+        self._runner = None
+        self._lag_task: asyncio.Task or None = None
+
+    async def _handle(self, request):
+        from aiohttp import web
+        return web.Response(text=REGISTRY.render(), content_type='text/plain', charset='utf-8')
+
+    async def _measure_lag(self) -> None:
+        while True:
+            start = monotonic()
+            await asyncio.sleep(LOOP_LAG_INTERVAL)
+            lag = max(0.0, monotonic() - start - LOOP_LAG_INTERVAL)
+            loop_lag.observe(lag)
+            loop_lag_last.set(lag)
+
+    async def start(self) -> None:
+        from aiohttp import web
+
+        app = web.Application()
+        app.router.add_get('/metrics', self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+
+        self._lag_task = asyncio.ensure_future(self._measure_lag())
+
+    async def stop(self) -> None:
+        if self._lag_task is not None:
+            self._lag_task.cancel()
+            self._lag_task = None
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+metrics_server = MetricsServer()
@@ -0,0 +1,306 @@
+from __future__ import annotations
+from classes.data_classes import QueueEntry, QueuePlaylist
+
+from utils.source import GetSource, get_url_expire, record_play
+from utils.extractor import extraction_engine, ExtractionError, ExtractorBusy, ExtractionTimeout
+from utils.sessions import voice_sessions
+from utils.log import log
+from utils.tracing import span
+
+from collections import deque
+from typing import Callable
+from time import time
+import discord
+import contextvars
+import asyncio
+
+import config
+
+QUEUE_MAX_SIZE = 500  # max number of tracks waiting in one guild queue
+PLAYLIST_PAGE_SIZE = max(1, getattr(config, 'PLAYLIST_PAGE_SIZE', 50))  # playlist entries loaded at once
+PLAYLIST_MAX_RETRIES = 5  # pages failing in a row because of an overloaded extractor before the playlist is dropped
+PLAYLIST_RETRY_DELAY = 10  # seconds before play_next tries again when only the playlist is left
+RECONNECT_RETRY_DELAY = 2  # seconds before play_next tries again while the voice client reconnects
+
+class GuildQueue:
+    """
+    Queue of tracks for one guild
+
+    While a track plays, the next one is resolved and validated in the background (prefetch),
+    so the transition between tracks does not wait for extraction.
+
+    A YouTube playlist waits in the queue as one QueuePlaylist, when it reaches the front it is replaced
+    by its next page of tracks (ids and titles only) followed by itself, until the playlist ends (expand).
+    """
+    def __init__(self, guild_id: int):
+        self.guild_id = guild_id
+
+        self.entries: deque[QueueEntry or QueuePlaylist] = deque()
+        self.current: QueueEntry or None = None
+        self.lock = asyncio.Lock()  # held only for the bookkeeping, not while a track loads
+        self.starting: object or None = None  # token of the play_next call loading the next track (see play_next)
+
+        self._prefetch_task: asyncio.Task or None = None
+        self._prefetch_entry: QueueEntry or None = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, entry: QueueEntry or QueuePlaylist) -> int:
+        """
+        Adds entry to the end of the queue
+        :param entry: QueueEntry or QueuePlaylist
+        :return: int - position of the entry (starting with 1)
+        :raises OverflowError: when the queue is full
+        """
+        if len(self.entries) >= QUEUE_MAX_SIZE:
+            raise OverflowError(f'Queue is full ({QUEUE_MAX_SIZE} tracks)')
+
+        self.entries.append(entry)
+        if len(self.entries) == 1 and self.current is not None:
+            self.prefetch()
+        return len(self.entries)
+
+    def remove(self, position: int) -> QueueEntry or QueuePlaylist:
+        """
+        Removes entry at position
+        :param position: int - position of the entry (starting with 1)
+        :return: QueueEntry or QueuePlaylist - removed entry
+        :raises IndexError: when position is out of range
+        """
+        if not 1 <= position <= len(self.entries):
+            raise IndexError(f'Position must be between 1 and {len(self.entries)}')
+
+        entry = self.entries[position - 1]
+        del self.entries[position - 1]
+
+        if isinstance(entry, QueuePlaylist):
+            self._cancel_expand(entry)
+
+        if entry is self._prefetch_entry:
+            self._cancel_prefetch()
+            if self.current is not None:
+                self.prefetch()
+        return entry
+
+    def pop_next(self) -> QueueEntry or QueuePlaylist or None:
+        """
+        Pops the next entry, a QueuePlaylist is returned without popping it (see expand)
+        :return: QueueEntry or QueuePlaylist or None
+        """
+        if not self.entries:
+            return None
+        if isinstance(self.entries[0], QueuePlaylist):
+            return self.entries[0]
+        return self.entries.popleft()
+
+    def clear(self) -> None:
+        """
+        Removes all entries and forgets the current track
+        :return: None
+        """
+        for entry in self.entries:
+            if isinstance(entry, QueuePlaylist):
+                self._cancel_expand(entry)
+        self.entries.clear()
+        self.current = None
+        self.starting = None
+        self._cancel_prefetch()
+
+    @staticmethod
+    def _cancel_expand(playlist: QueuePlaylist) -> None:
+        if playlist.task is not None and not playlist.task.done():
+            playlist.task.cancel()
+        playlist.task = None
+
+    async def _expand(self, playlist: QueuePlaylist) -> bool:
+        """
+        Loads the next page of playlist into the queue, see expand
+        """
+        # the placeholder is replaced in place, leave room for it so the queue does not grow over the limit
+        count = min(PLAYLIST_PAGE_SIZE, QUEUE_MAX_SIZE - len(self.entries))
+        if count < 1:
+            # the page is loaded when tracks behind the playlist were played
+            return False
+
+        try:
+            with span('playlist_page', start=playlist.next_index):
+                page = await extraction_engine.extract_playlist_page(playlist.url, playlist.next_index, count)
+            playlist.failures = 0
+        except (ExtractorBusy, ExtractionTimeout) as e:
+            playlist.failures += 1
+            if playlist.failures <= PLAYLIST_MAX_RETRIES:
+                # keeps the placeholder (and next_index), the page is loaded again later
+                log(self.guild_id, 'Extractor is overloaded, loading the playlist later', options={'url': playlist.url, 'index': playlist.next_index, 'failures': playlist.failures, 'error': e}, log_type='warning')
+                return False
+            log(self.guild_id, 'Failed to load playlist, skipping the rest of it', options={'url': playlist.url, 'index': playlist.next_index, 'error': e}, log_type='error')
+            page = {'title': None, 'entries': [], 'done': True}
+        except ExtractionError as e:
+            log(self.guild_id, 'Failed to load playlist, skipping the rest of it', options={'url': playlist.url, 'index': playlist.next_index, 'error': e}, log_type='error')
+            page = {'title': None, 'entries': [], 'done': True}
+
+        try:
+            index = self.entries.index(playlist)
+        except ValueError:
+            # removed (or the queue was cleared) while the page loaded
+            return True
+
+        playlist.title = playlist.title or page['title']
+        playlist.next_index += count
+
+        tracks = []
+        for item in page['entries']:
+            if item['id'] == playlist.skip_id:
+                playlist.skip_id = None
+                continue
+            entry = QueueEntry(item['url'], playlist.author)
+            entry.title = item['title']
+            entry.duration = item['duration']
+            tracks.append(entry)
+        if not page['done']:
+            tracks.append(playlist)
+
+        self.entries.rotate(-index)
+        self.entries.popleft()
+        self.entries.extendleft(reversed(tracks))
+        self.entries.rotate(index)
+        return True
+
+    async def expand(self, playlist: QueuePlaylist) -> bool:
+        """
+        Replaces playlist with its next page of tracks, followed by playlist if it has more entries
+        Waits for the page when it is already loading in the background (started by prefetch)
+
+        :param playlist: QueuePlaylist - entry returned by pop_next
+        :return: bool - False when the page can not be loaded now (overloaded extractor or full queue),
+                 the playlist stays in the queue, True otherwise (the playlist is removed when it ends or fails to load)
+        """
+        if playlist.task is None or playlist.task.done():
+            playlist.task = asyncio.get_running_loop().create_task(self._expand(playlist))
+        task = playlist.task
+        await asyncio.wait({task})
+        if task.cancelled():
+            return True
+        if task.exception() is not None:
+            log(self.guild_id, 'Loading of playlist failed', options={'error': task.exception()}, log_type='warning')
+            self._cancel_expand(playlist)
+            if playlist in self.entries:
+                self.entries.remove(playlist)
+            return True
+        return task.result()
+
+    def pop_after(self, playlist: QueuePlaylist) -> QueueEntry or None:
+        """
+        Pops the first track behind playlist, played while the playlist can not be loaded
+        :param playlist: QueuePlaylist - entry at the front of the queue
+        :return: QueueEntry or None
+        """
+        for index, entry in enumerate(self.entries):
+            if entry is not playlist and not isinstance(entry, QueuePlaylist):
+                del self.entries[index]
+                return entry
+        return None
+
+    def _done_expand(self, task: asyncio.Task) -> None:
+        if task.cancelled():
+            return
+        error = task.exception()
+        if error is not None:
+            log(self.guild_id, 'Loading of playlist failed', options={'error': error}, log_type='warning')
+        elif task.result() and self.current is not None:
+            # prefetch the first track of the page (a page that could not be loaded is tried again by the next prefetch)
+            self.prefetch()
+
+    def _cancel_prefetch(self) -> None:
+        if self._prefetch_task is not None and not self._prefetch_task.done():
+            self._prefetch_task.cancel()
+        self._prefetch_task = None
+        self._prefetch_entry = None
+
+    def connected(self) -> bool:
+        """
+        Returns False when the bot left the voice channel of the guild (stops extractions of a prefetch)
+        """
+        return voice_sessions.get(self.guild_id) is not None
+
+    async def _resolve(self, entry: QueueEntry, alive: Callable[[], bool]=None) -> None:
+        entry.data = await GetSource.resolve(self.guild_id, entry.url, alive)
+        entry.title = entry.data.get('title')
+        entry.duration = entry.data.get('duration')
+
+    def _done_prefetch(self, task: asyncio.Task) -> None:
+        if task.cancelled():
+            return
+        error = task.exception()
+        if error is not None:
+            log(self.guild_id, 'Prefetch failed', options={'error': error}, log_type='warning')
+
+    def prefetch(self) -> None:
+        """
+        Starts resolving the next entry in the background
+        :return: None
+        """
+        if not self.entries:
+            return
+
+        entry = self.entries[0]
+        if isinstance(entry, QueuePlaylist):
+            if entry.task is None or entry.task.done():
+                # the prefetch is not part of the trace of the current request
+                entry.task = asyncio.get_running_loop().create_task(self._expand(entry), context=contextvars.Context())
+                entry.task.add_done_callback(self._done_expand)
+            return
+
+        if entry is self._prefetch_entry or entry.data is not None:
+            return
+
+        self._cancel_prefetch()
+        self._prefetch_entry = entry
+        # the prefetch is not part of the trace of the current request
+        self._prefetch_task = asyncio.get_running_loop().create_task(self._resolve(entry, self.connected), context=contextvars.Context())
+        self._prefetch_task.add_done_callback(self._done_prefetch)
+
+    async def take_source(self, entry: QueueEntry, volume: float=1.0, alive: Callable[[], bool]=None) -> discord.AudioSource:
+        """
+        Returns source of entry, uses the prefetched data if available
+        :param entry: QueueEntry - entry that was just popped from the queue
+        :param volume: float - volume of the guild session
+        :param alive: callable - returns False when the track is no longer wanted (cancels extraction)
+        :return: discord.AudioSource
+        """
+        if entry is self._prefetch_entry:
+            task = self._prefetch_task
+            self._prefetch_task = None
+            self._prefetch_entry = None
+            with span('prefetch_wait'):
+                await asyncio.wait({task})
+            if task.cancelled() or task.exception() is not None:
+                # the error was already logged, try again below
+                entry.data = None
+
+        if entry.data is not None:
+            expire = get_url_expire(entry.data['url'])
+            if expire is not None and expire <= time():
+                entry.data = None
+
+        if entry.data is None:
+            with span('resolve'):
+                await self._resolve(entry, alive)
+
+        record_play(entry.url, entry.data)
+        with span('ffmpeg_spawn', local=bool(entry.data.get('local'))):
+            return GetSource.from_data(self.guild_id, entry.data, volume=volume)
+
+guild_queues: dict[int, GuildQueue] = {}
+
+def get_queue(guild_id: int) -> GuildQueue:
+    """
+    Returns queue of guild (creates it if needed)
+    :param guild_id: int
+    :return: GuildQueue
+    """
+    queue = guild_queues.get(guild_id)
+    if queue is None:
+        queue = GuildQueue(guild_id)
+        guild_queues[guild_id] = queue
+    return queue
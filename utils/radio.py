@@ -0,0 +1,391 @@
+from __future__ import annotations
+from classes.typed_dictionaries import RadioInfoDict, RadioGardenInfo, RadioGardenChannel, TuneInDescribe, RadiosJSON
+
+from utils.http import get_session
+from utils.log import log
+
+from contextlib import contextmanager
+from urllib.parse import urlparse
+from time import time
+import asyncio
+import json
+import os
+
+try:
+    import fcntl
+except ImportError:  # Windows, the clusters are not supported there anyway
+    fcntl = None
+
+import config
+
+RADIO_GARDEN_API = getattr(config, 'RADIO_GARDEN_API', 'https://radio.garden/api')
+TUNEIN_API = getattr(config, 'TUNEIN_API', 'https://opml.radiotime.com')
+RADIA_CZ_RADIOS_URL = getattr(config, 'RADIA_CZ_RADIOS_URL', 'https://www.radia.cz/api/v1/radios.json')
+
+RADIO_CATALOGUE_PATH = getattr(config, 'RADIO_CATALOGUE_PATH', 'db/radio_catalogue.json')
+RADIO_CATALOGUE_TTL = getattr(config, 'RADIO_CATALOGUE_TTL', 86400)  # seconds before a station is refreshed
+RADIO_CATALOGUE_REFRESH_INTERVAL = 3600  # seconds between refreshes of the stale stations
+RADIO_CATALOGUE_REFRESH_DELAY = 1  # seconds between requests of one refresh
+
+RADIO_TYPES = {'RadioGarden': 'garden', 'RadioTuneIn': 'tunein', 'RadioCz': 'radia_cz'}  # url type -> station type
+
+class RadioError(Exception):
+    """The station does not exist or its API returned something unexpected"""
+
+# ----------------------------------------------- radio.garden ---------------------------------------------------------
+
+def radio_garden_id(url: str) -> str:
+    """
+    Returns channel id of a radio.garden url
+    https://radio.garden/listen/kutx-98-9/vbFsCngB => vbFsCngB
+
+    :param url: str - radio.garden url
+    :return: str - channel id
+    :raises RadioError: when url is not a station url
+    """
+    parts = [part for part in urlparse(url).path.split('/') if part]
+    if len(parts) < 2 or parts[0] != 'listen':
+        raise RadioError(f'`{url}` is not a radio.garden station')
+    return parts[-1]
+
+async def get_radio_garden(channel_id: str) -> RadioGardenInfo:
+    """
+    Returns info of a radio.garden channel
+    :param channel_id: str
+    :return: RadioGardenInfo
+    """
+    async with get_session().get(f'{RADIO_GARDEN_API}/ara/content/channel/{channel_id}') as response:
+        if response.status == 404:
+            raise RadioError(f'radio.garden station `{channel_id}` does not exist')
+        response.raise_for_status()
+        channel: RadioGardenChannel = await response.json(content_type=None)
+
+    data = channel['data']
+    return {'id': data['id'], 'title': data['title'], 'url': data['url'], 'website': data.get('website'),
+            # redirects to the stream of the station
+            'stream': f'{RADIO_GARDEN_API}/ara/content/listen/{data["id"]}/channel.mp3',
+            'place': data.get('place'), 'country': data.get('country')}
+
+async def fetch_radio_garden(channel_id: str) -> RadioInfoDict:
+    info = await get_radio_garden(channel_id)
+    return {'type': 'garden', 'id': channel_id, 'station_name': info['title'], 'station_picture': None, 'station_website': info['website'],
+            'now_title': None, 'now_artist': None, 'now_picture': None,
+            'url': f"https://radio.garden{info['url']}", 'stream': info['stream'], 'last_update': None}
+
+# ----------------------------------------------- TuneIn ---------------------------------------------------------------
+
+async def _tunein_body(endpoint: str, guide_id: str) -> list[dict]:
+    async with get_session().get(f'{TUNEIN_API}/{endpoint}', params={'id': guide_id, 'render': 'json'}) as response:
+        response.raise_for_status()
+        data = await response.json(content_type=None)
+
+    status = str(data.get('head', {}).get('status', '200'))
+    if status != '200':
+        raise RadioError(f"TuneIn station `{guide_id}`: {data['head'].get('fault', status)}")
+    return data.get('body') or []
+
+async def fetch_tunein(guide_id: str) -> RadioInfoDict:
+    describe, tune = await asyncio.gather(_tunein_body('Describe.ashx', guide_id), _tunein_body('Tune.ashx', guide_id))
+    if not describe or not tune:
+        raise RadioError(f'TuneIn station `{guide_id}` does not exist or has no stream')
+
+    station: TuneInDescribe = describe[0]
+    # playlists (is_direct=False) can not be played by FFmpeg when a direct stream exists
+    streams = sorted(tune, key=lambda item: (not item.get('is_direct', True), -int(item.get('bitrate') or 0)))
+
+    return {'type': 'tunein', 'id': guide_id, 'station_name': station.get('name') or guide_id, 'station_picture': station.get('logo'), 'station_website': station.get('url') or None,
+            'now_title': None, 'now_artist': None, 'now_picture': None,
+            'url': station.get('tunein_url') or f'{TUNEIN_API}/Tune.ashx?id={guide_id}', 'stream': streams[0]['url'], 'last_update': None}
+
+# ----------------------------------------------- radia.cz -------------------------------------------------------------
+
+def radia_cz_stream(station: RadiosJSON) -> str or None:
+    """
+    Returns the best stream of a radia.cz station (mp3 preferred, then the highest bitrate)
+    :param station: RadiosJSON
+    :return: str - stream url or None
+    """
+    streams = (station.get('streams') or {}).get('stream') or []
+    if isinstance(streams, dict):
+        streams = [streams]
+    if not streams:
+        return None
+
+    best = max(streams, key=lambda stream: (stream.get('type') == 'mp3', stream.get('defWifi') == '1', int(stream.get('bitrate') or 0)))
+    return best['url']
+
+async def fetch_radia_cz() -> list[RadioInfoDict]:
+    """
+    Returns all stations of radia.cz (one request)
+    :return: list[RadioInfoDict]
+    """
+    async with get_session().get(RADIA_CZ_RADIOS_URL) as response:
+        response.raise_for_status()
+        data = await response.json(content_type=None)
+
+    # the document is converted from XML, a single station is not wrapped in a list
+    if isinstance(data, dict):
+        data = (data.get('radios') or data).get('radio') or []
+    if isinstance(data, dict):
+        data = [data]
+
+    stations = []
+    for station in data:
+        station: RadiosJSON
+        stream = radia_cz_stream(station)
+        if stream is None:
+            continue
+        stations.append({'type': 'radia_cz', 'id': str(station['id']), 'station_name': station['name'], 'station_picture': station.get('logo'), 'station_website': station.get('link'),
+                         'now_title': None, 'now_artist': None, 'now_picture': None,
+                         'url': station.get('nowplay'), 'stream': stream, 'last_update': None})
+    return stations
+
+# ----------------------------------------------- Catalogue ------------------------------------------------------------
+
+@contextmanager
+def file_lock(path: str):
+    """
+    Exclusive lock of path shared by all processes (no-op without fcntl)
+    """
+    with open(path, 'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+def merge_stations(into: dict[str, tuple[float, RadioInfoDict]], stations: dict[str, tuple[float, RadioInfoDict]]) -> None:
+    """
+    Adds stations to into, the newer one wins when both contain a station
+    """
+    for key, item in stations.items():
+        current = into.get(key)
+        if current is None or current[0] < item[0]:
+            into[key] = item
+
+class RadioCatalogue:
+    """
+    On-disk catalogue of radio stations keyed by '{type}:{id}'
+
+    Stations are fetched once and then served from memory (and from the file after a restart),
+    a station is never fetched again while it is in the catalogue. The refresh task updates
+    stations older than the ttl in the background, a station that fails to refresh is kept.
+    radia.cz publishes all stations in one document, so they are always fetched and refreshed together.
+
+    The clusters share the file: it is read, merged and replaced under a file lock (in a thread),
+    and a miss looks into the file before fetching, so a station fetched by one cluster is reused by the others.
+    """
+    def __init__(self, path: str=RADIO_CATALOGUE_PATH, ttl: float=RADIO_CATALOGUE_TTL):
+        self.path = path
+        self.ttl = ttl
+
+        self._stations: dict[str, tuple[float, RadioInfoDict]] or None = None  # key -> (fetched at, station)
+        self._flights: dict[str, asyncio.Task] = {}
+        self._task: asyncio.Task or None = None
+        self._save_lock: asyncio.Lock or None = None
+
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.errors = 0
+
+    def __len__(self):
+        return len(self.stations)
+
+    @property
+    def stations(self) -> dict[str, tuple[float, RadioInfoDict]]:
+        if self._stations is None:
+            self._stations = self._load()
+        return self._stations
+
+    def _load(self) -> dict[str, tuple[float, RadioInfoDict]]:
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return {key: (item['fetched_at'], item['station']) for key, item in data.get('stations', {}).items()}
+
+    def _merge_file(self, stations: dict[str, tuple[float, RadioInfoDict]] or None) -> dict[str, tuple[float, RadioInfoDict]]:
+        """
+        Merges stations into the file (written atomically) and returns its content, runs in a thread
+        :param stations: stations to write or None to only read the file
+        """
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        with file_lock(f'{self.path}.lock'):
+            merged = self._load()
+            if stations:
+                merge_stations(merged, stations)
+                temp_path = f'{self.path}.{os.getpid()}.tmp'
+                with open(temp_path, 'w', encoding='utf-8') as f:
+                    json.dump({'stations': {key: {'fetched_at': fetched_at, 'station': station} for key, (fetched_at, station) in merged.items()}}, f)
+                os.replace(temp_path, self.path)
+        return merged
+
+    async def _sync(self, stations: dict[str, tuple[float, RadioInfoDict]] or None=None) -> None:
+        """
+        Writes stations to the file and takes over the stations of the other clusters
+        """
+        if self._save_lock is None:
+            self._save_lock = asyncio.Lock()
+        try:
+            async with self._save_lock:
+                merged = await asyncio.to_thread(self._merge_file, stations)
+        except OSError as e:
+            log(None, 'Failed to sync radio catalogue', options={'path': self.path, 'error': e}, log_type='warning')
+            return
+        merge_stations(self.stations, merged)
+
+    async def _put(self, stations: list[RadioInfoDict]) -> None:
+        now = time()
+        items = {f"{station['type']}:{station['id']}": (now, station) for station in stations}
+        self.stations.update(items)
+        await self._sync(items)
+
+    async def _fetch(self, station_type: str, station_id: str) -> None:
+        if station_type == 'garden':
+            await self._put([await fetch_radio_garden(station_id)])
+        elif station_type == 'tunein':
+            await self._put([await fetch_tunein(station_id)])
+        elif station_type == 'radia_cz':
+            await self._put(await fetch_radia_cz())
+        else:
+            raise RadioError(f'Unknown station type `{station_type}`')
+
+    async def fetch(self, station_type: str, station_id: str) -> None:
+        """
+        Fetches station from its API into the catalogue, concurrent fetches of the same station share one request
+        """
+        # one document contains every radia.cz station
+        key = 'radia_cz:*' if station_type == 'radia_cz' else f'{station_type}:{station_id}'
+        task = self._flights.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch(station_type, station_id))
+            self._flights[key] = task
+            task.add_done_callback(lambda done: self._done(key, done))
+        await asyncio.shield(task)
+
+    def _done(self, key: str, task: asyncio.Task) -> None:
+        if self._flights.get(key) is task:
+            del self._flights[key]
+        if not task.cancelled():
+            # mark the exception as retrieved when nobody is waiting anymore
+            task.exception()
+
+    async def get(self, station_type: str, station_id: str) -> RadioInfoDict:
+        """
+        Returns station from the catalogue, fetches it on the first lookup
+
+        :param station_type: str - 'garden', 'tunein' or 'radia_cz'
+        :param station_id: str - id of the station
+        :return: RadioInfoDict
+        :raises RadioError: when the station does not exist
+        :raises aiohttp.ClientError: when the API is not reachable
+        """
+        key = f'{station_type}:{station_id}'
+        item = self.stations.get(key)
+        if item is not None:
+            self.hits += 1
+            return item[1]
+
+        self.misses += 1
+        # fetched by another cluster
+        await self._sync()
+        item = self.stations.get(key)
+        if item is not None:
+            return item[1]
+
+        if station_type == 'radia_cz' and self._radia_cz_fresh():
+            # the list is complete, an unknown id does not need another request
+            raise RadioError(f'Station `{station_id}` does not exist')
+        await self.fetch(station_type, station_id)
+
+        item = self.stations.get(key)
+        if item is None:
+            raise RadioError(f'Station `{station_id}` does not exist')
+        return item[1]
+
+    def _radia_cz_fresh(self) -> bool:
+        deadline = time() - self.ttl
+        return any(fetched_at > deadline for key, (fetched_at, _) in self.stations.items() if key.startswith('radia_cz:'))
+
+    async def refresh(self) -> int:
+        """
+        Fetches stations older than the ttl again
+        :return: int - number of refreshed stations
+        """
+        deadline = time() - self.ttl
+        stale = [station for fetched_at, station in list(self.stations.values()) if fetched_at <= deadline]
+
+        refreshed = 0
+        radia_cz = False
+        for station in stale:
+            if station['type'] == 'radia_cz':
+                if radia_cz:
+                    continue
+                radia_cz = True
+            try:
+                await self.fetch(station['type'], station['id'])
+                refreshed += 1
+            except Exception as e:
+                self.errors += 1
+                log(None, 'Failed to refresh radio station', options={'type': station['type'], 'id': station['id'], 'error': e}, log_type='warning')
+            await asyncio.sleep(RADIO_CATALOGUE_REFRESH_DELAY)
+
+        self.refreshes += refreshed
+        return refreshed
+
+    async def _run(self) -> None:
+        while True:
+            await self.refresh()
+            await asyncio.sleep(RADIO_CATALOGUE_REFRESH_INTERVAL)
+
+    def start(self) -> None:
+        """
+        Starts the refresh task
+        :return: None
+        """
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def stats(self) -> dict:
+        return {'size': len(self), 'hits': self.hits, 'misses': self.misses, 'refreshes': self.refreshes, 'errors': self.errors}
+
+radio_catalogue = RadioCatalogue()
+
+async def get_station(url_type: str, url: str) -> RadioInfoDict:
+    """
+    Returns station of a radio input of the user
+
+    'RadioGarden' - radio.garden station url
+    'RadioTuneIn' - '_tunein:{guide id}'
+    'RadioCz' - '_radia_cz:{radia.cz id}'
+
+    :param url_type: str - type returned by utils.url.classify_url
+    :param url: str - url returned by utils.url.classify_url
+    :return: RadioInfoDict with 'stream'
+    :raises RadioError: when the station does not exist
+    :raises aiohttp.ClientError: when the API is not reachable
+    """
+    station_type = RADIO_TYPES.get(url_type)
+    if station_type is None:
+        raise RadioError(f'`{url}` is not a radio station')
+
+    if station_type == 'garden':
+        station_id = radio_garden_id(url)
+    else:
+        station_id = url.split(':', 1)[1].strip()
+        if not station_id:
+            raise RadioError(f'`{url}` is missing the station id')
+
+    return await radio_catalogue.get(station_type, station_id)
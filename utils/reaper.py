@@ -0,0 +1,123 @@
+from __future__ import annotations
+from utils.queue import get_queue
+from utils.sessions import voice_sessions
+from utils.log import log
+
+from time import monotonic
+import asyncio
+import heapq
+
+IDLE_TIMEOUT = 30  # seconds of inactivity before the bot leaves the voice channel
+
+class IdleReaper:
+    """
+    Disconnects idle voice clients
+
+    One task keeps a heap of (deadline, guild_id). Playback events reset the deadline of a guild (touch),
+    stale heap entries are skipped when popped. When a deadline expires and the guild is still not playing,
+    the voice client is disconnected exactly once.
+    """
+    def __init__(self, timeout: float=IDLE_TIMEOUT):
+        self.timeout = timeout
+
+        self._heap: list[tuple[float, int]] = []
+        self._deadlines: dict[int, float] = {}
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task or None = None
+        self._bot = None
+
+        self.disconnects = 0
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def start(self, bot_class) -> None:
+        """
+        Starts the reaper task
+        :param bot_class: Bot class
+        :return: None
+        """
+        self._bot = bot_class
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def touch(self, guild_id: int, timeout: float=None) -> None:
+        """
+        Resets the idle deadline of guild
+        :param guild_id: int
+        :param timeout: float - seconds from now (default: reaper timeout)
+        :return: None
+        """
+        deadline = monotonic() + (self.timeout if timeout is None else timeout)
+        wake = not self._heap or deadline < self._heap[0][0]
+
+        self._deadlines[guild_id] = deadline
+        heapq.heappush(self._heap, (deadline, guild_id))
+
+        # drop stale entries when the heap grows too much
+        if len(self._heap) > 2 * len(self._deadlines) + 64:
+            self._heap = [(d, g) for g, d in self._deadlines.items()]
+            heapq.heapify(self._heap)
+
+        if wake:
+            self._wakeup.set()
+
+    def forget(self, guild_id: int) -> None:
+        """
+        Removes guild from the reaper (e.g. after disconnect)
+        :param guild_id: int
+        :return: None
+        """
+        self._deadlines.pop(guild_id, None)
+
+    def _pop_expired(self) -> list[int]:
+        now = monotonic()
+        expired = []
+        while self._heap and self._heap[0][0] <= now:
+            deadline, guild_id = heapq.heappop(self._heap)
+            if self._deadlines.get(guild_id) == deadline:
+                del self._deadlines[guild_id]
+                expired.append(guild_id)
+        return expired
+
+    async def _run(self) -> None:
+        while True:
+            self._wakeup.clear()
+            timeout = max(0.0, self._heap[0][0] - monotonic()) if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+            for guild_id in self._pop_expired():
+                try:
+                    await self._expire(guild_id)
+                except Exception as e:
+                    log(guild_id, 'Idle reaper failed', options={'error': e}, log_type='error')
+
+    async def _expire(self, guild_id: int) -> None:
+        voice = voice_sessions.voice(guild_id)
+        if voice is None:
+            return
+
+        if voice.is_playing() and not voice.is_paused():
+            self.touch(guild_id)
+            return
+
+        get_queue(guild_id).clear()
+        voice.stop()
+        await voice.disconnect()
+        voice_sessions.unregister(guild_id)
+        self.disconnects += 1
+
+        log(guild_id, f"-->> Disconnecting after {self.timeout} seconds of inactivity <<--")
+
+    def stats(self) -> dict:
+        return {'guilds': len(self._deadlines), 'heap': len(self._heap), 'disconnects': self.disconnects}
+
+idle_reaper = IdleReaper()
@@ -0,0 +1,133 @@
+from __future__ import annotations
+
+from typing import Literal
+from time import monotonic
+import random
+
+class CircuitOpen(Exception):
+    """Calls are rejected because the circuit breaker is open"""
+
+class RetryPolicy:
+    """
+    Exponential backoff with full jitter
+
+    delay(attempt) = random(0, min(max_delay, base_delay * 2 ** attempt))
+    """
+    def __init__(self, attempts: int=4, base_delay: float=0.5, max_delay: float=8.0):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self.calls = 0
+        self.retries = 0
+        self.exhausted = 0
+
+    def delay(self, attempt: int) -> float:
+        """
+        Returns how long to wait before the next attempt
+        :param attempt: int - number of the failed attempt (starting with 0)
+        :return: float - seconds
+        """
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def record_call(self) -> None:
+        self.calls += 1
+
+    def retry(self, attempt: int) -> float:
+        """
+        Counts a retry and returns how long to wait before it
+        :param attempt: int - number of the retry (starting with 1)
+        :return: float - seconds
+        """
+        self.retries += 1
+        return self.delay(attempt - 1)
+
+    def record_exhausted(self) -> None:
+        self.exhausted += 1
+
+    def stats(self) -> dict:
+        return {'attempts': self.attempts, 'calls': self.calls, 'retries': self.retries, 'exhausted': self.exhausted}
+
+class CircuitBreaker:
+    """
+    Circuit breaker for one extractor
+
+    'closed' - calls pass, consecutive failures are counted
+    'open' - calls are rejected until reset_timeout passes
+    'half_open' - one trial call passes, its result closes or reopens the circuit
+                  (a trial that ends without a result is released, so the next call becomes the trial)
+    """
+    def __init__(self, name: str, failure_threshold: int=5, reset_timeout: float=30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self.failures = 0
+        self.opened_at: float or None = None
+        self._trial = False
+
+        self.opened = 0
+        self.rejected = 0
+
+    @property
+    def state(self) -> Literal['closed', 'open', 'half_open']:
+        if self.opened_at is None:
+            return 'closed'
+        if monotonic() - self.opened_at >= self.reset_timeout:
+            return 'half_open'
+        return 'open'
+
+    def check(self) -> bool:
+        """
+        Raises CircuitOpen if a call is not allowed right now
+        :return: bool - True if the call is the half-open trial (release it with release_trial when it ends)
+        """
+        state = self.state
+        if state == 'closed':
+            return False
+        if state == 'half_open' and not self._trial:
+            self._trial = True
+            return True
+
+        self.rejected += 1
+        retry_in = max(0, round(self.reset_timeout - (monotonic() - self.opened_at)))
+        raise CircuitOpen(f'{self.name} is failing, not trying again for {retry_in}s')
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+
+    def release_trial(self) -> None:
+        """
+        Ends the trial call without a result (cancelled or not recorded), lets another call try
+        """
+        self._trial = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self._trial or self.failures >= self.failure_threshold:
+            if self.opened_at is None or self._trial:
+                self.opened += 1
+            self.opened_at = monotonic()
+            self._trial = False
+
+    def stats(self) -> dict:
+        return {'state': self.state, 'failures': self.failures, 'opened': self.opened, 'rejected': self.rejected}
+
+class CircuitBreakers:
+    """Circuit breakers created on demand by name"""
+    def __init__(self, failure_threshold: int=5, reset_timeout: float=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._breakers: dict[str, CircuitBreaker] = {}
+
+    def get(self, name: str) -> CircuitBreaker:
+        breaker = self._breakers.get(name)
+        if breaker is None:
+            breaker = CircuitBreaker(name, self.failure_threshold, self.reset_timeout)
+            self._breakers[name] = breaker
+        return breaker
+
+    def stats(self) -> dict:
+        return {name: breaker.stats() for name, breaker in self._breakers.items()}
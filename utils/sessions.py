@@ -0,0 +1,105 @@
+from __future__ import annotations
+
+from time import time
+import discord
+
+class VoiceSession:
+    """
+    Voice connection of one guild and its playback state
+
+    :param guild_id: int
+    :param voice_client: discord.VoiceClient of the guild
+    """
+    def __init__(self, guild_id: int, voice_client: discord.VoiceClient):
+        self.guild_id = guild_id
+        self.voice_client = voice_client
+
+        self.source: discord.AudioSource or None = None  # currently playing source
+        self.started_at: float or None = None  # time() when the source started playing
+        self.paused_at: float or None = None
+        self.volume = 1.0
+
+    @property
+    def connected(self) -> bool:
+        return self.voice_client.is_connected()
+
+    def playing(self, source: discord.AudioSource) -> None:
+        """
+        Records that source started playing
+        """
+        self.source = source
+        self.started_at = time()
+        self.paused_at = None
+
+    def paused(self) -> None:
+        if self.paused_at is None:
+            self.paused_at = time()
+
+    def resumed(self) -> None:
+        if self.paused_at is not None and self.started_at is not None:
+            # the paused time does not count into the position
+            self.started_at += time() - self.paused_at
+        self.paused_at = None
+
+    def stopped(self) -> None:
+        self.source = None
+        self.started_at = None
+        self.paused_at = None
+
+    def position(self) -> float or None:
+        """
+        Returns seconds played of the current source or None if nothing is playing
+        """
+        if self.started_at is None:
+            return None
+        return (self.paused_at or time()) - self.started_at
+
+class VoiceSessions:
+    """
+    Registry of voice sessions keyed by guild id, the single source of truth for voice clients
+
+    Updated when the bot connects (join_def, on_voice_state_update) and disconnects (disconnect_def,
+    on_voice_state_update, idle reaper). A session is returned until it is unregistered, also while its voice client
+    reconnects (check VoiceSession.connected before playing).
+    """
+    def __init__(self):
+        self._sessions: dict[int, VoiceSession] = {}
+
+    def register(self, guild_id: int, voice_client: discord.VoiceClient) -> VoiceSession:
+        """
+        Registers voice_client of guild, keeps the playback state if the client did not change
+        :param guild_id: int
+        :param voice_client: discord.VoiceClient
+        :return: VoiceSession
+        """
+        session = self._sessions.get(guild_id)
+        if session is None or session.voice_client is not voice_client:
+            session = VoiceSession(guild_id, voice_client)
+            self._sessions[guild_id] = session
+        return session
+
+    def unregister(self, guild_id: int) -> VoiceSession or None:
+        return self._sessions.pop(guild_id, None)
+
+    def get(self, guild_id: int) -> VoiceSession or None:
+        """
+        Returns session of guild or None when the bot is not in a voice channel
+        :param guild_id: int
+        :return: VoiceSession or None
+        """
+        return self._sessions.get(guild_id)
+
+    def voice(self, guild_id: int) -> discord.VoiceClient or None:
+        """
+        Returns voice client of guild (it may be reconnecting) or None
+        """
+        session = self.get(guild_id)
+        return session.voice_client if session else None
+
+    def sessions(self) -> list[VoiceSession]:
+        return list(self._sessions.values())
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+voice_sessions = VoiceSessions()
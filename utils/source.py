@@ -1,49 +1,421 @@
 from __future__ import annotations
 from utils.log import log
+from utils.url import extract_yt_id
+from utils.http import get_session
+from utils.extractor import extraction_engine, ExtractionError, ExtractionCancelled
+from utils.retry import RetryPolicy, CircuitBreakers, CircuitOpen
+from utils.audio_cache import audio_cache
+from utils.metrics import url_check_total
+from utils.tracing import span
+
+from collections import OrderedDict
+from urllib.parse import urlparse, parse_qs
+from typing import Literal, Callable, Awaitable
+from time import time
 import discord
 import asyncio
-import yt_dlp
-import aiohttp
-
-YTDL_OPTIONS = {
-    'format': 'bestaudio/best',
-    'extractaudio': True,
-    'audioformat': 'mp3',
-    'outtmpl': '%(extractor)s-%(id)s-%(title)s.%(ext)s',
-    'restrictfilenames': True,
-    'noplaylist': True,
-    'nocheckcertificate': True,
-    'ignoreerrors': False,
-    'logtostderr': False,
-    'quiet': True,
-    'no_warnings': True,
-    'default_search': 'auto',
-    'source_address': '0.0.0.0',
-}
+
+import config
 
 FFMPEG_OPTIONS = {
     'before_options': '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5',
     'options': '-vn',
 }
 
-async def url_checker(url):
+STREAM_CACHE_SIZE = 256  # max number of resolved streams kept in memory
+STREAM_CACHE_MARGIN = 300  # seconds before 'expire' when an entry is considered stale
+STREAM_CACHE_DEFAULT_TTL = 1800  # seconds to keep an entry whose url has no 'expire' parameter
+
+def get_url_expire(url: str) -> int or None:
+    """
+    Returns the expiration timestamp embedded in a media url
+    googlevideo urls contain 'expire=<epoch>' either as a query parameter or as a path segment
+    :param url: str - media url
+    :return: int - epoch timestamp or None if not found
+    """
+    try:
+        parsed = urlparse(url)
+    except ValueError:
+        return None
+
+    expire = parse_qs(parsed.query).get('expire')
+    if expire:
+        value = expire[0]
+    else:
+        # /videoplayback/expire/1700000000/ei/...
+        parts = parsed.path.split('/')
+        if 'expire' not in parts or parts.index('expire') + 1 >= len(parts):
+            return None
+        value = parts[parts.index('expire') + 1]
+
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+class StreamCache:
+    """
+    LRU cache of resolved streams keyed by YouTube video id
+
+    Stores the resolved media url together with its format metadata.
+    Each entry expires from the 'expire' parameter of the media url.
+    """
+    def __init__(self, max_size: int=STREAM_CACHE_SIZE, margin: int=STREAM_CACHE_MARGIN, default_ttl: int=STREAM_CACHE_DEFAULT_TTL):
+        self.max_size = max_size
+        self.margin = margin
+        self.default_ttl = default_ttl
+
+        self._data: OrderedDict[str, tuple[int, dict]] = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key: str) -> dict or None:
+        """
+        Returns cached data for key or None if missing or expired
+        :param key: str - video id
+        :return: dict or None
+        """
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        expires_at, data = entry
+        if expires_at <= time():
+            del self._data[key]
+            self.misses += 1
+            return None
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return data
+
+    def put(self, key: str, data: dict) -> None:
+        """
+        Stores data for key, expiration is taken from data['url']
+        :param key: str - video id
+        :param data: dict - extracted info (must contain 'url')
+        :return: None
+        """
+        expire = get_url_expire(data.get('url', ''))
+        if expire is None:
+            expires_at = int(time()) + self.default_ttl
+        else:
+            expires_at = expire - self.margin
+
+        if expires_at <= time():
+            return
+
+        self._data[key] = (expires_at, data)
+        self._data.move_to_end(key)
+
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key: str) -> None:
+        self._data.pop(key, None)
+
+    def stats(self) -> dict:
+        return {'size': len(self._data), 'max_size': self.max_size, 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+stream_cache = StreamCache()
+
+PLAYBACK_MODE = getattr(config, 'PLAYBACK_MODE', 'opus')  # 'opus' (copy Opus streams when possible) | 'pcm'
+
+URL_CHECK_METHOD = 'range'  # 'range' | 'head' | 'get'
+
+async def url_checker(url, method: Literal['range', 'head', 'get']=URL_CHECK_METHOD):
+    """
+    Checks if url is reachable using the shared session
+    'range' requests only the first byte, 'head' requests only headers, 'get' requests the whole response
+    :param url: str - url to check
+    :param method: ('range', 'head', 'get') - how to check the url
+    :return: (bool, status code or exception)
+    """
+    if method not in ('range', 'head', 'get'):
+        raise ValueError('Wrong method')
+
+    session = get_session()
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as response:
-                if response.status == 200:
-                    return True, response.status
-                return False, response.status
+        match method:
+            case 'range':
+                request = session.get(url, headers={'Range': 'bytes=0-0'})
+            case 'head':
+                request = session.head(url, allow_redirects=True)
+            case _:
+                request = session.get(url)
+
+        async with request as response:
+            url_check_total.inc(status=response.status)
+            if response.status in (200, 206):
+                return True, response.status
+            return False, response.status
     except Exception as e:
+        url_check_total.inc(status=type(e).__name__)
         return False, e
 
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key into one running task
+
+    The first caller starts the task, later callers await the same task.
+    The task is cancelled only when all of its callers went away.
+    """
+    class _Flight:
+        def __init__(self):
+            self.task: asyncio.Task or None = None
+            self.waiters: list[Callable[[], bool] or None] = []
+
+        def is_alive(self) -> bool:
+            if not self.waiters:
+                return True
+            return any(alive is None or alive() for alive in self.waiters)
+
+    def __init__(self):
+        self._flights: dict[str, SingleFlight._Flight] = {}
+
+        self.started = 0
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self._flights)
+
+    def _done(self, key: str, flight: _Flight, task: asyncio.Task) -> None:
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+        if not task.cancelled():
+            # mark the exception as retrieved when nobody is waiting anymore
+            task.exception()
+
+    async def run(self, key: str, factory: Callable[[Callable[[], bool]], Awaitable], alive: Callable[[], bool]=None):
+        """
+        Runs factory(is_alive) once per key, concurrent callers share the result
+        :param key: str - key of the call (video id or url)
+        :param factory: callable - creates the awaitable, gets a callback that returns False when all callers went away
+        :param alive: callable - returns False when this caller went away
+        :return: result of the awaitable
+        """
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = self._Flight()
+            flight.task = asyncio.ensure_future(factory(flight.is_alive))
+            flight.task.add_done_callback(lambda task: self._done(key, flight, task))
+            self._flights[key] = flight
+            self.started += 1
+        else:
+            self.coalesced += 1
+
+        flight.waiters.append(alive)
+        try:
+            return await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            # this caller was cancelled, cancel the task only if it was the last one
+            if not flight.task.done() and len(flight.waiters) == 1:
+                flight.task.cancel()
+            raise
+        finally:
+            flight.waiters.remove(alive)
+
+    def running(self, key: str) -> bool:
+        return key in self._flights
+
+    def stats(self) -> dict:
+        return {'in_flight': len(self._flights), 'started': self.started, 'coalesced': self.coalesced}
+
+stream_flights = SingleFlight()
+
+async def resolve_stream(url: str, alive: Callable[[], bool]=None) -> (dict, bool, int or Exception):
+    """
+    Extracts (or gets from cache) the stream of url and validates it with url_checker
+    :param url: str - url to resolve
+    :param alive: callable - returns False when the result is no longer needed
+    :return: (info dict, is valid, status code or exception)
+    """
+    yt_id = extract_yt_id(url)
+
+    data = stream_cache.get(yt_id) if yt_id else None
+    if data is None:
+        with span('extract'):
+            data = await extraction_engine.extract(url, alive=alive)
+        if yt_id:
+            stream_cache.put(yt_id, data)
+
+    with span('url_check'):
+        response, code = await url_checker(data['url'])
+    if not response and yt_id:
+        stream_cache.invalidate(yt_id)
+
+    return data, response, code
+
+def record_play(url: str, data: dict) -> None:
+    """
+    Counts a play of url for the audio cache, called when playback starts (a prefetch is not a play)
+    :param url: str - requested url
+    :param data: dict - resolved info dict
+    :return: None
+    """
+    yt_id = extract_yt_id(url)
+    if yt_id:
+        audio_cache.record_play(yt_id, data)
+
+class SourceUnavailable(Exception):
+    """The source could not be resolved to a working stream"""
+
+class ExtractorUnavailable(SourceUnavailable, CircuitOpen):
+    """The circuit breaker of the extractor is open"""
+
+retry_policy = RetryPolicy(attempts=4, base_delay=0.5, max_delay=8.0)
+circuit_breakers = CircuitBreakers(failure_threshold=5, reset_timeout=30.0)
+
+def get_extractor_name(url: str) -> str:
+    """
+    Returns name of the extractor (circuit breaker) responsible for url
+    :param url: str - url
+    :return: str - 'youtube' or host of the url
+    """
+    if extract_yt_id(url):
+        return 'youtube'
+    try:
+        host = urlparse(url).hostname
+    except ValueError:
+        host = None
+    return host or 'other'
+
+def source_metrics() -> dict:
+    """
+    Returns metrics of source resolution
+    :return: dict
+    """
+    return {'stream_cache': stream_cache.stats(),
+            'flights': stream_flights.stats(),
+            'retry': retry_policy.stats(),
+            'circuit_breakers': circuit_breakers.stats(),
+            'extractor': extraction_engine.stats(),
+            'audio_cache': audio_cache.stats()}
+
+def can_passthrough(data: dict, volume: float=1.0, filters: list[str]=None) -> bool:
+    """
+    Returns True if the stream can be sent to discord without decoding
+    This is possible only when the source is already Opus and no volume change or filter is requested
+    :param data: dict - resolved info dict
+    :param volume: float - requested volume
+    :param filters: list - requested FFmpeg audio filters
+    :return: bool
+    """
+    if PLAYBACK_MODE != 'opus':
+        return False
+    if volume != 1.0 or filters:
+        return False
+    return data.get('acodec') == 'opus'
+
 class GetSource(discord.PCMVolumeTransformer):
-    ytdl = yt_dlp.YoutubeDL(YTDL_OPTIONS)
+    def __init__(self, guild_id: int, source: discord.FFmpegPCMAudio, volume: float=1.0):
+        super().__init__(source, volume)
+
+    @classmethod
+    async def resolve(cls, guild_id: int, url: str, alive: Callable[[], bool]=None) -> dict:
+        """
+        Resolves url to a validated stream
+
+        :param guild_id: int
+        :param url: str
+        :param alive: callable - returns False when the track is no longer wanted (cancels extraction)
+
+        :return: dict - slim info dict with a working 'url'
+        :raises SourceUnavailable: when all attempts failed
+        :raises ExtractorUnavailable: when the extractor's circuit breaker is open
+        """
+        yt_id = extract_yt_id(url)
+        if yt_id:
+            cached = await audio_cache.get(yt_id)
+            if cached is not None:
+                return cached
+
+        key = yt_id or url
+        breaker = circuit_breakers.get(get_extractor_name(url))
+
+        retry_policy.record_call()
+        for attempt in range(retry_policy.attempts):
+            if attempt:
+                with span('backoff', attempt=attempt):
+                    await asyncio.sleep(retry_policy.retry(attempt))
+
+            # a caller joining a running extraction neither checks nor records, the caller that started it does
+            leader = not stream_flights.running(key)
+            trial = False
+            if leader:
+                try:
+                    trial = breaker.check()
+                except CircuitOpen as e:
+                    raise ExtractorUnavailable(str(e)) from None
+
+            try:
+                try:
+                    data, response, code = await stream_flights.run(key, lambda is_alive: resolve_stream(url, is_alive), alive)
+                except ExtractionCancelled:
+                    raise
+                except ExtractionError as e:
+                    if leader:
+                        breaker.record_failure()
+                    log(guild_id, f'Failed to get source', options={'attempt': attempt, 'org_url': url, 'error': e}, log_type='error')
+                    continue
+
+                if response:
+                    if leader:
+                        breaker.record_success()
+                    return data
+
+                if leader:
+                    breaker.record_failure()
+                log(guild_id, f'Failed to get source', options={'attempt': attempt, 'org_url': url, 'code': code, 'url': data['url']}, log_type='error')
+            finally:
+                # a trial that was cancelled (or raised) must not block the breaker
+                if trial:
+                    breaker.release_trial()
+
+        retry_policy.record_exhausted()
+        raise SourceUnavailable(f'Could not get a working stream for `{url}` after {retry_policy.attempts} attempts')
+
+    @classmethod
+    def from_data(cls, guild_id: int, data: dict, time_stamp: int=None, volume: float=1.0, filters: list[str]=None) -> discord.AudioSource:
+        """
+        Creates source from resolved data (starts FFmpeg)
+
+        Opus streams played at full volume without filters are copied (discord.FFmpegOpusAudio),
+        everything else is decoded to PCM and scaled in python (GetSource).
+
+        :param guild_id: int
+        :param data: dict - resolved info dict (see resolve)
+        :param time_stamp: int - time stamp in seconds
+        :param volume: float - volume (1.0 = 100%)
+        :param filters: list - FFmpeg audio filters (-af)
+
+        :return: discord.FFmpegOpusAudio or GetSource
+        """
+        if data.get('local'):
+            # file from the audio cache
+            before_options = f'-ss {time_stamp}' if time_stamp else None
+        else:
+            before_options = f'{f"-ss {time_stamp} " if time_stamp else ""}-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5'
+
+        if can_passthrough(data, volume, filters):
+            bitrate = int(data.get('abr') or 128)
+            return discord.FFmpegOpusAudio(data['url'], bitrate=min(bitrate, 512), codec='copy', before_options=before_options, options='-vn')
+
+        options = '-vn'
+        if filters:
+            options += f' -af {",".join(filters)}'
 
-    def __init__(self, guild_id: int, source: discord.FFmpegPCMAudio):
-        super().__init__(source, 1.0)
+        return cls(guild_id, discord.FFmpegPCMAudio(data['url'], before_options=before_options, options=options), volume)
 
     @classmethod
-    async def create_source(cls, guild_id: int, url: str, time_stamp: int=None, attempt: int=0) -> GetSource:
+    async def create_source(cls, guild_id: int, url: str, time_stamp: int=None, alive: Callable[[], bool]=None, volume: float=1.0, filters: list[str]=None) -> discord.AudioSource:
         """
         Get source from url
 
@@ -54,30 +426,14 @@ class GetSource(discord.PCMVolumeTransformer):
         :param guild_id: int
         :param url: str
         :param time_stamp: int - time stamp in seconds
-        :param attempt: int - how many times has this function been called
+        :param alive: callable - returns False when the track is no longer wanted (cancels extraction)
+        :param volume: float - volume (1.0 = 100%)
+        :param filters: list - FFmpeg audio filters (-af)
 
-        :return source: discord.FFmpegPCMAudio, chapters: list
+        :return source: discord.FFmpegOpusAudio or GetSource
+        :raises SourceUnavailable: when all attempts failed
+        :raises ExtractorUnavailable: when the extractor's circuit breaker is open
         """
-        source_ffmpeg_options = {
-            'before_options': f'{f"-ss {time_stamp} " if time_stamp else ""}-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5',
-            'options': '-vn'
-        }
-
-        org_url = url
-        loop = asyncio.get_event_loop()
-        data = await loop.run_in_executor(None, lambda: cls.ytdl.extract_info(url, download=False))
-
-        if 'entries' in data:
-            data = data['entries'][0]
-
-        url = data['url']
-        response, code = await url_checker(url)
-        if not response:
-            log(guild_id, f'Failed to get source', options={'attempt': attempt, 'org_url': org_url, 'code': code, 'url': url},  log_type='error')
-            if attempt > 9:
-                pass
-            else:
-                attempt += 1
-                return await cls.create_source(guild_id, org_url, time_stamp, attempt)
-
-        return cls(guild_id, discord.FFmpegPCMAudio(url, **source_ffmpeg_options))
+        data = await cls.resolve(guild_id, url, alive)
+        record_play(url, data)
+        return cls.from_data(guild_id, data, time_stamp, volume, filters)
@@ -0,0 +1,177 @@
+from __future__ import annotations
+from utils.log import collect_data, log
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from collections import deque
+from time import monotonic, time
+from typing import Literal
+from math import ceil
+import discord
+import asyncio
+import os
+
+TRACE_SAMPLES = 1000  # durations kept per phase for percentiles
+
+current_trace: ContextVar[Trace or None] = ContextVar('current_trace', default=None)
+
+# kind -> phase -> recent durations in seconds
+trace_samples: dict[str, dict[str, deque]] = {}
+
+class Trace:
+    """
+    Span-style trace of one play request (time to first audio)
+
+    Spans are recorded while the trace is the current one (see span()),
+    the trace is finished when the first audio packet is read from the source (see TracedSource),
+    or when the request ends without playing anything.
+    """
+    def __init__(self, trace_id: str, kind: Literal['play', 'next'], guild_id: int or None):
+        self.trace_id = trace_id
+        self.kind = kind
+        self.guild_id = guild_id
+
+        self.started = monotonic()
+        self.created = time()
+        self.spans: list[dict] = []
+
+        self.waiting_audio = False
+        self.finished = False
+
+    def add(self, name: str, start: float, end: float, attrs: dict=None) -> None:
+        span_dict = {'name': name, 'start': round(start - self.started, 6), 'duration': round(end - start, 6)}
+        if attrs:
+            span_dict['attrs'] = attrs
+        self.spans.append(span_dict)
+
+    def _first_audio(self, played: float, now: float) -> None:
+        self.add('first_audio', played, now)
+        self.finish('ok')
+
+    def finish(self, status: str='ok') -> None:
+        """
+        Records durations for percentiles and writes the raw spans to the structured log
+        :param status: str - 'ok' or reason why nothing was played
+        :return: None
+        """
+        if self.finished:
+            return
+        self.finished = True
+
+        total = max(s['start'] + s['duration'] for s in self.spans) if self.spans else monotonic() - self.started
+        if status == 'ok':
+            phases = trace_samples.setdefault(self.kind, {})
+            for span_dict in self.spans:
+                phases.setdefault(span_dict['name'], deque(maxlen=TRACE_SAMPLES)).append(span_dict['duration'])
+            phases.setdefault('total', deque(maxlen=TRACE_SAMPLES)).append(total)
+
+        collect_data({'type': 'trace', 'trace_id': self.trace_id, 'kind': self.kind, 'guild_id': self.guild_id,
+                      'created': self.created, 'status': status, 'total': round(total, 6), 'spans': self.spans})
+
+class TracedSource(discord.AudioSource):
+    """
+    Wraps the source given to voice.play, finishes trace when the first audio packet is read from it
+
+    :param original: discord.AudioSource
+    :param trace: Trace of the request
+    :param loop: event loop of the bot (read() runs on the audio thread)
+    """
+    def __init__(self, original: discord.AudioSource, trace: Trace, loop: asyncio.AbstractEventLoop):
+        self.original = original
+        self._trace = trace
+        self._loop = loop
+        self._played = monotonic()
+        self._first = True
+        trace.waiting_audio = True
+
+    def read(self) -> bytes:
+        data = self.original.read()
+        if self._first:
+            self._first = False
+            self._loop.call_soon_threadsafe(self._trace._first_audio, self._played, monotonic())
+        return data
+
+    def is_opus(self) -> bool:
+        return self.original.is_opus()
+
+    def cleanup(self) -> None:
+        self.original.cleanup()
+
+def start_trace(kind: Literal['play', 'next'], guild_id: int or None, trace_id=None) -> Trace:
+    """
+    Starts a trace and makes it the current one (in this task and tasks created from it)
+    :param kind: 'play' (user request) or 'next' (transition to the next track)
+    :param guild_id: int
+    :param trace_id: id of the trace (interaction id), random if None
+    :return: Trace
+    """
+    trace = Trace(str(trace_id) if trace_id else os.urandom(8).hex(), kind, guild_id)
+    current_trace.set(trace)
+    return trace
+
+@contextmanager
+def span(name: str, **attrs):
+    """
+    Records duration of the block as a span of the current trace (does nothing without a trace)
+    :param name: str - name of the phase
+    :param attrs: additional attributes of the span
+    """
+    trace = current_trace.get()
+    if trace is None:
+        yield
+        return
+
+    start = monotonic()
+    try:
+        yield
+    finally:
+        trace.add(name, start, monotonic(), attrs)
+
+def percentile(values: list[float], q: float) -> float:
+    """
+    Returns q-th percentile (0-100) of sorted values (nearest rank)
+    """
+    if not values:
+        return 0.0
+    index = max(0, min(len(values) - 1, ceil(q / 100 * len(values)) - 1))
+    return values[index]
+
+def trace_percentiles() -> dict[str, dict[str, dict]]:
+    """
+    Returns percentiles of every phase
+    :return: {kind: {phase: {'count', 'p50', 'p90', 'p99'}}}
+    """
+    out = {}
+    for kind, phases in trace_samples.items():
+        out[kind] = {}
+        for phase, samples in phases.items():
+            values = sorted(samples)
+            out[kind][phase] = {'count': len(values), 'p50': percentile(values, 50), 'p90': percentile(values, 90), 'p99': percentile(values, 99)}
+    return out
+
+class StartupTimer:
+    """
+    Durations of the startup phases (imports, setup, gateway connect, ...), reported to the log once
+    """
+    def __init__(self, start: float=None):
+        self.start = monotonic() if start is None else start
+        self.last = self.start
+        self.phases: list[tuple[str, float]] = []
+        self.reported = False
+
+    def mark(self, phase: str) -> None:
+        """
+        Ends phase (it started when the previous one ended)
+        :param phase: str - name of the phase
+        """
+        now = monotonic()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    def report(self) -> None:
+        if self.reported:
+            return
+        self.reported = True
+        phases = ' | '.join(f'{phase} {duration:.2f}s' for phase, duration in self.phases)
+        log(None, f'Startup: {phases} (total {self.last - self.start:.2f}s)')
+        collect_data({'type': 'startup', 'phases': dict(self.phases), 'total': round(self.last - self.start, 6)})
@@ -1,5 +1,33 @@
-import re
+from classes.data_classes import UrlInfo
+
+from functools import lru_cache
 from typing import Literal
+import re
+
+URL_CACHE_SIZE = 1024  # classified inputs kept in memory
+URL_CACHE_MAX_LENGTH = 256  # longer inputs are not memoized
+
+YT_ID_REGEX = re.compile(r"^(?:https?://|//)?(?:www\.|m\.|.+\.)?(?:youtu\.be/|youtube\.com/(?:embed/|v/|shorts/|feeds/api/videos/|watch\?v=|watch\?.+&v=))([\w-]{11})(?![\w-])")
+URL_REGEX = re.compile(r"(http|ftp|https)://([\w_-]+(?:\.[\w_-]+)+)([\w.,@?^=%&:/~+#-]*[\w@?^=%&/~+#-])")
+YT_PLAYLIST_ID_REGEX = re.compile(r"[?&]list=([\w-]+)")
+YT_PLAYLIST_INDEX_REGEX = re.compile(r"[?&]index=(\d+)")
+SPOTIFY_ID_REGEX = re.compile(r"spotify\.com/(?:intl-[\w-]+/)?(?:track|album|playlist|artist|episode|show)/(\w+)")
+
+# checked in this order after the YouTube types, the URL is the first word containing the section
+SECTION_TYPES = (
+    ('spotify.com/playlist/', 'Spotify Playlist'),
+    ('spotify.com/album/', 'Spotify Album'),
+    ('spotify.com/track/', 'Spotify Track'),
+    ('spotify.com/', 'Spotify URL'),
+    ('soundcloud.com/', 'SoundCloud URL'),
+    ('radio.garden/', 'RadioGarden'),
+)
+
+PREFIX_TYPES = (
+    ('_tunein:', 'RadioTuneIn'),
+    ('_radia_cz:', 'RadioCz'),
+    ('_local:', 'Local'),
+)
 
 def extract_yt_id(url_string: str) -> str or None:
     """
@@ -9,9 +37,11 @@ def extract_yt_id(url_string: str) -> str or None:
     :param url_string: str - url
     :return: str - youtube video id
     """
-    magic_regex = r"^(?:https?://|//)?(?:www\.|m\.|.+\.)?(?:youtu\.be/|youtube\.com/(?:embed/|v/|shorts/|feeds/api/videos/|watch\?v=|watch\?.+&v=))([\w-]{11})(?![\w-])"
-    regex = re.compile(magic_regex)
-    results = regex.search(url_string)
+    # every match contains 'youtu', this skips the (backtracking) regex for most other strings
+    if 'youtu' not in url_string:
+        return None
+
+    results = YT_ID_REGEX.search(url_string)
 
     if results is None:
         return None
@@ -30,6 +60,20 @@ def get_playlist_from_url(url: str) -> str:
     playlist_url = 'https://www.youtube.com/playlist?' + code
     return playlist_url
 
+def get_playlist_index(url: str) -> int or None:
+    """
+    Returns position of the video in the playlist (index= parameter, starting with 1)
+    :param url: str - playlist video url
+    :return: int or None
+    """
+    if 'index=' not in url:
+        return None
+
+    results = YT_PLAYLIST_INDEX_REGEX.search(url)
+    if results is None:
+        return None
+    return int(results.group(1))
+
 def get_url_of(string: str, section: str) -> str or None:
     """
     Returns url of section in string
@@ -53,11 +97,100 @@ def get_first_url(string: str) -> str or None:
     :param string: str - string to search in
     :return: str - url or None
     """
-    re_search = re.search(r"(http|ftp|https)://([\w_-]+(?:\.[\w_-]+)+)([\w.,@?^=%&:/~+#-]*[\w@?^=%&/~+#-])", string)
+    if '://' not in string:
+        return None
+
+    re_search = URL_REGEX.search(string)
     if re_search is None:
         return None
     return re_search[0]
 
+def _url_of(words: list[str], section: str) -> str or None:
+    """
+    get_url_of on a string that was already split into words
+    """
+    for word in words:
+        if section in word:
+            return get_first_url(word)
+    return None
+
+def _with_ids(url_type: str, url: str, video_id: str or None=...) -> UrlInfo:
+    if video_id is ...:
+        video_id = extract_yt_id(url)
+
+    playlist_id = None
+    if 'list=' in url:
+        match = YT_PLAYLIST_ID_REGEX.search(url)
+        playlist_id = match.group(1) if match else None
+
+    spotify_id = None
+    if url_type.startswith('Spotify'):
+        match = SPOTIFY_ID_REGEX.search(url)
+        spotify_id = match.group(1) if match else None
+
+    return UrlInfo(url_type, url, video_id, playlist_id, spotify_id)
+
+def classify_url_uncached(string: str) -> UrlInfo:
+    """
+    Classifies string without the memo cache of classify_url (used for long inputs and by the benchmarks)
+    The branches (and their order) are the same as they always were in get_url_type,
+    the YouTube regex runs once, the string is split into words once and only when needed
+    """
+    yt_id = extract_yt_id(string)
+    words = None
+
+    if yt_id is None:
+        if '/playlist?list=' in string:
+            words = string.split(' ')
+            extracted_url = _url_of(words, '/playlist?list=')
+            if extracted_url is None:
+                return _with_ids('String', string, yt_id)
+            return _with_ids('YouTube Playlist', extracted_url)
+    else:
+        if 'index=' in string or 'list=' in string:
+            words = string.split(' ')
+            extracted_url = _url_of(words, 'index=')
+            if extracted_url is None:
+                extracted_url = _url_of(words, 'list=')
+                if extracted_url is None:
+                    return _with_ids('String', string, yt_id)
+            return _with_ids('YouTube Playlist Video', extracted_url)
+
+        return _with_ids('YouTube Video', string, yt_id)
+
+    for section, url_type in SECTION_TYPES:
+        if section in string:
+            if words is None:
+                words = string.split(' ')
+            extracted_url = _url_of(words, section)
+            if extracted_url is None:
+                return _with_ids('String', string, yt_id)
+            return _with_ids(url_type, extracted_url)
+
+    for prefix, url_type in PREFIX_TYPES:
+        if string.startswith(prefix):
+            return UrlInfo(url_type, string)
+
+    first_url = get_first_url(string)
+    if first_url is not None:
+        return _with_ids('String with URL', first_url)
+
+    return _with_ids('String', string, yt_id)
+
+_classify_url_cached = lru_cache(maxsize=URL_CACHE_SIZE)(classify_url_uncached)
+
+def classify_url(string: str) -> UrlInfo:
+    """
+    Returns type, canonical url and extracted ids of string
+    Results for inputs up to URL_CACHE_MAX_LENGTH characters are memoized
+
+    :param string: str - input of the user
+    :return: UrlInfo
+    """
+    if len(string) <= URL_CACHE_MAX_LENGTH:
+        return _classify_url_cached(string)
+    return classify_url_uncached(string)
+
 def get_url_type(string: str) -> tuple[Literal['YouTube Playlist',
                                                'YouTube Playlist Video',
                                                'YouTube Video',
@@ -73,7 +206,7 @@ def get_url_type(string: str) -> tuple[Literal['YouTube Playlist',
                                                'String with URL',
                                                'String'], str]:
     """
-    Returns type of url
+    Returns type of url (see classify_url for the extracted ids)
 
     :param string: str - string to search in
     :return: (
@@ -93,75 +226,8 @@ def get_url_type(string: str) -> tuple[Literal['YouTube Playlist',
     'String'
     ), url: str
     """
-    first_url = get_first_url(string)
-    yt_id = extract_yt_id(string)
-
-    if '/playlist?list=' in string and extract_yt_id(string) is None:
-        extracted_url = get_url_of(string, '/playlist?list=')
-        if extracted_url is None:
-            return 'String', string
-        return 'YouTube Playlist', extracted_url
-
-    if any(param in string for param in {'index=', 'list='}) and extract_yt_id(string) is not None:
-        extracted_url = get_url_of(string, 'index=')
-        if extracted_url is None:
-            extracted_url = get_url_of(string, 'list=')
-            if extracted_url is None:
-                return 'String', string
-        return 'YouTube Playlist Video', extracted_url
-
-    if yt_id is not None:
-        return 'YouTube Video', string
-
-    if 'spotify.com/playlist/' in string:
-        extracted_url = get_url_of(string, 'spotify.com/playlist/')
-        if extracted_url is None:
-            return 'String', string
-        return 'Spotify Playlist', extracted_url
-
-    if 'spotify.com/album/' in string:
-        extracted_url = get_url_of(string, 'spotify.com/album/')
-        if extracted_url is None:
-            return 'String', string
-        return 'Spotify Album', extracted_url
-
-    if 'spotify.com/track/' in string:
-        extracted_url = get_url_of(string, 'spotify.com/track/')
-        if extracted_url is None:
-            return 'String', string
-        return 'Spotify Track', extracted_url
-
-    if 'spotify.com/' in string:
-        extracted_url = get_url_of(string, 'spotify.com/')
-        if extracted_url is None:
-            return 'String', string
-        return 'Spotify URL', extracted_url
-
-    if 'soundcloud.com/' in string:
-        extracted_url = get_url_of(string, 'soundcloud.com/')
-        if extracted_url is None:
-            return 'String', string
-        return 'SoundCloud URL', extracted_url
-
-    if 'radio.garden/' in string:
-        extracted_url = get_url_of(string, 'radio.garden/')
-        if extracted_url is None:
-            return 'String', string
-        return 'RadioGarden', extracted_url
-
-    if string.startswith('_tunein:'):
-        return 'RadioTuneIn', string
-
-    if string.startswith('_radia_cz:'):
-        return 'RadioCz', string
-
-    if string.startswith('_local:'):
-        return 'Local', string
-
-    if first_url is not None:
-        return 'String with URL', first_url
-
-    return 'String', string
+    info = classify_url(string)
+    return info.type, info.url
 
 def command_for_type(url_type: str) -> str:
     """